@@ -0,0 +1,228 @@
+import math
+from array import array
+from typing import Dict, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, stats are computed without it
+    np = None
+
+# Trackpoint columns, filled in this order by ActivityColumns.append()
+COLUMNS = (
+    "time",  # Seconds since the epoch
+    "distance",  # m
+    "heart_rate",  # bpm
+    "cadence",  # rpm
+    "speed",  # m/s
+    "power",  # W
+    "altitude",  # m
+)
+
+# Trackpoints are buffered as rows and moved to the columns in batches of
+# this size, one array.extend() per column instead of an append per value
+_BATCH_SIZE = 1024
+
+# Normalized power is based on a 30 second rolling average of 1 Hz power
+NP_WINDOW = 30
+# Power is not interpolated across longer gaps between trackpoints (pauses,
+# broken clocks); the rolling average restarts after them
+NP_MAX_GAP = 300
+# No normalized power if the resampled power would exceed this many seconds
+NP_MAX_SECONDS = 7 * 24 * 3600
+
+_NAN = float("nan")
+
+# Columns with average and maximum in the stats: (column, key, unit factor)
+_AVERAGED = (
+    ("heart_rate", "heart_rate", 1),
+    ("speed", "speed_kmh", 3.6),  # m/s to km/h
+)
+
+
+class ActivityColumns:
+    """
+    Trackpoints of an activity in compact columns of doubles, 56 bytes per
+    trackpoint; missing values are NaN. The converter fills it in the same
+    pass that writes the output, and summary stats are computed from the
+    columns (vectorized if NumPy is installed) without another tree walk.
+    """
+
+    def __init__(self):
+        self._columns = {name: array("d") for name in COLUMNS}
+        self._rows = []
+
+    def __len__(self) -> int:
+        return len(self._columns["time"]) + len(self._rows)
+
+    def append(self, *values: Optional[float]) -> None:
+        """
+        Add a trackpoint.
+        :param values: one value per column in the order of COLUMNS,
+            None where the trackpoint has no value.
+        """
+        self._rows.append(values)
+        if len(self._rows) >= _BATCH_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._rows:
+            return
+        for name, values in zip(COLUMNS, zip(*self._rows)):
+            self._columns[name].extend(
+                [_NAN if value is None else value for value in values]
+            )
+        self._rows = []
+
+    def column(self, name: str) -> Sequence[float]:
+        """
+        :return: the column as a NumPy array sharing the memory of the
+            column, or as an array.array without NumPy.
+        """
+        self._flush()
+        column = self._columns[name]
+        if np is not None:
+            return np.frombuffer(column, dtype=np.float64)
+        return column
+
+    def stats(self) -> Dict:
+        """
+        :return: power, heart rate, speed and altitude stats; keys without
+            data are left out.
+        """
+        if np is not None:
+            return _numpy_stats(self)
+        return _python_stats(self)
+
+
+def _rounded(stats: Dict) -> Dict:
+    result = {}
+    for key, value in stats.items():
+        if value is None or math.isnan(value):
+            continue
+        value = float(value)  # NumPy scalars are not plain numbers
+        if key.endswith(("power", "heart_rate")):
+            result[key] = round(value)
+        else:
+            result[key] = round(value, 1)
+    return result
+
+
+def _numpy_stats(columns: ActivityColumns) -> Dict:
+    stats = {}
+    power = columns.column("power")
+    valid = ~np.isnan(power)
+    if valid.any():
+        stats["avg_power"] = power[valid].mean()
+        stats["max_power"] = power[valid].max()
+        stats["normalized_power"] = _numpy_normalized_power(
+            columns.column("time")[valid], power[valid]
+        )
+    for name, key, factor in _AVERAGED:
+        values = columns.column(name)
+        values = values[~np.isnan(values)]
+        if values.size:
+            stats[f"avg_{key}"] = values.mean() * factor
+            stats[f"max_{key}"] = values.max() * factor
+    altitude = columns.column("altitude")
+    altitude = altitude[~np.isnan(altitude)]
+    if altitude.size:
+        stats["min_altitude"] = altitude.min()
+        stats["max_altitude"] = altitude.max()
+        stats["ascent"] = np.clip(np.diff(altitude), 0, None).sum()
+    return _rounded(stats)
+
+
+def _numpy_normalized_power(time, power) -> Optional[float]:
+    # Needs the time of every power value
+    if time.size < 2 or np.isnan(time).any():
+        return None
+    bounds = np.concatenate(
+        ([0], np.flatnonzero(np.diff(time) > NP_MAX_GAP) + 1, [time.size])
+    )
+    starts, ends = bounds[:-1], bounds[1:] - 1
+    spans = time[ends] - time[starts]
+    if np.floor(spans).sum() + spans.size > NP_MAX_SECONDS:
+        return None
+    rolling = []
+    for start, end, span in zip(starts, ends, spans):
+        if span < NP_WINDOW:
+            continue
+        # Resample to 1 Hz, so gaps and faster recording don't skew the
+        # average
+        grid = np.arange(time[start], time[end] + 1)
+        resampled = np.interp(
+            grid, time[start : end + 1], power[start : end + 1]
+        )
+        sums = np.cumsum(np.concatenate(([0.0], resampled)))
+        rolling.append((sums[NP_WINDOW:] - sums[:-NP_WINDOW]) / NP_WINDOW)
+    if not rolling:
+        return None
+    return float(np.mean(np.concatenate(rolling) ** 4) ** 0.25)
+
+
+def _python_stats(columns: ActivityColumns) -> Dict:
+    stats = {}
+    time = columns.column("time")
+    power = columns.column("power")
+    points = [(t, p) for t, p in zip(time, power) if not math.isnan(p)]
+    if points:
+        values = [p for _, p in points]
+        stats["avg_power"] = sum(values) / len(values)
+        stats["max_power"] = max(values)
+        stats["normalized_power"] = _python_normalized_power(points)
+    for name, key, factor in _AVERAGED:
+        values = [v for v in columns.column(name) if not math.isnan(v)]
+        if values:
+            stats[f"avg_{key}"] = sum(values) / len(values) * factor
+            stats[f"max_{key}"] = max(values) * factor
+    altitude = [v for v in columns.column("altitude") if not math.isnan(v)]
+    if altitude:
+        stats["min_altitude"] = min(altitude)
+        stats["max_altitude"] = max(altitude)
+        stats["ascent"] = sum(
+            max(0.0, b - a) for a, b in zip(altitude, altitude[1:])
+        )
+    return _rounded(stats)
+
+
+def _python_normalized_power(points) -> Optional[float]:
+    if len(points) < 2 or any(math.isnan(t) for t, _ in points):
+        return None
+    # Contiguous runs of points, split at gaps longer than NP_MAX_GAP
+    segments = []
+    first = 0
+    for i in range(1, len(points) + 1):
+        if i == len(points) or points[i][0] - points[i - 1][0] > NP_MAX_GAP:
+            segments.append(points[first:i])
+            first = i
+    seconds = sum(
+        math.floor(segment[-1][0] - segment[0][0]) + 1 for segment in segments
+    )
+    if seconds > NP_MAX_SECONDS:
+        return None
+    total = 0.0
+    count = 0
+    for segment in segments:
+        start, end = segment[0][0], segment[-1][0]
+        if end - start < NP_WINDOW:
+            continue
+        # Resample to 1 Hz by linear interpolation, like np.interp
+        resampled = []
+        index = 0
+        second = start
+        while second <= end:
+            while segment[index + 1][0] < second:
+                index += 1
+            (t0, p0), (t1, p1) = segment[index], segment[index + 1]
+            share = (second - t0) / (t1 - t0) if t1 > t0 else 0.0
+            resampled.append(p0 + (p1 - p0) * share)
+            second += 1
+        window = sum(resampled[:NP_WINDOW])
+        total += (window / NP_WINDOW) ** 4
+        for i in range(NP_WINDOW, len(resampled)):
+            window += resampled[i] - resampled[i - NP_WINDOW]
+            total += (window / NP_WINDOW) ** 4
+        count += len(resampled) - NP_WINDOW + 1
+    if not count:
+        return None
+    return (total / count) ** 0.25
@@ -0,0 +1,5 @@
+"""
+Benchmarks for the TCX converter and FIT parsing.
+
+Run ``python -m benchmarks.run --help`` from the project root.
+"""
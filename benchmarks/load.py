@@ -0,0 +1,555 @@
+"""
+Load test of the bot with local stand-ins for Telegram and Garmin Connect.
+
+Synthetic users send TCX, FIT and ZIP documents, which are fed to the real
+dispatcher of bot.py. The bot talks to a fake Bot API session and uploads
+to a fake garth client, both with configurable latency; the fake Garmin
+also fails a share of the uploads. The bot is configured by the same
+environment variables as in production (CONVERSION_WORKERS, MEMORY_BUDGET,
+UPLOAD_RATE_GLOBAL, ...), so scaling changes can be compared before they
+are deployed.
+
+Example:
+    python -m benchmarks.load --users 50 --files 4 --output load.json
+    python -m benchmarks.load --mix zip=1 --zip-entries 20 \
+        --garmin-error-rate 0.2
+"""
+
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import random
+import resource
+import threading
+import time
+import zipfile
+from collections import Counter, defaultdict
+from datetime import timedelta
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+import garth
+import requests
+from aiogram import Bot
+from aiogram.client.bot import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.methods import (
+    EditMessageText,
+    GetFile,
+    SendDocument,
+    SendMessage,
+    TelegramMethod,
+)
+from aiogram.types import Update
+
+from benchmarks.run import _read_status_mb, _reset_peak_rss, percentile
+from benchmarks.synthetic import DEFAULT_START, generate_fit, generate_tcx
+from fair_scheduler import FairTelegramRequests
+from metrics import TelegramRequestMetrics
+from storage import LocalRedis
+from token_store import RedisTokenStore
+from webhook import FakeTelegramSender
+
+KINDS = ("tcx", "fit", "zip")
+DEFAULT_MIX = "tcx=6,fit=3,zip=1"
+
+MIME_TYPES = {
+    "tcx": "application/xml",
+    "fit": "application/octet-stream",
+    "zip": "application/zip",
+}
+
+
+class FakeBotSession(BaseSession):
+    """
+    Bot API session that answers every request locally after a delay.
+    Documents are downloaded from the files registered with add_file().
+    """
+
+    def __init__(self, latency: float = 0.05, **kwargs: Any):
+        """
+        :param latency: seconds every request takes.
+        """
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.files: Dict[str, bytes] = {}
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    def add_file(self, file_id: str, content: bytes) -> None:
+        self.files[file_id] = content
+
+    def _message(self, method: TelegramMethod) -> Dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": getattr(method, "chat_id", 0), "type": "private"},
+            "text": getattr(method, "text", None),
+        }
+
+    async def make_request(
+        self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None
+    ) -> Any:
+        self.calls[type(method).__name__] += 1
+        await asyncio.sleep(self.latency)
+        if isinstance(method, GetFile):
+            result = {
+                "file_id": method.file_id,
+                "file_unique_id": method.file_id,
+                "file_size": len(self.files[method.file_id]),
+                "file_path": method.file_id,
+            }
+        elif isinstance(method, (SendMessage, SendDocument, EditMessageText)):
+            result = self._message(method)
+        else:
+            result = True
+        # Parsed like a real response, so the handlers get real objects
+        response = self.check_response(
+            bot, method, 200, json.dumps({"ok": True, "result": result})
+        )
+        return response.result
+
+    async def stream_content(
+        self,
+        url: str,
+        headers: Optional[Dict[str, Any]] = None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        self.calls["download"] += 1
+        await asyncio.sleep(self.latency)
+        content = self.files[url.rsplit("/", 1)[-1]]
+        for start in range(0, len(content), chunk_size):
+            yield content[start : start + chunk_size]
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeGarmin:
+    """
+    Garmin Connect stand-in: uploads take a random time around the latency
+    and fail with the given HTTP status at the given rate.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.5,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.uploads = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def upload(self, file_io: io.BytesIO) -> Dict:
+        # Called on the uploader's threads, like garth.Client.upload
+        with self._lock:
+            delay = self.latency * self._random.uniform(0.5, 1.5)
+            fail = self._random.random() < self.error_rate
+        time.sleep(delay)
+        with self._lock:
+            self.uploads["failed" if fail else "uploaded"] += 1
+        if fail:
+            response = requests.Response()
+            response.status_code = self.error_status
+            raise garth.exc.GarthHTTPError(
+                msg=f"Fake Garmin error {self.error_status}",
+                error=requests.HTTPError(response=response),
+            )
+        return {"detailedImportResult": {"fileName": file_io.name}}
+
+
+class FakeGarminClient:
+    """
+    Logged in garth client of a synthetic user, uploading to FakeGarmin.
+    """
+
+    oauth2_token = None  # Never refreshed
+
+    def __init__(self, garmin: FakeGarmin):
+        self.garmin = garmin
+
+    def upload(self, file_io: io.BytesIO) -> Dict:
+        return self.garmin.upload(file_io)
+
+    def dumps(self) -> str:
+        return "fake"
+
+
+def _peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """
+    :param spec: weights of the document kinds, e.g. "tcx=6,fit=3,zip=1".
+    :return: weight by kind.
+    """
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError(f"Unknown document kind: {kind}")
+        mix[kind] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("The mix needs a positive weight")
+    return mix
+
+
+def make_document(
+    kind: str, points: int, seed: int, zip_entries: int = 5
+) -> Tuple[str, bytes]:
+    """
+    Build a synthetic document; every seed gives a different activity, so
+    nothing is answered from the conversion cache.
+    :return: file name and content.
+    """
+    start = DEFAULT_START + timedelta(days=seed)
+    if kind == "tcx":
+        return f"ride_{seed}.tcx", generate_tcx(points, start=start, seed=seed)
+    if kind == "fit":
+        return f"ride_{seed}.fit", generate_fit(points, start=start, seed=seed)
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for entry in range(zip_entries):
+            entry_seed = seed * 1000 + entry
+            zip_ref.writestr(
+                f"rides/ride_{entry_seed}.tcx",
+                generate_tcx(
+                    points,
+                    start=start + timedelta(hours=entry),
+                    seed=entry_seed,
+                ),
+            )
+    return f"rides_{seed}.zip", output.getvalue()
+
+
+class LoadTest:
+    """
+    Runs synthetic users against the bot module. Every user sends its files
+    one after another; a file counts as done when its handler has returned
+    and the upload queue has no job of the user left.
+    """
+
+    def __init__(self, bot_module, args: argparse.Namespace):
+        self.bot_module = bot_module
+        self.args = args
+        self.session = FakeBotSession(args.telegram_latency)
+        self.bot = Bot(
+            bot_module.TOKEN_API,
+            session=self.session,
+            default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+        )
+        self.garmin = FakeGarmin(
+            args.garmin_latency,
+            args.garmin_error_rate,
+            args.garmin_error_status,
+            args.seed,
+        )
+        self.mix = parse_mix(args.mix)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors = Counter()
+        self.input_bytes = 0
+        self.peak_reserved = 0
+        self._done: Dict[int, asyncio.Event] = defaultdict(asyncio.Event)
+        self._documents = itertools.count(1)
+        self._updates = None
+
+    def _notifier(self):
+        done = self._done
+
+        class LoadUploadNotifier(self.bot_module.ChatUploadNotifier):
+            # Wakes up the user waiting for the result of the upload
+            async def uploaded(self, job):
+                try:
+                    await super().uploaded(job)
+                finally:
+                    done[job.user_id].set()
+
+            async def already_uploaded(self, job):
+                try:
+                    await super().already_uploaded(job)
+                finally:
+                    done[job.user_id].set()
+
+            async def failed(self, job, error):
+                try:
+                    await super().failed(job, error)
+                finally:
+                    done[job.user_id].set()
+
+        return LoadUploadNotifier(self.bot)
+
+    async def _wait_for_uploads(self, user_id: int) -> None:
+        done = self._done[user_id]
+        while True:
+            # Cleared before the check: a result arriving meanwhile sets it
+            # again, so none is missed
+            done.clear()
+            if not await self.bot_module.upload_queue.pending(user_id):
+                return
+            await done.wait()
+
+    async def _send(self, user_id: int, kind: str) -> None:
+        seed = next(self._documents)
+        file_name, content = await asyncio.to_thread(
+            make_document, kind, self.args.points, seed, self.args.zip_entries
+        )
+        file_id = f"doc{seed}"
+        self.session.add_file(file_id, content)
+        update = self._updates.document_update(
+            user_id, file_name, len(content), file_id, MIME_TYPES[kind]
+        )
+        started = time.perf_counter()
+        try:
+            await self.bot_module.dp.feed_update(
+                self.bot,
+                Update.model_validate(update, context={"bot": self.bot}),
+            )
+            await self._wait_for_uploads(user_id)
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+            return
+        finally:
+            del self.session.files[file_id]
+        self.latencies[kind].append(time.perf_counter() - started)
+        self.input_bytes += len(content)
+
+    async def _user(self, user_id: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        rng = random.Random(self.args.seed * 100003 + user_id)
+        kinds = rng.choices(
+            list(self.mix), list(self.mix.values()), k=self.args.files
+        )
+        for kind in kinds:
+            await self._send(user_id, kind)
+
+    async def _sample_memory(self) -> None:
+        while True:
+            self.peak_reserved = max(
+                self.peak_reserved, self.bot_module.memory_budget.used
+            )
+            await asyncio.sleep(0.05)
+
+    async def run(self) -> Dict:
+        bot_module = self.bot_module
+        args = self.args
+        self._updates = FakeTelegramSender(url="", secret_token="")
+        # Requests go through the same middlewares as in bot.main()
+        self.bot.session.middleware(TelegramRequestMetrics())
+        self.bot.session.middleware(
+            FairTelegramRequests(bot_module.telegram_scheduler)
+        )
+        if args.output_format:
+            bot_module.OUTPUT_FORMAT = args.output_format
+        bot_module.upload_queue.base_delay = args.retry_delay
+        # Synthetic users are logged in with fake clients, kept in memory
+        clients = bot_module.garmin_clients
+        clients.token_store = RedisTokenStore(LocalRedis())
+        clients.max_size = max(clients.max_size, args.users)
+        user_ids = range(1, args.users + 1)
+        for user_id in user_ids:
+            await clients.put(user_id, FakeGarminClient(self.garmin))
+
+        bot_module.converter.start()
+        bot_module.upload_queue.start(self._notifier())
+        sampler = asyncio.create_task(self._sample_memory())
+        # As in benchmarks.run: VmHWM if it can be reset, else ru_maxrss
+        reset = _reset_peak_rss()
+        rss_before = _peak_rss_mb() if not reset else _read_status_mb("VmRSS")
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(
+                *(
+                    self._user(
+                        user_id, args.ramp_up * index / max(1, args.users)
+                    )
+                    for index, user_id in enumerate(user_ids)
+                )
+            )
+            elapsed = time.perf_counter() - started
+        finally:
+            sampler.cancel()
+            await bot_module.upload_queue.close()
+            bot_module.uploader.shutdown()
+            bot_module.converter.shutdown()
+            await bot_module.cache.close()
+        peak_rss = _read_status_mb("VmHWM") if reset else _peak_rss_mb()
+        return self._report(elapsed, peak_rss - rss_before)
+
+    def _report(self, elapsed: float, peak_rss_mb: float) -> Dict:
+        def latency_ms(values: List[float]) -> Dict:
+            if not values:
+                return {}
+            return {
+                "count": len(values),
+                "p50": round(percentile(values, 50) * 1000, 1),
+                "p90": round(percentile(values, 90) * 1000, 1),
+                "p99": round(percentile(values, 99) * 1000, 1),
+                "max": round(max(values) * 1000, 1),
+            }
+
+        all_latencies = [
+            v for values in self.latencies.values() for v in values
+        ]
+        activities = sum(
+            len(values) * (self.args.zip_entries if kind == "zip" else 1)
+            for kind, values in self.latencies.items()
+        )
+        return {
+            "config": vars(self.args),
+            "elapsed_s": round(elapsed, 2),
+            "documents": len(all_latencies),
+            "documents_per_sec": round(len(all_latencies) / elapsed, 2),
+            "activities_per_sec": round(activities / elapsed, 2),
+            "mb_per_sec": round(self.input_bytes / elapsed / 1024 / 1024, 2),
+            "latency_ms": {
+                "all": latency_ms(all_latencies),
+                **{
+                    kind: latency_ms(values)
+                    for kind, values in sorted(self.latencies.items())
+                },
+            },
+            "errors": dict(self.errors),
+            "telegram_requests": dict(self.session.calls),
+            "garmin_uploads": dict(self.garmin.uploads),
+            "peak_rss_growth_mb": round(peak_rss_mb, 1),
+            "peak_memory_reserved_mb": round(
+                self.peak_reserved / 1024 / 1024, 1
+            ),
+        }
+
+
+def _format_report(report: Dict) -> str:
+    lines = [
+        f"{report['documents']} documents in {report['elapsed_s']} s: "
+        f"{report['documents_per_sec']} documents/s, "
+        f"{report['activities_per_sec']} activities/s, "
+        f"{report['mb_per_sec']} MB/s"
+    ]
+    for kind, latency in report["latency_ms"].items():
+        if latency:
+            lines.append(
+                f"{kind:<4} {latency['count']:>6}"
+                f"  p50 {latency['p50']:>9.1f} ms"
+                f"  p90 {latency['p90']:>9.1f} ms"
+                f"  p99 {latency['p99']:>9.1f} ms"
+                f"  max {latency['max']:>9.1f} ms"
+            )
+    lines.append(
+        f"Peak memory: +{report['peak_rss_growth_mb']} MB RSS of the bot "
+        f"process, {report['peak_memory_reserved_mb']} MB reserved "
+        "by the memory budget"
+    )
+    lines.append(f"Telegram requests: {report['telegram_requests']}")
+    lines.append(f"Garmin uploads: {report['garmin_uploads']}")
+    if report["errors"]:
+        lines.append(f"Errors: {report['errors']}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument(
+        "--users", type=int, default=20, help="number of synthetic users"
+    )
+    arg_parser.add_argument(
+        "--files", type=int, default=3, help="documents sent by every user"
+    )
+    arg_parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help=f"weights of the document kinds (default: {DEFAULT_MIX})",
+    )
+    arg_parser.add_argument(
+        "--points",
+        type=int,
+        default=1800,
+        help="Trackpoints per activity (default: 1800)",
+    )
+    arg_parser.add_argument(
+        "--zip-entries",
+        type=int,
+        default=5,
+        help="TCX files per ZIP archive (default: 5)",
+    )
+    arg_parser.add_argument(
+        "--ramp-up",
+        type=float,
+        default=0.0,
+        help="seconds over which the users start (default: all at once)",
+    )
+    arg_parser.add_argument(
+        "--output-format",
+        choices=["tcx", "fit"],
+        help="format TCX files are uploaded in (default: OUTPUT_FORMAT)",
+    )
+    arg_parser.add_argument(
+        "--telegram-latency",
+        type=float,
+        default=0.05,
+        help="seconds every Telegram request takes (default: 0.05)",
+    )
+    arg_parser.add_argument(
+        "--garmin-latency",
+        type=float,
+        default=0.5,
+        help="average seconds a Garmin upload takes (default: 0.5)",
+    )
+    arg_parser.add_argument(
+        "--garmin-error-rate",
+        type=float,
+        default=0.0,
+        help="share of Garmin uploads that fail (default: 0)",
+    )
+    arg_parser.add_argument(
+        "--garmin-error-status",
+        type=int,
+        default=503,
+        help="HTTP status of failed uploads; 429 and 5xx are retried "
+        "(default: 503)",
+    )
+    arg_parser.add_argument(
+        "--retry-delay",
+        type=float,
+        default=1.0,
+        help="delay before the first retry of a failed upload (default: 1)",
+    )
+    arg_parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the synthetic load"
+    )
+    arg_parser.add_argument(
+        "--output", help="save the report to this JSON file"
+    )
+    args = arg_parser.parse_args()
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        arg_parser.error(str(e))
+    if args.users < 1 or args.files < 1:
+        arg_parser.error("--users and --files must be positive")
+
+    # The bot reads its configuration on import; nothing leaves the machine
+    os.environ.setdefault("TOKEN_API_BOT_TCX", "123456:load-test")
+    os.environ.setdefault("UPLOAD_QUEUE_DB", ":memory:")
+    import bot
+
+    report = asyncio.run(LoadTest(bot, args).run())
+    print(_format_report(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
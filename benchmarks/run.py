@@ -0,0 +1,276 @@
+"""
+Benchmark suite for TCX conversion, summary extraction and FIT parsing.
+
+Example:
+    python -m benchmarks.run --sizes 1000,10000,100000 --output results.json
+    python -m benchmarks.run --compare results.json
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+from typing import Callable, Dict, List
+
+from benchmarks.synthetic import generate_fit, write_tcx
+from convert_all_tcx import (
+    BACKENDS,
+    convert_tcx_in_memory,
+    convert_tcx_stream,
+    get_backend,
+)
+from fit_summary import extract_fit_summary
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+MAX_SIZE = 500000
+
+
+class _NullSink:
+    # Discards the converted output, to time parsing and summary only
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+
+def _cases() -> Dict[str, Callable[[bytes], object]]:
+    cases = {}
+    for name in BACKENDS:
+        backend = get_backend(name)
+        cases[f"tcx_convert:{name}"] = (
+            lambda data, backend=backend: convert_tcx_in_memory(data, backend)
+        )
+        cases[f"tcx_summary:{name}"] = (
+            lambda data, backend=backend: convert_tcx_stream(
+                BytesIO(data), _NullSink(), backend
+            )
+        )
+    cases["fit_summary"] = extract_fit_summary
+    return cases
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Nearest-rank percentile, q in [0, 100].
+    """
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _read_status_mb(field: str) -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def _reset_peak_rss() -> bool:
+    # Linux resets the VmHWM high-water mark on writing 5 to clear_refs
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_memory_worker(case: str, path: str, queue) -> None:
+    with open(path, "rb") as f:
+        data = f.read()
+    func = _cases()[case]
+    if _reset_peak_rss():
+        before = _read_status_mb("VmRSS")
+        func(data)
+        peak = _read_status_mb("VmHWM")
+    else:
+        # ru_maxrss can't be reset, so growth below the import peak is lost
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        func(data)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put(peak - before)
+
+
+def measure_peak_memory(case: str, path: str) -> float:
+    """
+    Run a case once in a fresh process.
+    :return: growth of the peak RSS in MB caused by the case, input excluded.
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(
+        target=_peak_memory_worker, args=(case, path, queue)
+    )
+    process.start()
+    result = queue.get()
+    process.join()
+    return round(result, 2)
+
+
+def run_case(
+    case: str, data: bytes, points: int, repeat: int, path: str, memory: bool
+) -> Dict:
+    func = _cases()[case]
+    func(data)  # Warm-up
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(data)
+        latencies.append(time.perf_counter() - started)
+    median = percentile(latencies, 50)
+    result = {
+        "case": case,
+        "points": points,
+        "input_bytes": len(data),
+        "runs": repeat,
+        "latency_ms": {
+            "min": round(min(latencies) * 1000, 3),
+            "p50": round(median * 1000, 3),
+            "p90": round(percentile(latencies, 90) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(max(latencies) * 1000, 3),
+        },
+        "points_per_sec": round(points / median),
+        "mb_per_sec": round(len(data) / median / 1024 / 1024, 2),
+    }
+    if memory:
+        result["peak_memory_mb"] = measure_peak_memory(case, path)
+    return result
+
+
+def run_suite(
+    sizes: List[int], repeat: int, cases: List[str], memory: bool
+) -> Dict:
+    results = []
+    with tempfile.TemporaryDirectory(prefix="tcx_bench_") as tmp_dir:
+        for points in sizes:
+            tcx_path = os.path.join(tmp_dir, f"{points}.tcx")
+            with open(tcx_path, "wb") as f:
+                write_tcx(f, points, laps=max(1, points // 3600))
+            fit_path = os.path.join(tmp_dir, f"{points}.fit")
+            with open(fit_path, "wb") as f:
+                f.write(generate_fit(points))
+
+            # Fewer runs for big inputs, so the suite finishes in minutes
+            runs = max(1, min(repeat, repeat * 10000 // points))
+            for case in cases:
+                path = fit_path if case == "fit_summary" else tcx_path
+                with open(path, "rb") as f:
+                    data = f.read()
+                result = run_case(case, data, points, runs, path, memory)
+                results.append(result)
+                print(_format_result(result), flush=True)
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def _format_result(result: Dict) -> str:
+    line = (
+        f"{result['case']:<22} {result['points']:>7} pts "
+        f"p50 {result['latency_ms']['p50']:>10.1f} ms  "
+        f"p99 {result['latency_ms']['p99']:>10.1f} ms  "
+        f"{result['points_per_sec']:>9} pts/s  "
+        f"{result['mb_per_sec']:>7.2f} MB/s"
+    )
+    if "peak_memory_mb" in result:
+        line += f"  peak +{result['peak_memory_mb']:.1f} MB"
+    return line
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> bool:
+    """
+    Print the change of median latency against a baseline run.
+    :return: True if no case got slower by more than the threshold.
+    """
+    previous = {
+        (r["case"], r["points"]): r for r in baseline.get("results", [])
+    }
+    ok = True
+    for result in current["results"]:
+        old = previous.get((result["case"], result["points"]))
+        if old is None:
+            continue
+        change = (
+            result["latency_ms"]["p50"] / old["latency_ms"]["p50"] - 1
+            if old["latency_ms"]["p50"]
+            else 0.0
+        )
+        regression = change > threshold
+        ok = ok and not regression
+        print(
+            f"{result['case']:<22} {result['points']:>7} pts "
+            f"p50 {old['latency_ms']['p50']:.1f} -> "
+            f"{result['latency_ms']['p50']:.1f} ms ({change:+.1%})"
+            + ("  REGRESSION" if regression else "")
+        )
+    return ok
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help=f"comma-separated Trackpoint counts, up to {MAX_SIZE}",
+    )
+    arg_parser.add_argument(
+        "--repeat", type=int, default=5, help="timed runs per case"
+    )
+    arg_parser.add_argument(
+        "--cases",
+        help="comma-separated cases to run (default: all): "
+        + ", ".join(_cases()),
+    )
+    arg_parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="skip peak memory measurement",
+    )
+    arg_parser.add_argument("--output", help="save results to this JSON file")
+    arg_parser.add_argument(
+        "--compare", help="JSON results of a previous run to compare with"
+    )
+    arg_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="slowdown that counts as a regression (default: 0.10)",
+    )
+    args = arg_parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    if any(size < 1 or size > MAX_SIZE for size in sizes):
+        arg_parser.error(f"sizes must be between 1 and {MAX_SIZE}")
+    cases = args.cases.split(",") if args.cases else list(_cases())
+    unknown = set(cases) - set(_cases())
+    if unknown:
+        arg_parser.error(f"unknown cases: {', '.join(sorted(unknown))}")
+
+    results = run_suite(sizes, args.repeat, cases, not args.no_memory)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
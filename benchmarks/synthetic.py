@@ -0,0 +1,230 @@
+"""
+Generators of synthetic Kinomap-style activity files for benchmarks.
+"""
+
+import argparse
+import math
+import random
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from typing import BinaryIO
+
+TCX_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<TrainingCenterDatabase xsi:schemaLocation="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 '
+    'http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd" '
+    'xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2" '
+    'xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+)
+
+DEFAULT_START = datetime(2024, 5, 1, 10, 0, 0, tzinfo=timezone.utc)
+
+
+def _iso(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def write_tcx(
+    destination: BinaryIO,
+    points: int = 3600,
+    laps: int = 1,
+    heart_rate: bool = True,
+    cadence: bool = True,
+    tpx: bool = True,
+    start: datetime = DEFAULT_START,
+    seed: int = 0,
+) -> None:
+    """
+    Write a synthetic indoor ride the way Kinomap exports it: one Trackpoint per
+    second with time, distance, heart rate, cadence and TPX speed and watts.
+    :param destination: binary file-like object.
+    :param points: total number of Trackpoints.
+    :param laps: number of laps the points are split into.
+    :param heart_rate: include HeartRateBpm.
+    :param cadence: include Cadence.
+    :param tpx: include the TPX extension with Speed and Watts.
+    :param start: start time of the activity.
+    :param seed: seed of the random noise, the same seed gives the same file.
+    """
+    rng = random.Random(seed)
+    laps = max(1, min(laps, points or 1))
+    per_lap = [
+        points // laps + (1 if i < points % laps else 0) for i in range(laps)
+    ]
+
+    destination.write(TCX_HEADER.encode("utf-8"))
+    destination.write(
+        (
+            '<Activities><Activity Sport="biking">' f"<Id>{_iso(start)}</Id>\n"
+        ).encode("utf-8")
+    )
+
+    distance = 0.0
+    second = 0
+    for lap_points in per_lap:
+        lap_start = start + timedelta(seconds=second)
+        # Speed and power follow a slow wave with some noise
+        samples = []
+        lap_distance = 0.0
+        for _ in range(lap_points):
+            phase = 2 * math.pi * second / 600
+            speed = max(
+                0.0, 8.0 + 2.0 * math.sin(phase) + rng.uniform(-0.3, 0.3)
+            )
+            watts = max(
+                0, round(180 + 60 * math.sin(phase) + rng.uniform(-15, 15))
+            )
+            hr = round(130 + 20 * math.sin(phase / 2) + rng.uniform(-2, 2))
+            cad = round(85 + 8 * math.sin(phase) + rng.uniform(-3, 3))
+            distance += speed
+            lap_distance += speed
+            second += 1
+            samples.append((second, distance, speed, watts, hr, cad))
+
+        destination.write(
+            (
+                f'<Lap StartTime="{_iso(lap_start)}">'
+                f"<TotalTimeSeconds>{lap_points}.0</TotalTimeSeconds>"
+                f"<DistanceMeters>{lap_distance:.2f}</DistanceMeters>"
+                f"<Calories>{round(lap_points * 0.2)}</Calories>"
+                "<Intensity>Active</Intensity>"
+                "<TriggerMethod>Manual</TriggerMethod>"
+                "<Track>\n"
+            ).encode("utf-8")
+        )
+        chunk = []
+        for sec, dist, speed, watts, hr, cad in samples:
+            parts = [
+                "<Trackpoint>",
+                f"<Time>{_iso(start + timedelta(seconds=sec))}</Time>",
+                "<Position><LatitudeDegrees>45.0</LatitudeDegrees>"
+                "<LongitudeDegrees>5.0</LongitudeDegrees></Position>",
+                "<AltitudeMeters>200.0</AltitudeMeters>",
+                f"<DistanceMeters>{dist:.2f}</DistanceMeters>",
+            ]
+            if heart_rate:
+                parts.append(
+                    f"<HeartRateBpm><Value>{hr}</Value></HeartRateBpm>"
+                )
+            if cadence:
+                parts.append(f"<Cadence>{cad}</Cadence>")
+            if tpx:
+                parts.append(
+                    "<Extensions><ns3:TPX>"
+                    f"<ns3:Speed>{speed:.3f}</ns3:Speed>"
+                    f"<ns3:Watts>{watts}</ns3:Watts>"
+                    "</ns3:TPX></Extensions>"
+                )
+            parts.append("</Trackpoint>\n")
+            chunk.append("".join(parts))
+            if len(chunk) >= 1000:
+                destination.write("".join(chunk).encode("utf-8"))
+                chunk = []
+        destination.write("".join(chunk).encode("utf-8"))
+        destination.write(b"</Track></Lap>\n")
+
+    destination.write(
+        b"<Creator><Name>Kinomap</Name></Creator></Activity></Activities>"
+        b"</TrainingCenterDatabase>\n"
+    )
+
+
+def generate_tcx(points: int = 3600, **kwargs) -> bytes:
+    """
+    Same as write_tcx, but returns the file as bytes.
+    """
+    output = BytesIO()
+    write_tcx(output, points, **kwargs)
+    return output.getvalue()
+
+
+def generate_fit(
+    points: int = 3600, start: datetime = DEFAULT_START, seed: int = 0
+) -> bytes:
+    """
+    Build a synthetic FIT activity with one record per second and a session.
+    :param points: number of record messages.
+    :param start: start time of the activity.
+    :param seed: seed of the random noise.
+    :return: FIT file as bytes.
+    """
+    from fit_tool.fit_file_builder import FitFileBuilder
+    from fit_tool.profile.messages.file_id_message import FileIdMessage
+    from fit_tool.profile.messages.record_message import RecordMessage
+    from fit_tool.profile.messages.session_message import SessionMessage
+    from fit_tool.profile.profile_type import FileType, Manufacturer, Sport
+
+    rng = random.Random(seed)
+    start_ms = round(start.timestamp()) * 1000
+    builder = FitFileBuilder(auto_define=True)
+
+    message = FileIdMessage()
+    message.type = FileType.ACTIVITY
+    message.manufacturer = Manufacturer.DEVELOPMENT.value
+    message.product = 0
+    message.time_created = start_ms
+    message.serial_number = 0x12345678
+    builder.add(message)
+
+    distance = 0.0
+    records = []
+    for second in range(points):
+        speed = max(0.0, 8.0 + rng.uniform(-0.3, 0.3))
+        distance += speed
+        message = RecordMessage()
+        message.timestamp = start_ms + second * 1000
+        message.distance = distance
+        message.speed = speed
+        message.power = round(180 + rng.uniform(-15, 15))
+        message.heart_rate = round(130 + rng.uniform(-2, 2))
+        message.cadence = round(85 + rng.uniform(-3, 3))
+        records.append(message)
+    builder.add_all(records)
+
+    message = SessionMessage()
+    message.timestamp = start_ms + points * 1000
+    message.start_time = start_ms
+    message.total_elapsed_time = points
+    message.total_timer_time = points
+    message.total_distance = distance
+    message.sport = Sport.CYCLING
+    builder.add(message)
+
+    return builder.build().to_bytes()
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description="Write a synthetic Kinomap-style TCX (or FIT) file."
+    )
+    arg_parser.add_argument("output", help="output file path")
+    arg_parser.add_argument("--points", type=int, default=3600)
+    arg_parser.add_argument("--laps", type=int, default=1)
+    arg_parser.add_argument("--no-heart-rate", action="store_true")
+    arg_parser.add_argument("--no-cadence", action="store_true")
+    arg_parser.add_argument("--no-tpx", action="store_true")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument(
+        "--fit", action="store_true", help="write a FIT file instead"
+    )
+    args = arg_parser.parse_args()
+
+    if args.fit:
+        with open(args.output, "wb") as f:
+            f.write(generate_fit(args.points, seed=args.seed))
+        return
+    with open(args.output, "wb") as f:
+        write_tcx(
+            f,
+            args.points,
+            laps=args.laps,
+            heart_rate=not args.no_heart_rate,
+            cadence=not args.no_cadence,
+            tpx=not args.no_tpx,
+            seed=args.seed,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,63 @@
 import asyncio
-import datetime
-import io
 import logging
-import re
+import time
 import zipfile
-from datetime import datetime, timedelta
+from html import escape
 from os import getenv
+from typing import Dict, Optional
 
 import garth
-import keyring
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.client.bot import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramAPIError
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import DefaultKeyBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import BufferedInputFile, Message
+from aiogram.types import BufferedInputFile, FSInputFile, Message
 from aiogram.utils.markdown import hbold
-from fit_tool.fit_file import FitFile
-from fit_tool.profile.messages.session_message import SessionMessage
 
-from convert_all_tcx import convert_tcx_in_memory
+from client_pool import GarminClientPool
+from compaction import CompactionRules
+from conversion_cache import ConversionCache, content_hash
+from conversion_pool import ConversionBusyError, ConversionExecutor
+from convert_all_tcx import OUTPUT_FORMATS, output_file_name
+from downloads import (
+    SPOOL_THRESHOLD,
+    download_document,
+    looks_like_fit,
+    looks_like_tcx,
+)
+from fair_scheduler import FairScheduler, FairTelegramRequests
+from garmin_uploader import GarminUploader
+from memory_budget import (
+    JobTooLargeError,
+    MemoryBudget,
+    MemoryBudgetTimeout,
+    Reservation,
+    estimate_footprint,
+)
+from metrics import (
+    FAILURES,
+    FILE_BYTES,
+    FILES,
+    STAGE_SECONDS,
+    TelegramRequestMetrics,
+    start_metrics_server,
+)
+from storage import SQLiteStorage, dump_fsm_data, redis_from_url
+from token_store import KeyringTokenStore, RedisTokenStore, SQLiteTokenStore
+from upload_queue import UploadJob, UploadNotifier, UploadQueue
+from webhook import run_webhook
+from zip_pipeline import (
+    BatchReport,
+    BatchReporter,
+    ResultArchive,
+    ZipBatchPipeline,
+    result_entry_name,
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -29,7 +65,140 @@ logger = logging.getLogger(__name__)
 
 # Initialize the Bot and Dispatcher
 TOKEN_API = getenv("TOKEN_API_BOT_TCX")
-dp = Dispatcher(storage=MemoryStorage())
+
+# FSM state is kept in memory, in an SQLite file shared by the bot processes
+# of one machine, or in Redis shared by processes on any number of machines.
+# With Redis, Garmin tokens are kept there too instead of the local keyring;
+# otherwise they can be kept encrypted in an SQLite file
+REDIS_URL = getenv("REDIS_URL")
+FSM_STORAGE_DB = getenv("FSM_STORAGE_DB")
+TOKEN_STORE_DB = getenv("TOKEN_STORE_DB")
+TOKEN_STORE_KEY = getenv("TOKEN_STORE_KEY")
+if TOKEN_STORE_DB and not TOKEN_STORE_KEY:
+    raise ValueError("TOKEN_STORE_KEY must be set with TOKEN_STORE_DB")
+redis = redis_from_url(REDIS_URL) if REDIS_URL else None
+if redis is not None:
+    # Imported here, since the redis package is only needed with REDIS_URL
+    from aiogram.fsm.storage.redis import RedisStorage
+
+    # The storage gets a client of its own, as aiogram closes it when
+    # polling stops, while the token store is still saving tokens. Bot ids
+    # stay in the keys, as the earlier storage kept them there
+    storage = RedisStorage.from_url(
+        REDIS_URL,
+        key_builder=DefaultKeyBuilder(with_bot_id=True),
+        json_dumps=dump_fsm_data,
+    )
+    token_store = RedisTokenStore(redis)
+else:
+    storage = (
+        SQLiteStorage(FSM_STORAGE_DB) if FSM_STORAGE_DB else MemoryStorage()
+    )
+    token_store = (
+        SQLiteTokenStore(TOKEN_STORE_DB, TOKEN_STORE_KEY)
+        if TOKEN_STORE_DB
+        else KeyringTokenStore()
+    )
+dp = Dispatcher(storage=storage)
+
+# Garmin calls are blocking, so they run on a bounded thread pool.
+# Like conversion workers, its threads are shared round-robin between users,
+# so one big ZIP archive can't hold up everyone else
+uploader = GarminUploader(
+    max_workers=int(getenv("GARMIN_UPLOAD_WORKERS", "4")),
+    per_user_limit=int(getenv("USER_UPLOAD_LIMIT", "0")) or None,
+)
+
+# TCX conversion and FIT parsing are CPU-bound, so they run in worker processes.
+# Optionally, redundant trackpoints are dropped to shrink converted files
+converter = ConversionExecutor(
+    max_workers=int(getenv("CONVERSION_WORKERS", "0")) or None,
+    queue_size=int(getenv("CONVERSION_QUEUE_SIZE", "16")),
+    per_user_limit=int(getenv("USER_CONVERSION_LIMIT", "0")) or None,
+    compaction=CompactionRules.parse(getenv("TRACKPOINT_COMPACTION")),
+)
+BUSY_MESSAGE = "The bot is busy right now. Please try again in a minute."
+
+# Outgoing Telegram requests are shared between chats in the same way
+telegram_scheduler = FairScheduler(
+    int(getenv("TELEGRAM_CONCURRENCY", "8")), per_user_limit=1, name="telegram"
+)
+
+# Resent files are answered from the cache instead of being converted
+# and uploaded again
+cache = ConversionCache(
+    max_bytes=int(getenv("CONVERSION_CACHE_SIZE", str(64 * 1024 * 1024))),
+    db_path=getenv("CONVERSION_CACHE_DB"),
+)
+ALREADY_UPLOADED_MESSAGE = (
+    "You have already uploaded this activity to Garmin Connect."
+)
+
+# Authorized garth clients stay in memory; tokens are refreshed in background
+garmin_clients = GarminClientPool(
+    uploader,
+    max_size=int(getenv("GARMIN_CLIENT_POOL_SIZE", "1000")),
+    idle_ttl=float(getenv("GARMIN_CLIENT_IDLE_TTL", "3600")),
+    token_store=token_store,
+)
+
+# Uploads are queued on disk and retried when Garmin is temporarily unavailable
+upload_queue = UploadQueue(
+    uploader,
+    garmin_clients,
+    db_path=getenv("UPLOAD_QUEUE_DB", "upload_queue.db"),
+    workers=int(getenv("UPLOAD_QUEUE_WORKERS", str(uploader.max_workers))),
+    max_attempts=int(getenv("UPLOAD_MAX_ATTEMPTS", "8")),
+    user_rate=float(getenv("UPLOAD_RATE_PER_USER", "10")),
+    global_rate=float(getenv("UPLOAD_RATE_GLOBAL", "120")),
+    cache=cache,
+)
+
+# Files in flight reserve their estimated memory footprint first, so bursts
+# of big files wait (or are turned away) instead of exhausting the memory
+memory_budget = MemoryBudget(
+    int(getenv("MEMORY_BUDGET", str(512 * 1024 * 1024))) or None,
+    timeout=float(getenv("MEMORY_BUDGET_TIMEOUT", "60")),
+)
+TOO_LARGE_NOW_MESSAGE = (
+    "The file is too large for the bot to process. "
+    "Please send a smaller file."
+)
+
+# Entries of a ZIP archive are read, converted and uploaded concurrently
+zip_pipeline = ZipBatchPipeline(
+    converter,
+    uploader,
+    read_limit=int(getenv("ZIP_READ_CONCURRENCY", "2")),
+    convert_limit=int(
+        getenv("ZIP_CONVERT_CONCURRENCY", str(converter.max_workers))
+    ),
+    upload_limit=int(getenv("ZIP_UPLOAD_CONCURRENCY", "2")),
+    cache=cache,
+    upload_queue=upload_queue,
+    memory_budget=memory_budget,
+)
+
+
+# TCX files are uploaded as cleaned TCX or encoded as FIT, which is much
+# smaller; users can pick their own format with /format
+OUTPUT_FORMAT = getenv("OUTPUT_FORMAT", "tcx").lower()
+if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+    raise ValueError(f"Unknown OUTPUT_FORMAT: {OUTPUT_FORMAT}")
+
+# Prometheus metrics are served on a local HTTP endpoint; port 0 disables it
+METRICS_HOST = getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(getenv("METRICS_PORT", "9100"))
+
+# Updates are received by long polling, or by a webhook, which lets several
+# replicas share one bot token behind a load balancer
+BOT_MODE = getenv("BOT_MODE", "polling").lower()
+WEBHOOK_HOST = getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")
+SHUTDOWN_TIMEOUT = float(getenv("SHUTDOWN_TIMEOUT", "60"))
 
 
 class AuthForm(StatesGroup):
@@ -37,28 +206,90 @@ class AuthForm(StatesGroup):
     password = State()
 
 
+def summary_details(summary: dict) -> str:
+    """
+    :return: lines for the summary message with the power, heart rate, speed
+        and altitude stats the activity has, and the dropped trackpoints.
+    """
+    lines = []
+    if "avg_power" in summary:
+        power = f"⚡ Power: avg {summary['avg_power']} W"
+        if "normalized_power" in summary:
+            power += f", NP {summary['normalized_power']} W"
+        lines.append(f"{power}, max {summary['max_power']} W")
+    if "avg_heart_rate" in summary:
+        lines.append(
+            f"❤️ Heart Rate: avg {summary['avg_heart_rate']} bpm, "
+            f"max {summary['max_heart_rate']} bpm"
+        )
+    if "avg_speed_kmh" in summary:
+        lines.append(
+            f"🚀 Speed: avg {summary['avg_speed_kmh']} km/h, "
+            f"max {summary['max_speed_kmh']} km/h"
+        )
+    if "min_altitude" in summary:
+        lines.append(
+            f"⛰ Altitude: {summary['min_altitude']}–"
+            f"{summary['max_altitude']} m, ascent {summary['ascent']} m"
+        )
+    if summary.get("trackpoints_removed"):
+        lines.append(
+            f"🗜 Trackpoints removed: {summary['trackpoints_removed']} "
+            f"of {summary['trackpoints']}"
+        )
+    return "".join(f"\n{line}" for line in lines)
+
+
 async def check_auth(message: Message, bot: Bot, state: FSMContext):
     """
     Check if the user is authorized.
+    Returns the user's garth client, or asks the user to log in.
     """
     user_id = message.from_user.id
 
-    auth = keyring.get_password(f"tcx_bot_{user_id}", "auth")
+    g_client = await garmin_clients.get(user_id)
 
-    if not auth:
+    if not g_client:
         await message.answer(
             "You are not logged in. Please provide me with your email address to log in to Garmin Connect:"
         )
         await state.set_state(AuthForm.email)
-    else:
-        # Create a new instance of garth.client for the user
-        g_client = garth.Client()
-        g_client.loads(auth)
-        auth = g_client.dumps()
-        keyring.set_password(f"tcx_bot_{user_id}", "auth", auth)
-        await state.update_data(g_client=g_client)
-        await message.answer("You are already logged in to Garmin Connect.")
-        return g_client
+    return g_client
+
+
+async def reserve_memory(
+    message: Message, kind: str, amount: int
+) -> Optional[Reservation]:
+    """
+    Reserve the estimated memory footprint of a file, or tell the user why
+    the file can't be processed.
+    :return: the reservation, or None if the file was rejected.
+    """
+    try:
+        return await memory_budget.reserve(amount)
+    except JobTooLargeError:
+        FAILURES.inc(kind=kind, type="too_large")
+        await message.answer(TOO_LARGE_NOW_MESSAGE)
+    except MemoryBudgetTimeout:
+        FAILURES.inc(kind=kind, type="busy")
+        await message.answer(BUSY_MESSAGE)
+    return None
+
+
+async def get_output_format(state: FSMContext) -> str:
+    """
+    Output format chosen by the user with /format, or the bot's default.
+    """
+    data = await state.get_data()
+    return data.get("output_format", OUTPUT_FORMAT)
+
+
+async def finish_login(state: FSMContext) -> None:
+    # Leave the login form but keep the user's settings
+    data = await state.get_data()
+    data.pop("email", None)
+    await state.set_state(None)
+    await state.set_data(data)
 
 
 @dp.message(AuthForm.email)
@@ -80,25 +311,22 @@ async def process_password(message: Message, bot: Bot, state: FSMContext):
     try:
         # Create a new instance of garth.client for the user
         g_client = garth.Client()
-        g_client.login(email, password)
-
-        auth = g_client.dumps()
+        await uploader.login(g_client, email, password)
 
         user_id = message.from_user.id
 
-        keyring.set_password(f"tcx_bot_{user_id}", "auth", auth)
+        await garmin_clients.put(user_id, g_client)
 
         await message.answer(
             "Thank you! Your data has been received and saved securely."
         )
 
-        await state.clear()
-        await state.update_data(g_client=g_client)
+        await finish_login(state)
     except Exception as e:
         logger.error(f"Error during login: {e}")
         logger.info(f"Failed login attempt for user ID={message.from_user.id}")
         await message.answer(f"An error occurred, please try again")
-        await state.clear()
+        await finish_login(state)
 
 
 @dp.message(CommandStart())
@@ -111,6 +339,26 @@ async def start_handler(message: Message) -> None:
     )
 
 
+@dp.message(Command("format"))
+async def format_handler(message: Message, state: FSMContext) -> None:
+    """
+    This handler receives messages with /format command
+    and sets the format of converted TCX files.
+    """
+    args = (message.text or "").split()[1:]
+    if args and args[0].lower() in OUTPUT_FORMATS:
+        await state.update_data(output_format=args[0].lower())
+    elif args:
+        await message.answer(
+            f"Unknown format. Use /format {' or /format '.join(OUTPUT_FORMATS)}."
+        )
+        return
+    output_format = await get_output_format(state)
+    await message.answer(
+        f"Converted TCX files are uploaded as {output_format.upper()}."
+    )
+
+
 @dp.message(Command("stop"))
 async def stop_handler(message: Message, state: FSMContext) -> None:
     """
@@ -119,7 +367,9 @@ async def stop_handler(message: Message, state: FSMContext) -> None:
     user_id = message.from_user.id
     try:
         await state.clear()
-        keyring.delete_password(f"tcx_bot_{user_id}", "auth")
+        await cache.forget_user(user_id)
+        await upload_queue.forget_user(user_id)
+        await garmin_clients.delete(user_id)
     finally:
         await message.answer(
             f"Bye, {hbold(message.from_user.full_name)}! I forgot your data."
@@ -138,75 +388,94 @@ async def handle_tcx_file(
         f"Received file: {message.document.file_name}, MIME-type: {message.document.mime_type} "
         f"from user {message.from_user.full_name}, ID={message.from_user.id}"
     )
+    FILES.inc(kind="tcx")
+    FILE_BYTES.inc(message.document.file_size or 0, kind="tcx")
     if message.document.file_size > 50 * 1024 * 1024:  # 50 MB
+        FAILURES.inc(kind="tcx", type="too_large")
         await message.answer(
             "The file is too large. Please send a smaller file."
         )
         return
 
-    data = await state.get_data()
-    g_client = data.get("g_client")
+    g_client = await check_auth(message, bot, state)
     if not g_client:
-        g_client = await check_auth(message, bot, state)
-        if not g_client:
-            return
+        return
 
-    # Get file details
-    file_id = message.document.file_id
-    file = await bot.get_file(file_id)
-    file_path = file.file_path
-
-    # Download the file into memory
-    downloaded_file = await bot.download_file(file_path)
-    file_content = downloaded_file.read()
-    # Check if the file content is a valid TCX file
-    if re.search(rb"<\?xml.*?\?>", file_content) and re.search(
-        rb"<TrainingCenterDatabase", file_content
-    ):
-        try:
-            # Convert the TCX file (in memory)
-            converted_content, summary = convert_tcx_in_memory(file_content)
-            logger.info("TCX conversion completed successfully.")
+    output_format = await get_output_format(state)
+    file_size = message.document.file_size
+    reservation = await reserve_memory(
+        message,
+        "tcx",
+        estimate_footprint(
+            file_size, output_format, on_disk=file_size > SPOOL_THRESHOLD
+        ),
+    )
+    if reservation is None:
+        return
 
-            # Send back the converted file
-            await message.answer(
-                "Conversion was successful! Trying to upload to Garmin Connect....\n\n"
-                f"📅 Activity Date & Time: {summary['activity_datetime']}\n"
-                f"⏱ Total Time: {summary['total_time']}\n"
-                f"🛣 Total Distance: {summary['total_distance_km']} km"
-            )
+    # Download the file into memory (or a temp file if it is large)
+    with reservation, await download_document(
+        bot, message.document
+    ) as download:
+        # Check if the file content is a valid TCX file
+        with STAGE_SECONDS.time(stage="validation"):
+            valid = looks_like_tcx(download.head())
+            if valid:
+                key = await asyncio.to_thread(content_hash, download.open())
+        if valid:
+            if await cache.is_uploaded(message.from_user.id, key):
+                await message.answer(ALREADY_UPLOADED_MESSAGE)
+                return
+            cache_key = converter.cache_key(key, output_format)
             try:
-                converted_content_io = io.BytesIO(converted_content)
-                converted_content_io.name = (
-                    f"converted_{message.document.file_name}"
-                )
-                uploaded = g_client.upload(converted_content_io)
-
-                if uploaded:
-                    await message.answer(
-                        "File uploaded successfully to Garmin Connect!"
+                cached = await cache.get(cache_key)
+                if cached:
+                    converted_content, summary = cached
+                else:
+                    # Convert the TCX file in a worker process
+                    converted_content, summary = await converter.convert_tcx(
+                        download.source(), message.from_user.id, output_format
                     )
-            except garth.exc.GarthHTTPError as e:
-                await message.answer_document(
-                    BufferedInputFile(
-                        converted_content,
-                        filename=f"converted_{message.document.file_name}",
+                    await cache.put(cache_key, converted_content, summary)
+                logger.info("TCX conversion completed successfully.")
+
+                # Send back the converted file
+                await message.answer(
+                    "Conversion was successful! Trying to upload to Garmin Connect....\n\n"
+                    f"📅 Activity Date & Time: {summary['activity_datetime']}\n"
+                    f"⏱ Total Time: {summary['total_time']}\n"
+                    f"🛣 Total Distance: {summary['total_distance_km']} km"
+                    + summary_details(summary)
+                )
+                # The upload queue reports the result when it is done
+                await upload_queue.enqueue(
+                    message.from_user.id,
+                    message.chat.id,
+                    output_file_name(
+                        message.document.file_name, output_format
                     ),
-                    caption="Something is wrong with uploading. Here is your converted TCX file.",
+                    converted_content,
+                    key,
+                    kind="tcx",
                 )
 
-        except Exception as e:
-            logger.error(f"Error during conversion: {e}")
+            except ConversionBusyError:
+                FAILURES.inc(kind="tcx", type="busy")
+                await message.answer(BUSY_MESSAGE)
+            except Exception as e:
+                logger.error(f"Error during conversion: {e}")
+                FAILURES.inc(kind="tcx", type="conversion")
+                await message.answer(
+                    "An error occurred while converting the file. Please try again or another file."
+                )
+        else:
+            FAILURES.inc(kind="tcx", type="invalid")
             await message.answer(
-                "An error occurred while converting the file. Please try again or another file."
+                "The file you sent does not appear to be a valid TCX file."
+            )
+            logger.info(
+                f"Invalid TCX file received from user {message.from_user.id}."
             )
-    else:
-        await message.answer(
-            "The file you sent does not appear to be a valid TCX file."
-        )
-        logger.info(
-            f"Invalid TCX file received from user {message.from_user.id}."
-        )
 
 
 @dp.message(F.document.file_name.endswith(".fit"))  # For .fit files
@@ -218,165 +487,389 @@ async def handle_fit_file(
         f"Received file: {message.document.file_name}, MIME-type: {message.document.mime_type} "
         f"from user {message.from_user.full_name}, ID={message.from_user.id}"
     )
+    FILES.inc(kind="fit")
+    FILE_BYTES.inc(message.document.file_size or 0, kind="fit")
     if message.document.file_size > 50 * 1024 * 1024:  # 50 MB
+        FAILURES.inc(kind="fit", type="too_large")
         await message.answer(
             "The file is too large. Please send a smaller file."
         )
         return
 
-    data = await state.get_data()
-    g_client = data.get("g_client")
+    g_client = await check_auth(message, bot, state)
     if not g_client:
-        g_client = await check_auth(message, bot, state)
-        if not g_client:
-            return
+        return
 
-    # Get file details
-    file_id = message.document.file_id
-    file = await bot.get_file(file_id)
-    file_path = file.file_path
+    # FIT files are uploaded as is, so the whole file is read into memory
+    file_size = message.document.file_size
+    reservation = await reserve_memory(
+        message,
+        "fit",
+        estimate_footprint(
+            file_size, None, on_disk=file_size > SPOOL_THRESHOLD
+        ),
+    )
+    if reservation is None:
+        return
 
-    # Download the file into memory
-    downloaded_file = await bot.download_file(file_path)
-    file_content = downloaded_file.read()
+    # Download the file into memory (or a temp file if it is large)
+    with reservation, await download_document(
+        bot, message.document
+    ) as download:
+        with STAGE_SECONDS.time(stage="validation"):
+            valid = looks_like_fit(download.head())
+            if valid:
+                key = await asyncio.to_thread(content_hash, download.open())
+        if not valid:
+            FAILURES.inc(kind="fit", type="invalid")
+            await message.answer(
+                "The file you sent does not appear to be a valid FIT file."
+            )
+            logger.info(
+                f"Invalid FIT file received from user {message.from_user.id}."
+            )
+            return
 
-    try:
-        # Process the FIT file
-        app_fit = FitFile.from_bytes(file_content)
-        summary = {}
-        for record in app_fit.records:
-            m = record.message
-            if isinstance(m, SessionMessage):
-                summary["activity_datetime"] = datetime.fromtimestamp(
-                    m.start_time / 1000
-                ).strftime("%d %b @ %H:%M UTC")
-                total_seconds_rounded = round(m.total_timer_time)
-                summary["total_time"] = str(
-                    timedelta(seconds=total_seconds_rounded)
+        if await cache.is_uploaded(message.from_user.id, key):
+            await message.answer(ALREADY_UPLOADED_MESSAGE)
+            return
+        try:
+            # Process the FIT file
+            cached = await cache.get(key)
+            if cached:
+                summary = cached[1]
+            else:
+                summary = await converter.fit_summary(
+                    download.source(), message.from_user.id
                 )
-                distance_km = float(m.total_distance) / 1000
-                summary["total_distance_km"] = f"{distance_km:.2f}"
-                break
+                await cache.put(key, None, summary)
 
-        logger.info("FIT processing completed successfully.")
+            logger.info("FIT processing completed successfully.")
 
-        await message.answer(
-            "Trying to upload to Garmin Connect....\n\n"
-            f"📅 Activity Date & Time: {summary['activity_datetime']}\n"
-            f"⏱ Total Time: {summary['total_time']}\n"
-            f"🛣 Total Distance: {summary['total_distance_km']} km"
+            await message.answer(
+                "Trying to upload to Garmin Connect....\n\n"
+                f"📅 Activity Date & Time: {summary['activity_datetime']}\n"
+                f"⏱ Total Time: {summary['total_time']}\n"
+                f"🛣 Total Distance: {summary['total_distance_km']} km"
+            )
+            # FIT files are uploaded as is; the queue reports the result
+            content = await asyncio.to_thread(download.open().read)
+            await upload_queue.enqueue(
+                message.from_user.id,
+                message.chat.id,
+                download.name,
+                content,
+                key,
+                kind="fit",
+            )
+
+        except ConversionBusyError:
+            FAILURES.inc(kind="fit", type="busy")
+            await message.answer(BUSY_MESSAGE)
+        except Exception as e:
+            logger.error(f"Error during processing FIT-file: {e}")
+            FAILURES.inc(kind="fit", type="conversion")
+            await message.answer(
+                "An error occurred while processing the FIT-file. Please try again or another file."
+            )
+
+
+# Status of ZIP entries in the progress message and the final summary
+BATCH_STATUSES = {
+    "uploaded": "Uploaded",
+    "not_uploaded": "Not uploaded",
+    "queued": "Upload will be retried",
+    "already_uploaded": "Already uploaded before",
+    "failed": "Failed to convert",
+}
+# Columns of the summary.csv sent back with the converted files
+BATCH_SUMMARY_FIELDS = [
+    "name",
+    "status",
+    "activity_datetime",
+    "total_time",
+    "total_distance_km",
+    "file",
+    "error",
+]
+# Problem entries listed in the final message; summary.csv has all of them
+BATCH_PROBLEMS_SHOWN = 10
+
+
+class ChatBatchReporter(BatchReporter):
+    """
+    Reports the progress of a ZIP batch in a single message, edited at most
+    every PROGRESS_INTERVAL seconds, and sends back the converted files as
+    one ZIP archive with a summary.csv, built on disk as they come in.
+    So a batch costs a few Telegram requests however many entries it has.
+    """
+
+    PROGRESS_INTERVAL = 3
+    # Telegram bots may send files up to 50 MB
+    ARCHIVE_LIMIT = 40 * 1024 * 1024
+
+    def __init__(self, message: Message, output_format: str = "tcx"):
+        self.message = message
+        self.output_format = output_format
+        self.archive = ResultArchive(
+            output_file_name(message.document.file_name), self.ARCHIVE_LIMIT
+        )
+        self.total = 0
+        self.rows: Dict[str, dict] = {}
+        self.left_out = 0  # Converted files that didn't fit into the archive
+        self._progress: Optional[Message] = None
+        self._text = None
+        self._edited_at = 0.0
+        self._pending: Optional[asyncio.Task] = None
+
+    def _counts(self) -> Dict[str, int]:
+        counts = dict.fromkeys(BATCH_STATUSES, 0)
+        for row in self.rows.values():
+            if row["status"] in counts:
+                counts[row["status"]] += 1
+        return counts
+
+    def _progress_text(self) -> str:
+        counts = self._counts()
+        lines = [
+            f"Processing {self.total} TCX files: {sum(counts.values())} done."
+        ]
+        lines += [
+            f"{label}: {counts[status]}"
+            for status, label in BATCH_STATUSES.items()
+            if counts[status]
+        ]
+        return "\n".join(lines)
+
+    def _summary_text(self, report: BatchReport) -> str:
+        counts = self._counts()
+        table = "\n".join(
+            f"{label:<24}{counts[status]:>6}"
+            for status, label in BATCH_STATUSES.items()
         )
+        lines = [
+            f"Done! Processed {report.total} TCX files "
+            f"in {report.elapsed:.1f} s.",
+            f"<pre>{table}</pre>",
+        ]
+        problems = [
+            row
+            for row in self.rows.values()
+            if row["status"] in ("failed", "not_uploaded")
+        ]
+        for row in problems[:BATCH_PROBLEMS_SHOWN]:
+            reason = row.get("error") or BATCH_STATUSES[row["status"]]
+            lines.append(f"• {escape(row['name'])}: {escape(reason)}")
+        if len(problems) > BATCH_PROBLEMS_SHOWN:
+            lines.append(
+                f"…and {len(problems) - BATCH_PROBLEMS_SHOWN} more, "
+                "see summary.csv."
+            )
+        return "\n".join(lines)
+
+    async def _edit(self, text: str) -> None:
+        self._edited_at = time.monotonic()
+        if text == self._text:
+            return
+        self._text = text
         try:
-            file_content_io = io.BytesIO(file_content)
-            file_content_io.name = message.document.file_name
-            uploaded = g_client.upload(file_content_io)
+            await self._progress.edit_text(text)
+        except TelegramAPIError as e:
+            # Progress is best effort, the final summary follows anyway
+            logger.info(f"Could not update the progress message: {e}")
+
+    async def _edit_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._pending = None
+        await self._edit(self._progress_text())
+
+    def _update(self, name: str, status: str, **fields) -> None:
+        row = self.rows.setdefault(name, {"name": name})
+        row.update(fields, status=status)
+        # Changes are collected and shown with the next throttled edit
+        if self._pending is None and self._progress is not None:
+            delay = self._edited_at + self.PROGRESS_INTERVAL - time.monotonic()
+            self._pending = asyncio.create_task(
+                self._edit_later(max(0.0, delay))
+            )
 
-            if uploaded:
-                await message.answer(
-                    "File uploaded successfully to Garmin Connect!"
-                )
-        except garth.exc.GarthHTTPError as e:
-            await message.answer("Something is wrong with uploading")
+    async def started(self, total: int) -> None:
+        self.total = total
+        self._text = self._progress_text()
+        self._progress = await self.message.answer(self._text)
+        self._edited_at = time.monotonic()
+
+    async def converted(
+        self, name: str, summary: dict, converted_content: bytes
+    ) -> None:
+        file_name = result_entry_name(name, self.output_format)
+        if not await self.archive.add(file_name, converted_content):
+            self.left_out += 1
+            file_name = ""
+        self._update(name, "converted", file=file_name, **summary)
+
+    async def uploaded(self, name: str) -> None:
+        self._update(name, "uploaded")
+
+    async def upload_failed(self, name: str, converted_content: bytes) -> None:
+        # The converted file is in the archive already
+        self._update(name, "not_uploaded")
+
+    async def queued(self, name: str) -> None:
+        self._update(name, "queued")
+
+    async def already_uploaded(self, name: str) -> None:
+        self._update(name, "already_uploaded")
+
+    async def failed(self, name: str, error: Exception) -> None:
+        if isinstance(error, JobTooLargeError):
+            reason = TOO_LARGE_NOW_MESSAGE
+        elif isinstance(error, MemoryBudgetTimeout):
+            reason = BUSY_MESSAGE
+        else:
+            reason = str(error) or type(error).__name__
+        self._update(name, "failed", error=reason)
+
+    async def finish(self, report: BatchReport) -> None:
+        """
+        Turn the progress message into the final summary and send the
+        converted files with the summary.csv.
+        """
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        await self.archive.close(self.rows.values(), BATCH_SUMMARY_FIELDS)
+        text = self._summary_text(report)
+        if self._progress is not None:
+            await self._edit(text)
+        else:
+            await self.message.answer(text)
+        if not self.rows:
+            return
+        caption = (
+            f"Converted files of {escape(self.message.document.file_name)}"
+        )
+        if self.left_out:
+            caption += (
+                f"\n{self.left_out} converted files didn't fit into the "
+                "archive, see summary.csv."
+            )
+        await self.message.answer_document(
+            FSInputFile(self.archive.path), caption=caption
+        )
 
-    except Exception as e:
-        logger.error(f"Error during processing FIT-file: {e}")
-        await message.answer(
-            "An error occurred while processing the FIT-file. Please try again or another file."
+    def close(self) -> None:
+        if self._pending is not None:
+            self._pending.cancel()
+        self.archive.cleanup()
+
+
+class ChatUploadNotifier(UploadNotifier):
+    """
+    Tells users the final result of their queued uploads.
+    """
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+
+    async def uploaded(self, job: UploadJob) -> None:
+        await self.bot.send_message(
+            job.chat_id,
+            f"{job.file_name}: file uploaded successfully to Garmin Connect!",
         )
 
+    async def already_uploaded(self, job: UploadJob) -> None:
+        await self.bot.send_message(
+            job.chat_id, f"{job.file_name}: {ALREADY_UPLOADED_MESSAGE}"
+        )
+
+    async def failed(self, job: UploadJob, error: Exception) -> None:
+        FAILURES.inc(kind=job.kind, type="upload")
+        if job.kind == "tcx":
+            # Converted TCX files may have been encoded as FIT
+            output_format = job.file_name.rsplit(".", 1)[-1].upper()
+            await self.bot.send_document(
+                job.chat_id,
+                BufferedInputFile(job.content, filename=job.file_name),
+                caption="Something is wrong with uploading. "
+                f"Here is your converted {output_format} file.",
+            )
+        else:
+            await self.bot.send_message(
+                job.chat_id,
+                f"{job.file_name}: something is wrong with uploading",
+            )
+
 
 @dp.message(F.document.file_name.endswith(".zip"))
 async def handle_zip_file(
     message: Message, bot: Bot, state: FSMContext
 ) -> None:
     """
-    This handler processes ZIP files, extracts TCX files, and sends them back.
+    This handler processes ZIP files, converts and uploads their TCX files and
+    sends the converted files back in a single ZIP archive.
     """
     logger.info(
         f"Received file: {message.document.file_name}, MIME-type: {message.document.mime_type} "
         f"from user {message.from_user.full_name}, ID={message.from_user.id}"
     )
+    FILES.inc(kind="zip")
+    FILE_BYTES.inc(message.document.file_size or 0, kind="zip")
     if message.document.file_size > 50 * 1024 * 1024:  # 50 MB
+        FAILURES.inc(kind="zip", type="too_large")
         await message.answer(
             "The file is too large. Please send a smaller file."
         )
         return
 
-    data = await state.get_data()
-    g_client = data.get("g_client")
+    g_client = await check_auth(message, bot, state)
     if not g_client:
-        g_client = await check_auth(message, bot, state)
-        if not g_client:
-            return
-
-    # Get file details
-    file_id = message.document.file_id
-    file = await bot.get_file(file_id)
-    file_path = file.file_path
+        return
 
-    # Download the ZIP file into memory
-    downloaded_file = await bot.download_file(file_path)
-    file_content = downloaded_file.read()
+    output_format = await get_output_format(state)
+    # Entries reserve their own memory in the pipeline; the archive itself
+    # only counts while it is kept in memory
+    file_size = message.document.file_size
+    reservation = await reserve_memory(
+        message, "zip", file_size if file_size <= SPOOL_THRESHOLD else 0
+    )
+    if reservation is None:
+        return
 
-    # Work with the ZIP file in memory
+    reporter = ChatBatchReporter(message, output_format)
     try:
-        with zipfile.ZipFile(io.BytesIO(file_content), "r") as zip_ref:
-            for file_name in zip_ref.namelist():
-                if file_name.endswith(".tcx"):
-                    with zip_ref.open(file_name) as tcx_file:
-                        tcx_content = tcx_file.read()
-                        try:
-                            # Convert the TCX file (in memory)
-                            converted_content, summary = convert_tcx_in_memory(
-                                tcx_content
-                            )
-
-                            # Send back the converted file
-                            await message.answer(
-                                "Conversion was successful! Trying to upload to Garmin Connect....\n\n"
-                                f"📅 Activity Date & Time: {summary['activity_datetime']}\n"
-                                f"⏱ Total Time: {summary['total_time']}\n"
-                                f"🛣 Total Distance: {summary['total_distance_km']} km"
-                            )
-                            try:
-                                converted_content_io = io.BytesIO(
-                                    converted_content
-                                )
-                                converted_content_io.name = (
-                                    f"converted_{file_name}"
-                                )
-                                uploaded = g_client.upload(converted_content_io)
-
-                                if uploaded:
-                                    await message.answer(
-                                        "File uploaded successfully to Garmin Connect!"
-                                    )
-                            except garth.exc.GarthHTTPError as e:
-                                await message.answer_document(
-                                    BufferedInputFile(
-                                        converted_content,
-                                        filename=f"converted_{file_name}",
-                                    ),
-                                    caption="Something is wrong with uploading. Here is your converted TCX file.",
-                                )
-
-                        except Exception as e:
-                            logger.error(
-                                f"Error during conversion of {tcx_file}: {e}"
-                            )
-                            await message.answer(
-                                f"An error occurred while converting the file {tcx_file}. Please try again."
-                            )
+        # Download the ZIP file into memory (or a temp file if it is large);
+        # large archives are read from disk by the conversion workers
+        with reservation, await download_document(
+            bot, message.document
+        ) as download, zipfile.ZipFile(download.open(), "r") as zip_ref:
+            report = await zip_pipeline.run(
+                zip_ref,
+                g_client,
+                reporter,
+                zip_path=download.path,
+                user_id=message.from_user.id,
+                chat_id=message.chat.id,
+                output_format=output_format,
+            )
+        FILES.inc(report.total, kind="zip_entry")
+        FAILURES.inc(report.failed, kind="zip_entry", type="conversion")
+        FAILURES.inc(report.upload_failed, kind="zip_entry", type="upload")
+        await reporter.finish(report)
 
     except zipfile.BadZipFile:
+        FAILURES.inc(kind="zip", type="invalid")
         await message.answer(
             "The file you sent is not a valid ZIP file. Please send a valid ZIP archive."
         )
     except Exception as e:
         logger.error(f"Error processing ZIP file: {e}")
+        FAILURES.inc(kind="zip", type="unexpected")
         await message.answer(
             "An unexpected error occurred while processing the ZIP file. Please try again."
         )
+    finally:
+        reporter.close()
 
 
 @dp.message()
@@ -401,11 +894,45 @@ async def main() -> None:
     bot = Bot(
         TOKEN_API, default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
+    bot.session.middleware(TelegramRequestMetrics())
+    bot.session.middleware(FairTelegramRequests(telegram_scheduler))
+    # Fork the conversion workers before any other threads are started
+    converter.start()
+    if isinstance(token_store, SQLiteTokenStore):
+        # Tokens saved in the keyring by earlier versions are moved once
+        await token_store.migrate(KeyringTokenStore())
+    garmin_clients.start()
+    upload_queue.start(ChatUploadNotifier(bot))
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
     try:
-        # Start polling for updates
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await run_webhook(
+                dp,
+                bot,
+                WEBHOOK_SECRET,
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                path=WEBHOOK_PATH,
+                url=WEBHOOK_URL,
+                drain_timeout=SHUTDOWN_TIMEOUT,
+            )
+        else:
+            # Start polling for updates
+            await dp.start_polling(bot)
     finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await upload_queue.close()
         await bot.session.close()
+        await garmin_clients.close()
+        await token_store.close()
+        if redis is not None:
+            await redis.aclose()
+        uploader.shutdown()
+        converter.shutdown()
+        await cache.close()
 
 
 if __name__ == "__main__":
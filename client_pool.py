@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import garth
+
+from garmin_uploader import GarminUploader
+from token_store import KeyringTokenStore, TokenStore
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    def __init__(self, client: garth.Client, auth: str):
+        self.client = client
+        self.auth = auth  # Tokens as last saved to the token store
+        self.last_used = time.monotonic()
+
+
+class GarminClientPool:
+    """
+    In-process cache of authorized garth clients keyed by Telegram user ID.
+    Clients are rebuilt from the token store on a miss, evicted after being
+    idle for idle_ttl seconds or when the pool is full, and their OAuth2
+    tokens are refreshed in the background shortly before they expire.
+    The token store is only written when the tokens actually change.
+    If the token store is shared by several bot processes (Redis, SQLite),
+    the refresher drops clients whose tokens were deleted by another
+    process (e.g. on /stop) and reloads the ones it changed, so a pool is
+    at most refresh_interval seconds behind the others. With a local store
+    such as the keyring the pool is the only writer, and nothing is re-read.
+    """
+
+    def __init__(
+        self,
+        uploader: GarminUploader,
+        max_size: int = 1000,
+        idle_ttl: float = 3600,
+        refresh_margin: float = 300,
+        refresh_interval: float = 60,
+        token_store: TokenStore = None,
+    ):
+        """
+        :param uploader: runs blocking token refreshes off the event loop.
+        :param max_size: maximum number of cached clients.
+        :param idle_ttl: seconds after which an unused client is evicted.
+        :param refresh_margin: refresh OAuth2 tokens that expire within this many seconds.
+        :param refresh_interval: how often the background refresher runs.
+        :param token_store: where tokens are kept (default: the keyring).
+        """
+        self.uploader = uploader
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.refresh_margin = refresh_margin
+        self.refresh_interval = refresh_interval
+        self.token_store = token_store or KeyringTokenStore()
+        self._clients = OrderedDict()
+        self._refresher = None
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    async def _save(self, user_id: int, entry: _Entry) -> None:
+        # Tokens may have been refreshed during a request; persist only changes
+        auth = entry.client.dumps()
+        if auth != entry.auth:
+            await self.token_store.put(user_id, auth)
+            entry.auth = auth
+
+    async def _evict(self) -> None:
+        now = time.monotonic()
+        while self._clients:
+            user_id, entry = next(iter(self._clients.items()))
+            if (
+                len(self._clients) <= self.max_size
+                and now - entry.last_used <= self.idle_ttl
+            ):
+                break
+            del self._clients[user_id]
+            await self._save(user_id, entry)
+
+    async def get(self, user_id: int) -> Optional[garth.Client]:
+        """
+        :return: the user's authorized garth client, or None if the user is not logged in.
+        """
+        entry = self._clients.get(user_id)
+        if entry is None:
+            auth = await self.token_store.get(user_id)
+            if not auth:
+                return None
+            # Another handler may have loaded the client in the meantime
+            entry = self._clients.get(user_id)
+            if entry is None:
+                client = garth.Client()
+                client.loads(auth)
+                entry = _Entry(client, auth)
+                self._clients[user_id] = entry
+        entry.last_used = time.monotonic()
+        self._clients.move_to_end(user_id)
+        await self._evict()
+        return entry.client
+
+    async def put(self, user_id: int, client: garth.Client) -> None:
+        """
+        Cache a freshly logged in client and save its tokens to the token store.
+        """
+        entry = _Entry(client, None)
+        self._clients[user_id] = entry
+        self._clients.move_to_end(user_id)
+        await self._save(user_id, entry)
+        await self._evict()
+
+    async def delete(self, user_id: int) -> None:
+        """
+        Forget the user's client and remove its tokens from the token store.
+        """
+        self._clients.pop(user_id, None)
+        await self.token_store.delete(user_id)
+
+    async def _reload(self, user_id: int, entry: _Entry) -> bool:
+        """
+        Pick up changes other processes made to the user's tokens.
+        :return: False if the tokens were deleted and the client is dropped.
+        """
+        auth = await self.token_store.get(user_id)
+        if not auth:
+            if self._clients.get(user_id) is entry:
+                del self._clients[user_id]
+            return False
+        if entry.auth is not None and auth != entry.auth:
+            entry.client.loads(auth)
+            entry.auth = auth
+        return True
+
+    async def refresh(self) -> None:
+        """
+        Drop or reload clients whose tokens other processes deleted or
+        changed in a shared token store, refresh tokens that are about to
+        expire, save changed tokens and evict idle clients.
+        """
+        deadline = time.time() + self.refresh_margin
+        for user_id, entry in list(self._clients.items()):
+            try:
+                if self.token_store.shared and not await self._reload(
+                    user_id, entry
+                ):
+                    continue
+                token = entry.client.oauth2_token
+                if token is not None and token.expires_at < deadline:
+                    await self.uploader.run(entry.client.refresh_oauth2)
+                await self._save(user_id, entry)
+            except Exception as e:
+                logger.error(f"Error refreshing tokens of user {user_id}: {e}")
+        await self._evict()
+
+    async def _refresh_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+    def start(self) -> None:
+        """
+        Start the background token refresher.
+        """
+        self._refresher = asyncio.create_task(self._refresh_forever())
+
+    async def close(self) -> None:
+        """
+        Stop the refresher and save tokens that changed since the last save.
+        """
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+        for user_id, entry in list(self._clients.items()):
+            await self._save(user_id, entry)
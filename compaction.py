@@ -0,0 +1,243 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+# Trackpoint values the rules look at, in this order
+CHANNELS = ("distance", "heart_rate", "cadence", "speed", "power")
+
+# Values closer than this are equal; TCX values are printed rounded anyway
+_EPSILON = 1e-6
+
+
+class Point(NamedTuple):
+    """
+    A trackpoint as seen by the compactor. The payload is what the converter
+    writes for the point, e.g. serialized XML.
+    """
+
+    time: Optional[float]  # Seconds since the epoch
+    values: Tuple[Optional[float], ...]  # One per channel
+    payload: Any
+
+
+@dataclass
+class CompactionRules:
+    """
+    Which trackpoints may be dropped. Within a lap, the first and the last
+    trackpoint are always kept.
+    """
+
+    # Drop trackpoints whose values repeat the ones before and after them,
+    # e.g. while the rider pauses
+    drop_duplicates: bool = True
+    # Drop trackpoints that linear interpolation between the kept ones
+    # reproduces within this tolerance, by channel. Channels without a
+    # tolerance are not compared, they only have to be present or missing
+    # alike, so their values at dropped points are lost
+    tolerances: Dict[str, float] = field(default_factory=dict)
+    # Keep at most one trackpoint per this many seconds
+    min_interval: float = 0
+    # Keep at least one trackpoint per this many seconds
+    max_gap: float = 60
+
+    @classmethod
+    def parse(cls, spec: Optional[str]) -> Optional["CompactionRules"]:
+        """
+        Parse rules like "duplicates,power=5,speed=0.1,min_interval=2".
+        Any channel of CHANNELS can get a tolerance.
+        :return: the rules, or None if spec is empty or "off".
+        :raise ValueError: on an unknown rule.
+        """
+        if not spec or spec.strip().lower() in ("off", "none", "0"):
+            return None
+        rules = cls(drop_duplicates=False)
+        for item in spec.split(","):
+            name, _, value = item.strip().partition("=")
+            name = name.strip().lower()
+            if name == "duplicates" and not value:
+                rules.drop_duplicates = True
+            elif name in CHANNELS and value:
+                rules.tolerances[name] = float(value)
+            elif name in ("min_interval", "max_gap") and value:
+                setattr(rules, name, float(value))
+            else:
+                raise ValueError(f"Unknown compaction rule: {item.strip()}")
+        return rules
+
+    def spec(self) -> str:
+        """
+        :return: the rules in the form parse() reads, e.g. for cache keys.
+        """
+        items = ["duplicates"] if self.drop_duplicates else []
+        items += [
+            f"{channel}={self.tolerances[channel]:g}"
+            for channel in CHANNELS
+            if channel in self.tolerances
+        ]
+        items.append(f"min_interval={self.min_interval:g}")
+        items.append(f"max_gap={self.max_gap:g}")
+        return ",".join(items)
+
+
+class _IntervalFilter:
+    """
+    Keeps at most one point per min_interval seconds, and the last point.
+    """
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self.last_kept = None
+        self.held = None  # Dropped for now, kept if it turns out to be last
+        self.removed = 0
+
+    def add(self, point: Point) -> List[Point]:
+        if (
+            self.last_kept is not None
+            and point.time is not None
+            and point.time - self.last_kept < self.min_interval
+        ):
+            if self.held is not None:
+                self.removed += 1
+            self.held = point
+            return []
+        if self.held is not None:
+            self.removed += 1
+        self.held = None
+        self.last_kept = point.time
+        return [point]
+
+    def finish(self) -> List[Point]:
+        held, self.held, self.last_kept = self.held, None, None
+        return [held] if held is not None else []
+
+
+class _Simplifier:
+    """
+    Opening window simplification: points after the last kept one are held
+    while the segment from the kept point to the newest one reproduces them;
+    when it doesn't, the newest held point is kept and starts a new segment.
+    """
+
+    def __init__(self, rules: CompactionRules):
+        self.drop_duplicates = rules.drop_duplicates
+        self.tolerances = tuple(
+            (
+                rules.tolerances[channel] + _EPSILON
+                if channel in rules.tolerances
+                else None
+            )
+            for channel in CHANNELS
+        )
+        self.use_tolerances = bool(rules.tolerances)
+        self.max_gap = rules.max_gap
+        self.anchor = None
+        self.held: List[Point] = []
+        self.removed = 0
+
+    def _reproduces(self, end: Point) -> bool:
+        anchor = self.anchor
+        if end.time - anchor.time > self.max_gap:
+            return False
+        if self.drop_duplicates and end.values == anchor.values:
+            if all(point.values == anchor.values for point in self.held):
+                return True
+        if not self.use_tolerances:
+            return False
+        span = end.time - anchor.time
+        for point in self.held:
+            share = (point.time - anchor.time) / span if span else 0.0
+            for start, value, stop, tolerance in zip(
+                anchor.values, point.values, end.values, self.tolerances
+            ):
+                if start is None or value is None or stop is None:
+                    if (
+                        start is not None
+                        or value is not None
+                        or stop is not None
+                    ):
+                        return False
+                elif (
+                    tolerance is not None
+                    and abs(start + (stop - start) * share - value) > tolerance
+                ):
+                    return False
+        return True
+
+    def _keep_held(self) -> List[Point]:
+        if not self.held:
+            return []
+        last = self.held.pop()
+        self.removed += len(self.held)
+        self.held = []
+        self.anchor = last
+        return [last]
+
+    def add(self, point: Point) -> List[Point]:
+        if point.time is None:
+            # Nothing to interpolate with; keep it and start over
+            kept = self._keep_held()
+            self.anchor = None
+            return kept + [point]
+        if self.anchor is None:
+            self.anchor = point
+            return [point]
+        kept = [] if self._reproduces(point) else self._keep_held()
+        # The newest point is the tentative end of the segment
+        self.held.append(point)
+        return kept
+
+    def finish(self) -> List[Point]:
+        kept = self._keep_held()
+        self.anchor = None
+        return kept
+
+
+class Compactor:
+    """
+    Applies CompactionRules to the trackpoints of one lap after another.
+    Points are passed in order with add(); the kept ones come back, possibly
+    later, and finish_lap() returns the rest at the end of every lap.
+    """
+
+    def __init__(self, rules: CompactionRules):
+        self._interval = (
+            _IntervalFilter(rules.min_interval) if rules.min_interval else None
+        )
+        self._simplifier = _Simplifier(rules)
+        self.total = 0
+
+    @property
+    def removed(self) -> int:
+        """
+        :return: number of trackpoints dropped so far.
+        """
+        removed = self._simplifier.removed
+        if self._interval is not None:
+            removed += self._interval.removed
+        return removed
+
+    def add(self, point: Point) -> List[Any]:
+        """
+        :return: payloads of the points to write now.
+        """
+        self.total += 1
+        points = [point]
+        if self._interval is not None:
+            points = self._interval.add(point)
+        kept = []
+        for point in points:
+            kept.extend(self._simplifier.add(point))
+        return [point.payload for point in kept]
+
+    def finish_lap(self) -> List[Any]:
+        """
+        :return: payloads of the points still held back.
+        """
+        kept = []
+        if self._interval is not None:
+            for point in self._interval.finish():
+                kept.extend(self._simplifier.add(point))
+        kept.extend(self._simplifier.finish())
+        return [point.payload for point in kept]
+
+    def summary(self) -> Dict[str, int]:
+        return {"trackpoints": self.total, "trackpoints_removed": self.removed}
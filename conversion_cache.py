@@ -0,0 +1,228 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def content_hash(source: Union[bytes, BinaryIO]) -> str:
+    """
+    SHA-256 of the input data, used as the cache key.
+    :param source: data as bytes, or a binary file-like object (read from the start).
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(source).hexdigest()
+    source.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: source.read(_HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConversionCache:
+    """
+    Content-addressed cache of conversion results, plus a per-user record of
+    inputs that were already uploaded to Garmin Connect.
+    Results are kept in memory with LRU eviction bounded by total size and,
+    if a database path is given, persisted to SQLite. The database is only
+    used from a dedicated thread, so large results don't stall the event loop.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        db_path: str = None,
+        db_max_bytes: int = 1024 * 1024 * 1024,
+    ):
+        """
+        :param max_bytes: size limit of the in-memory cache.
+        :param db_path: SQLite database for persistent storage, None to keep
+            everything in memory only.
+        :param db_max_bytes: size limit of the results stored in SQLite.
+        """
+        self.max_bytes = max_bytes
+        self.db_max_bytes = db_max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._uploads = set()
+        self._db = None
+        if db_path:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="conversion_cache"
+            )
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS conversions (
+                    hash TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    content BLOB,
+                    size INTEGER NOT NULL,
+                    accessed REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS uploads (
+                    user_id INTEGER NOT NULL,
+                    hash TEXT NOT NULL,
+                    uploaded_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, hash)
+                );
+                """)
+            self._db.commit()
+
+    def _remember(
+        self, key: str, converted: Optional[bytes], summary: Dict
+    ) -> None:
+        size = len(converted) if converted else 0
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[0]) if old[0] else 0
+        if size > self.max_bytes:
+            # Too large to keep in memory; the old entry is stale anyway
+            return
+        self._entries[key] = (converted, summary)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.size -= len(evicted) if evicted else 0
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _load(self, key: str) -> Optional[Tuple[Optional[bytes], str]]:
+        row = self._db.execute(
+            "SELECT content, summary FROM conversions WHERE hash = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._db.execute(
+            "UPDATE conversions SET accessed = ? WHERE hash = ?",
+            (time.time(), key),
+        )
+        self._db.commit()
+        return row
+
+    async def get(self, key: str) -> Optional[Tuple[Optional[bytes], Dict]]:
+        """
+        :return: cached (converted data, summary), or None on a miss.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        if self._db is None:
+            return None
+        row = await self._run(self._load, key)
+        if row is None:
+            return None
+        converted, summary = row[0], json.loads(row[1])
+        self._remember(key, converted, summary)
+        return converted, summary
+
+    def _store(
+        self, key: str, converted: Optional[bytes], summary: str
+    ) -> None:
+        size = len(converted) if converted else 0
+        self._db.execute(
+            "INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?)",
+            (key, summary, converted, size, time.time()),
+        )
+        self._evict_db()
+        self._db.commit()
+
+    async def put(
+        self, key: str, converted: Optional[bytes], summary: Dict
+    ) -> None:
+        """
+        Store a conversion result.
+        :param converted: converted data, or None if only the summary is cached
+            (e.g. for FIT files, which are uploaded as is).
+        """
+        self._remember(key, converted, summary)
+        if self._db is None:
+            return
+        await self._run(self._store, key, converted, json.dumps(summary))
+
+    def _evict_db(self) -> None:
+        (total,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM conversions"
+        ).fetchone()
+        if total <= self.db_max_bytes:
+            return
+        # Drop the least recently used results until we are under the limit
+        rows = self._db.execute(
+            "SELECT hash, size FROM conversions ORDER BY accessed"
+        ).fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= self.db_max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM conversions WHERE hash = ?", stale)
+
+    def _load_upload(self, user_id: int, key: str) -> bool:
+        row = self._db.execute(
+            "SELECT 1 FROM uploads WHERE user_id = ? AND hash = ?",
+            (user_id, key),
+        ).fetchone()
+        return row is not None
+
+    async def is_uploaded(self, user_id: int, key: str) -> bool:
+        """
+        Check whether the user already uploaded this input to Garmin Connect.
+        """
+        if (user_id, key) in self._uploads:
+            return True
+        if self._db is None:
+            return False
+        uploaded = await self._run(self._load_upload, user_id, key)
+        if uploaded:
+            self._uploads.add((user_id, key))
+        return uploaded
+
+    def _store_upload(self, user_id: int, key: str) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)",
+            (user_id, key, time.time()),
+        )
+        self._db.commit()
+
+    async def mark_uploaded(self, user_id: int, key: str) -> None:
+        self._uploads.add((user_id, key))
+        if self._db is not None:
+            await self._run(self._store_upload, user_id, key)
+
+    def _delete_uploads(self, user_id: int) -> None:
+        self._db.execute("DELETE FROM uploads WHERE user_id = ?", (user_id,))
+        self._db.commit()
+
+    async def forget_user(self, user_id: int) -> None:
+        """
+        Forget the upload history of a user (e.g. after /stop).
+        """
+        self._uploads = {item for item in self._uploads if item[0] != user_id}
+        if self._db is not None:
+            await self._run(self._delete_uploads, user_id)
+
+    async def close(self) -> None:
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._executor.shutdown()
+            self._db = None
+
+
+def is_duplicate_upload(error: Exception) -> bool:
+    """
+    Check whether a garth upload error means the activity already exists.
+    """
+    response = getattr(getattr(error, "error", None), "response", None)
+    return getattr(response, "status_code", None) == 409
@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import ByteString, Dict, Tuple, Union
+
+from compaction import CompactionRules
+from convert_all_tcx import CONVERTERS
+from fair_scheduler import FairScheduler
+from fit_summary import extract_fit_summary
+from metrics import CONVERSIONS_IN_FLIGHT, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionBusyError(Exception):
+    """
+    Raised when the conversion queue is full.
+    """
+
+
+def _warm_up() -> int:
+    # Runs in a worker: make sure the heavy imports are already paid for
+    import fit_tool.fit_file  # noqa: F401
+    import convert_all_tcx  # noqa: F401
+
+    return 0
+
+
+def _convert_tcx(
+    source: Union[str, ByteString],
+    output_format: str = "tcx",
+    compaction: CompactionRules = None,
+) -> Tuple[bytes, Dict]:
+    # Files on disk are streamed by the worker itself instead of being pickled
+    if not isinstance(source, str):
+        source = BytesIO(source)
+    output = BytesIO()
+    summary = CONVERTERS[output_format](source, output, compaction=compaction)
+    return output.getvalue(), summary
+
+
+def _convert_zip_member(
+    zip_path: str,
+    name: str,
+    output_format: str = "tcx",
+    compaction: CompactionRules = None,
+) -> Tuple[bytes, Dict]:
+    output = BytesIO()
+    with zipfile.ZipFile(zip_path) as zip_ref, zip_ref.open(name) as member:
+        summary = CONVERTERS[output_format](
+            member, output, compaction=compaction
+        )
+    return output.getvalue(), summary
+
+
+def _fit_summary(source: Union[str, ByteString]) -> Dict:
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            source = f.read()
+    return extract_fit_summary(source)
+
+
+class ConversionExecutor:
+    """
+    Runs CPU-bound TCX conversion and FIT parsing on a pool of worker processes,
+    so big files don't hold the GIL on the event loop thread. If a worker
+    dies (e.g. killed for running out of memory), the conversions running at
+    that moment fail and the pool is replaced for the following ones.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = None,
+        queue_size: int = 16,
+        per_user_limit: int = None,
+        compaction: CompactionRules = None,
+    ):
+        """
+        :param max_workers: number of worker processes (default: number of CPUs).
+        :param queue_size: how many jobs may wait for a free worker before
+            new jobs are rejected with ConversionBusyError.
+        :param per_user_limit: how many workers one user may occupy at once
+            (default: half of them); free workers are shared round-robin
+            between users.
+        :param compaction: trackpoint compaction rules applied to every
+            conversion (default: none).
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        self.scheduler = FairScheduler(
+            self.max_workers,
+            per_user_limit or max(1, self.max_workers // 2),
+            name="conversion",
+        )
+        self.queue_size = queue_size
+        self.compaction = compaction
+        self.in_flight = 0
+
+    def cache_key(self, content_key: str, output_format: str = "tcx") -> str:
+        """
+        :return: key of a conversion result in the ConversionCache; results
+            differ by output format and compaction rules.
+        """
+        key = f"{content_key}.{output_format}"
+        if self.compaction is not None:
+            key += f".{self.compaction.spec()}"
+        return key
+
+    def start(self) -> None:
+        """
+        Spawn and pre-warm all workers. Call it at startup, before the bot
+        starts other threads: on Linux the workers are forked from this process.
+        """
+        futures = [
+            self._executor.submit(_warm_up) for _ in range(self.max_workers)
+        ]
+        for future in futures:
+            future.result()
+        logger.info(f"Conversion pool started with {self.max_workers} workers")
+
+    def _replace_pool(self, broken: ProcessPoolExecutor) -> None:
+        if self._executor is not broken:
+            return  # Another failed job replaced it already
+        logger.error("A conversion worker died, restarting the pool")
+        broken.shutdown(wait=False, cancel_futures=True)
+        # The bot runs threads by now, which must not be forked
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+        for _ in range(self.max_workers):
+            self._executor.submit(_warm_up)
+
+    async def _run(self, func, *args, user_id: int = None):
+        if self.in_flight >= self.max_workers + self.queue_size:
+            raise ConversionBusyError("Conversion queue is full")
+        self.in_flight += 1
+        CONVERSIONS_IN_FLIGHT.set(self.in_flight)
+        try:
+            # Time spent waiting for a free worker is included
+            with STAGE_SECONDS.time(stage="conversion"):
+                async with self.scheduler.slot(user_id):
+                    loop = asyncio.get_running_loop()
+                    executor = self._executor
+                    try:
+                        return await loop.run_in_executor(
+                            executor, func, *args
+                        )
+                    except BrokenProcessPool:
+                        self._replace_pool(executor)
+                        raise
+        finally:
+            self.in_flight -= 1
+            CONVERSIONS_IN_FLIGHT.set(self.in_flight)
+
+    async def convert_tcx(
+        self,
+        source: Union[str, ByteString],
+        user_id: int = None,
+        output_format: str = "tcx",
+    ) -> Tuple[bytes, Dict]:
+        """
+        Convert TCX data in a worker process.
+        :param source: TCX data as bytes, or the path of a TCX file.
+        :param user_id: user the job is scheduled for.
+        :param output_format: "tcx" or "fit".
+        :return: Converted data as bytes and a dictionary with summary data.
+        """
+        return await self._run(
+            _convert_tcx,
+            source,
+            output_format,
+            self.compaction,
+            user_id=user_id,
+        )
+
+    async def convert_zip_member(
+        self,
+        zip_path: str,
+        name: str,
+        user_id: int = None,
+        output_format: str = "tcx",
+    ) -> Tuple[bytes, Dict]:
+        """
+        Convert a TCX entry of a ZIP archive on disk. The worker decompresses
+        the entry straight into the converter.
+        :return: Converted data as bytes and a dictionary with summary data.
+        """
+        return await self._run(
+            _convert_zip_member,
+            zip_path,
+            name,
+            output_format,
+            self.compaction,
+            user_id=user_id,
+        )
+
+    async def fit_summary(
+        self, source: Union[str, ByteString], user_id: int = None
+    ) -> Dict:
+        """
+        Extract summary data from FIT data in a worker process.
+        :param source: FIT data as bytes, or the path of a FIT file.
+        :param user_id: user the job is scheduled for.
+        """
+        return await self._run(_fit_summary, source, user_id=user_id)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=True)
@@ -1,174 +1,1208 @@
+"""
+TCX converter used by the bot. Run as a script to convert files in bulk:
+
+    python convert_all_tcx.py exports/ "old/**/*.tcx" archive.zip -o converted
+    python convert_all_tcx.py exports/ -o converted --format fit --manifest summary.csv
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
 import xml.etree.ElementTree as ET
+import zipfile
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
 from io import BytesIO
-from datetime import timedelta
-from typing import Dict, ByteString, Tuple
+from os import getenv
+from os.path import splitext
+from datetime import datetime, timedelta, timezone
+from typing import (
+    BinaryIO,
+    Collection,
+    Dict,
+    ByteString,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 from dateutil import parser
 
+from activity_model import ActivityColumns
+from compaction import CompactionRules, Compactor, Point
+from fit_encoder import (
+    INTENSITIES,
+    LAP_TRIGGERS,
+    SPORT_GENERIC,
+    SPORTS,
+    FitActivityEncoder,
+    fit_timestamp,
+)
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # lxml is optional, only needed for its backend
+    lxml_etree = None
+
 namespaces = {
     "ns2": "http://www.garmin.com/xmlschemas/ActivityExtension/v2",  # Namespace for extensions
 }
 
+TCX_NS = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"
+EXT_NS = "http://www.garmin.com/xmlschemas/ActivityExtension/v2"
+
+# Qualified tag names, built once instead of per element
+_ACTIVITY = f"{{{TCX_NS}}}Activity"
+_LAP = f"{{{TCX_NS}}}Lap"
+_TRACK = f"{{{TCX_NS}}}Track"
+_TRACKPOINT = f"{{{TCX_NS}}}Trackpoint"
+_ID = f"{{{TCX_NS}}}Id"
+_TOTAL_TIME_SECONDS = f"{{{TCX_NS}}}TotalTimeSeconds"
+_DISTANCE_METERS = f"{{{TCX_NS}}}DistanceMeters"
+_TIME = f"{{{TCX_NS}}}Time"
+_ALTITUDE_METERS = f"{{{TCX_NS}}}AltitudeMeters"
+_HEART_RATE_BPM = f"{{{TCX_NS}}}HeartRateBpm"
+_VALUE = f"{{{TCX_NS}}}Value"
+_CADENCE = f"{{{TCX_NS}}}Cadence"
+_EXTENSIONS = f"{{{TCX_NS}}}Extensions"
+_TPX = f"{{{EXT_NS}}}TPX"
+_SPEED = f"{{{EXT_NS}}}Speed"
+_WATTS = f"{{{EXT_NS}}}Watts"
+
+# Keys of nested trackpoint elements in _trackpoint_fields(), by path
+_HEART_RATE_VALUE = (_HEART_RATE_BPM, _VALUE)
+_EXTENSIONS_TPX = (_EXTENSIONS, _TPX)
+_TPX_SPEED = (_EXTENSIONS, _TPX, _SPEED)
+_TPX_WATTS = (_EXTENSIONS, _TPX, _WATTS)
+
+# Elements the converter reacts to while parsing
+_PARSE_TAGS = frozenset(
+    [
+        _ACTIVITY,
+        _LAP,
+        _TRACK,
+        _TRACKPOINT,
+        _ID,
+        _TOTAL_TIME_SECONDS,
+        _DISTANCE_METERS,
+    ]
+)
 
-def convert_tcx_in_memory(input_data: ByteString) -> Tuple[ByteString, Dict]:
+# Lap elements to transfer: (input tag, output tag)
+LAP_ELEMENTS = [
+    (f"{{{TCX_NS}}}{element}", element)
+    for element in [
+        "TotalTimeSeconds",
+        "DistanceMeters",
+        "Calories",
+        "Intensity",
+        "TriggerMethod",
+    ]
+]
+
+# ElementTree assigns this prefix to the extension namespace on output
+_EXT_PREFIX = "ns0"
+_SCHEMA_LOCATION = "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd"
+_XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+
+# Output is held back in memory up to this size (then spilled to disk)
+# until we know whether the root must declare the extension namespace.
+_SPOOL_SIZE = 1024 * 1024
+_FLUSH_PARTS = 512
+
+# Output formats: cleaned TCX, or the same data encoded as FIT
+OUTPUT_FORMATS = ("tcx", "fit")
+
+
+class ConverterBackend(ABC):
     """
-    Converts TCX data in memory without saving to a file and extracts summary data.
-    :param input_data: TCX data as bytes (e.g., from a downloaded file).
-    :return: Converted TCX data as bytes and a dictionary with summary data.
+    XML parser used by the converter. Backends only differ in how the input is
+    parsed; the output is serialized by the same writer, so it is identical.
     """
 
-    # Parse the input data
-    tree = ET.ElementTree(ET.fromstring(input_data))
-    root = tree.getroot()
+    name = None
 
-    # Extract summary data
-    summary_data = {}
-    activities = root.findall(
-        ".//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Activity"
-    )
-    if activities:
-        activity = activities[0]  # Assuming only one activity for simplicity
-        # Extract activity ID (date and time)
-        activity_id = activity.find(
-            ".//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Id"
+    @abstractmethod
+    def iterparse(
+        self, source: Union[str, BinaryIO], tags: Collection[str]
+    ) -> Iterator:
+        """
+        Parse the input incrementally.
+        :param source: path or binary file-like object with XML data.
+        :param tags: qualified tag names the caller is interested in.
+        :return: iterator of (event, element, parent) for elements with the
+            given tags; event is "start" or "end", parent is only set for "end".
+        """
+
+
+class StdlibBackend(ConverterBackend):
+    """
+    Backend based on xml.etree.ElementTree.
+    """
+
+    name = "stdlib"
+
+    def iterparse(
+        self, source: Union[str, BinaryIO], tags: Collection[str]
+    ) -> Iterator:
+        # ElementTree has no parent pointers, so track the open elements
+        path = []
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                path.append(elem)
+                if elem.tag in tags:
+                    yield event, elem, None
+            else:
+                path.pop()
+                if elem.tag in tags:
+                    yield event, elem, path[-1] if path else None
+
+
+class LxmlBackend(ConverterBackend):
+    """
+    Backend based on lxml. With this converter it is slower than the stdlib
+    backend (see benchmarks/run.py), so it is only used when asked for.
+    """
+
+    name = "lxml"
+
+    def iterparse(
+        self, source: Union[str, BinaryIO], tags: Collection[str]
+    ) -> Iterator:
+        # Filtering by tag in lxml saves a Python round trip per element
+        for event, elem in lxml_etree.iterparse(
+            source, events=("start", "end"), tag=list(tags), huge_tree=True
+        ):
+            yield event, elem, elem.getparent() if event == "end" else None
+
+
+BACKENDS = {StdlibBackend.name: StdlibBackend}
+if lxml_etree is not None:
+    BACKENDS[LxmlBackend.name] = LxmlBackend
+
+
+def get_backend(name: str = None) -> ConverterBackend:
+    """
+    :param name: "stdlib" or "lxml". By default the TCX_CONVERTER_BACKEND
+        environment variable is used, or stdlib.
+    :return: Converter backend instance.
+    """
+    if name is None:
+        name = getenv("TCX_CONVERTER_BACKEND") or StdlibBackend.name
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown or unavailable converter backend: {name}")
+    return BACKENDS[name]()
+
+
+def _escape_text(text: str) -> str:
+    # Same escaping as ElementTree uses for character data
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def _escape_attrib(text: str) -> str:
+    # Same escaping as ElementTree uses for attribute values
+    text = _escape_text(text)
+    if '"' in text:
+        text = text.replace('"', "&quot;")
+    if "\r" in text:
+        text = text.replace("\r", "&#13;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    if "\t" in text:
+        text = text.replace("\t", "&#09;")
+    return text
+
+
+class _StreamWriter:
+    """
+    Incremental XML writer that mimics ElementTree serialization byte for byte.
+    The root start tag is written by begin_document() once we know whether the
+    extension namespace is used; everything before that goes to a spool.
+    """
+
+    def __init__(self, destination: BinaryIO):
+        self._destination = destination
+        self._out = tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+        self._parts = []
+        self._pending = False  # Start tag written without its closing ">"
+        self._stack = ["TrainingCenterDatabase"]
+        self.started = False
+
+    def _flush(self) -> None:
+        if self._parts:
+            self._out.write("".join(self._parts).encode("utf-8"))
+            self._parts = []
+
+    def begin_document(self, uses_extensions: bool) -> None:
+        self._flush()
+        ns_decl = f' xmlns:{_EXT_PREFIX}="{EXT_NS}"' if uses_extensions else ""
+        self._destination.write(
+            (
+                "<?xml version='1.0' encoding='UTF-8'?>\n"
+                f"<TrainingCenterDatabase{ns_decl}"
+                f' xsi:schemaLocation="{_SCHEMA_LOCATION}"'
+                f' xmlns:ns2="{namespaces["ns2"]}"'
+                f' xmlns="{TCX_NS}"'
+                f' xmlns:xsi="{_XSI_NS}">'
+            ).encode("utf-8")
         )
-        if activity_id is not None and activity_id.text:
-            # Parse the datetime and format it in a human-readable way
-            activity_datetime = parser.isoparse(activity_id.text)
-            summary_data["activity_datetime"] = activity_datetime.strftime(
-                "%d %b @ %H:%M UTC"
+        spool = self._out
+        spool.seek(0)
+        shutil.copyfileobj(spool, self._destination)
+        spool.close()
+        self._out = self._destination
+        self.started = True
+
+    def start(self, tag: str, attrib: Dict[str, str] = None) -> None:
+        if self._pending:
+            self._parts.append(">")
+        self._parts.append("<" + tag)
+        if attrib:
+            for key, value in attrib.items():
+                self._parts.append(f' {key}="{_escape_attrib(value)}"')
+        self._pending = True
+        self._stack.append(tag)
+
+    def text(self, text: str) -> None:
+        if self._pending:
+            self._parts.append(">")
+            self._pending = False
+        self._parts.append(_escape_text(text))
+
+    def end(self) -> None:
+        tag = self._stack.pop()
+        if self._pending:
+            self._parts.append(" />")
+            self._pending = False
+        else:
+            self._parts.append(f"</{tag}>")
+        if len(self._parts) > _FLUSH_PARTS:
+            self._flush()
+
+    def raw(self, data: str) -> None:
+        """
+        Write already serialized XML as the next child of the open element.
+        """
+        if self._pending:
+            self._parts.append(">")
+            self._pending = False
+        self._parts.append(data)
+        if len(self._parts) > _FLUSH_PARTS:
+            self._flush()
+
+    def leaf(self, tag: str, text: str) -> None:
+        self.start(tag)
+        if text:
+            self.text(text)
+        self.end()
+
+    def close(self) -> None:
+        if not self.started:
+            self.begin_document(False)
+        while self._stack:
+            self.end()
+        self._flush()
+
+
+def _write_lap_header(writer: _StreamWriter, lap, trackpoint=None) -> None:
+    writer.start("Lap", {"StartTime": lap.attrib["StartTime"]})
+    for tag, element in LAP_ELEMENTS:
+        elem = lap.find(tag)
+        if elem is None and tag == _DISTANCE_METERS and trackpoint is not None:
+            # Without its own distance a lap takes the first trackpoint's
+            elem = _first_child(trackpoint, tag)
+        if elem is not None:
+            writer.leaf(element, elem.text)
+    writer.start("Track")
+
+
+def _lap_distance_known(lap, trackpoint) -> bool:
+    return (
+        lap.find(_DISTANCE_METERS) is not None
+        or _first_child(trackpoint, _DISTANCE_METERS) is not None
+    )
+
+
+def _first_child(elem, tag: str):
+    # Plain loop: lxml's find() goes through Python-level path matching
+    for child in elem:
+        if child.tag == tag:
+            return child
+    return None
+
+
+def _leaf(tag: str, text: str) -> str:
+    # Serialized element with text only, as ElementTree writes it
+    if text:
+        return f"<{tag}>{_escape_text(text)}</{tag}>"
+    return f"<{tag} />"
+
+
+def _trackpoint_fields(trackpoint) -> Dict:
+    """
+    :return: the first child of every tag, and the nested elements the
+        converter reads under their paths, e.g. _HEART_RATE_VALUE.
+    """
+    # One pass over the children instead of a search per field
+    fields = {}
+    for child in trackpoint:
+        if child.tag not in fields:
+            fields[child.tag] = child
+    # Nested elements are looked up once for both the output and the values
+    heart_rate = fields.get(_HEART_RATE_BPM)
+    if heart_rate is not None:
+        fields[_HEART_RATE_VALUE] = _first_child(heart_rate, _VALUE)
+    extensions = fields.get(_EXTENSIONS)
+    if extensions is not None:
+        tpx = _first_child(extensions, _TPX)
+        fields[_EXTENSIONS_TPX] = tpx
+        if tpx is not None:
+            fields[_TPX_SPEED] = _first_child(tpx, _SPEED)
+            fields[_TPX_WATTS] = _first_child(tpx, _WATTS)
+    return fields
+
+
+def _trackpoint_xml(fields: Dict) -> Tuple[str, bool]:
+    """
+    :return: the converted Trackpoint, and whether it uses the extension
+        namespace.
+    """
+    # Trackpoints are serialized as one string, it is the hot path
+    parts = []
+    uses_extensions = False
+
+    # Transfer time and distance
+    elem = fields.get(_TIME)
+    if elem is not None:
+        parts.append(_leaf("Time", elem.text))
+    elem = fields.get(_DISTANCE_METERS)
+    if elem is not None:
+        parts.append(_leaf("DistanceMeters", elem.text))
+
+    # Transfer heart rate
+    if _HEART_RATE_BPM in fields:
+        value = fields[_HEART_RATE_VALUE]
+        if value is not None:
+            parts.append(
+                f"<HeartRateBpm>{_leaf('Value', value.text)}</HeartRateBpm>"
             )
+        else:
+            parts.append("<HeartRateBpm />")
 
-        # Extract total time in seconds
-        total_time_seconds = activity.find(
-            ".//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}TotalTimeSeconds"
+    # Transfer cadence
+    cadence = fields.get(_CADENCE)
+    if cadence is not None:
+        parts.append(_leaf("Cadence", cadence.text))
+
+    # Transfer extension data (speed, watts)
+    if fields.get(_EXTENSIONS_TPX) is not None:
+        uses_extensions = True
+        tpx = ""
+        speed = fields[_TPX_SPEED]
+        if speed is not None:
+            tpx += _leaf(f"{_EXT_PREFIX}:Speed", speed.text)
+        watts = fields[_TPX_WATTS]
+        if watts is not None:
+            tpx += _leaf(f"{_EXT_PREFIX}:Watts", watts.text)
+        if tpx:
+            tpx = f"<{_EXT_PREFIX}:TPX>{tpx}</{_EXT_PREFIX}:TPX>"
+        else:
+            tpx = f"<{_EXT_PREFIX}:TPX />"
+        parts.append(f"<Extensions>{tpx}</Extensions>")
+
+    if parts:
+        return (
+            "<Trackpoint>" + "".join(parts) + "</Trackpoint>",
+            uses_extensions,
         )
-        if total_time_seconds is not None and total_time_seconds.text:
-            total_seconds = float(total_time_seconds.text)
-            # Round the total time to the nearest second
-            total_seconds_rounded = round(total_seconds)
-            summary_data["total_time"] = str(
-                timedelta(seconds=total_seconds_rounded)
+    return "<Trackpoint />", uses_extensions
+
+
+def _write_trackpoint_xml(
+    writer: _StreamWriter, converted: Tuple[str, bool]
+) -> None:
+    xml, uses_extensions = converted
+    if uses_extensions and not writer.started:
+        writer.begin_document(True)
+    writer.raw(xml)
+
+
+def _convert_trackpoint(
+    trackpoint,
+    columns: Optional[ActivityColumns],
+    compactor: Optional[Compactor],
+) -> List[Tuple[str, bool]]:
+    """
+    Convert a Trackpoint and add its values to the columns, if given.
+    :return: converted trackpoints to write now, see _trackpoint_xml().
+    """
+    # The children are only referenced in here: lxml clears elements faster
+    # when no Python objects point into them
+    fields = _trackpoint_fields(trackpoint)
+    converted = _trackpoint_xml(fields)
+    if columns is None and compactor is None:
+        return [converted]
+    time, values = _read_trackpoint(fields)
+    if columns is not None:
+        columns.append(time, *values, _read_altitude(fields))
+    if compactor is None:
+        return [converted]
+    return compactor.add(Point(time, values, converted))
+
+
+def convert_tcx_stream(
+    source: Union[str, BinaryIO],
+    destination: BinaryIO,
+    backend: ConverterBackend = None,
+    compaction: CompactionRules = None,
+) -> Dict:
+    """
+    Converts TCX data in a single pass. Parses the input incrementally,
+    writes the converted TCX to the destination one Trackpoint at a time and
+    discards processed elements, so memory use doesn't grow with the file size.
+    Note: on malformed XML a parse error is raised after part of the output
+    has already been written.
+    :param source: path or binary file-like object with TCX data.
+    :param destination: binary file-like object for the converted TCX data.
+    :param backend: XML parser backend, see get_backend().
+    :param compaction: if given, trackpoints these rules allow are dropped;
+        the summary then reports how many.
+    :return: Dictionary with summary data, including power, heart rate, speed
+        and altitude stats of the first activity.
+    """
+    if backend is None:
+        backend = get_backend()
+    compactor = Compactor(compaction) if compaction else None
+    # Trackpoints of the first activity, for the summary stats
+    columns = ActivityColumns()
+    writer = _StreamWriter(destination)
+    writer.start("Activities")
+
+    summary_elements = {}
+    activities_seen = 0
+    activity = lap = None
+    lap_started = False
+    # Trackpoints converted before the lap header could be written
+    held = []
+
+    for event, elem, parent in backend.iterparse(source, _PARSE_TAGS):
+        tag = elem.tag
+        if event == "start":
+            if tag == _ACTIVITY and activity is None:
+                activity = elem
+                activities_seen += 1
+                activity_id_written = False
+                # Convert the 'Sport' attribute value
+                writer.start(
+                    "Activity", {"Sport": elem.attrib["Sport"].capitalize()}
+                )
+            elif tag == _LAP and activity is not None and lap is None:
+                lap = elem
+                lap_started = False
+            elif (
+                tag == _TRACK
+                and lap is not None
+                and not lap_started
+                and lap.find(_DISTANCE_METERS) is not None
+            ):
+                _write_lap_header(writer, lap)
+                lap_started = True
+            continue
+
+        if activity is None:
+            continue
+
+        # Summary comes from the first matching elements of the first activity
+        if activities_seen == 1 and tag in (
+            _ID,
+            _TOTAL_TIME_SECONDS,
+            _DISTANCE_METERS,
+        ):
+            summary_elements.setdefault(tag, elem.text)
+
+        if tag == _ID and not activity_id_written:
+            writer.leaf("Id", elem.text)
+            activity_id_written = True
+        elif tag == _TRACKPOINT and lap is not None:
+            converted = _convert_trackpoint(
+                elem, columns if activities_seen == 1 else None, compactor
             )
+            if not lap_started:
+                # The lap's distance may have to come from a trackpoint,
+                # so the header waits for the first one that has it
+                held.extend(converted)
+                converted = []
+                if _lap_distance_known(lap, elem):
+                    _write_lap_header(writer, lap, elem)
+                    lap_started = True
+                    converted, held = held, []
+            for item in converted:
+                _write_trackpoint_xml(writer, item)
+            elem.clear()
+            parent.remove(elem)
+        elif elem is lap:
+            if not lap_started:
+                _write_lap_header(writer, lap)
+            for item in held:
+                _write_trackpoint_xml(writer, item)
+            held = []
+            if compactor is not None:
+                for kept in compactor.finish_lap():
+                    _write_trackpoint_xml(writer, kept)
+            writer.end()  # Track
+            writer.end()  # Lap
+            lap = None
+            elem.clear()
+            parent.remove(elem)
+        elif elem is activity:
+            writer.end()
+            activity = None
+            elem.clear()
+            parent.remove(elem)
+
+    writer.close()
+    summary_data = _summarize(summary_elements)
+    summary_data.update(columns.stats())
+    if compactor is not None:
+        summary_data.update(compactor.summary())
+    return summary_data
+
 
-        # Extract total distance in meters
-        distance_meters = activity.find(
-            ".//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}DistanceMeters"
+def _summarize(summary_elements: Dict[str, str]) -> Dict:
+    summary_data = {}
+    # Extract activity ID (date and time)
+    activity_id = summary_elements.get(_ID)
+    if activity_id:
+        # Parse the datetime and format it in a human-readable way
+        activity_datetime = parser.isoparse(activity_id)
+        summary_data["activity_datetime"] = activity_datetime.strftime(
+            "%d %b @ %H:%M UTC"
+        )
+    # Extract total time in seconds
+    total_time_seconds = summary_elements.get(_TOTAL_TIME_SECONDS)
+    if total_time_seconds:
+        # Round the total time to the nearest second
+        total_seconds_rounded = round(float(total_time_seconds))
+        summary_data["total_time"] = str(
+            timedelta(seconds=total_seconds_rounded)
         )
-        if distance_meters is not None and distance_meters.text:
-            distance_km = float(distance_meters.text) / 1000
-            summary_data["total_distance_km"] = f"{distance_km:.2f}"
-
-    # Create a new root for the output TCX
-    new_root = ET.Element(
-        "TrainingCenterDatabase",
-        {
-            "xsi:schemaLocation": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd",
-            "xmlns:ns2": namespaces["ns2"],  # Namespace for extensions
-            "xmlns": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2",  # Default namespace
-            "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
-        },
+    # Extract total distance in meters
+    distance_meters = summary_elements.get(_DISTANCE_METERS)
+    if distance_meters:
+        distance_km = float(distance_meters) / 1000
+        summary_data["total_distance_km"] = f"{distance_km:.2f}"
+    return summary_data
+
+
+def convert_tcx_in_memory(
+    input_data: ByteString,
+    backend: ConverterBackend = None,
+    compaction: CompactionRules = None,
+) -> Tuple[ByteString, Dict]:
+    """
+    Converts TCX data in memory without saving to a file and extracts summary data.
+    :param input_data: TCX data as bytes (e.g., from a downloaded file).
+    :param backend: XML parser backend, see get_backend().
+    :param compaction: trackpoint compaction rules, see convert_tcx_stream().
+    :return: Converted TCX data as bytes and a dictionary with summary data.
+    """
+    output_data = BytesIO()
+    summary_data = convert_tcx_stream(
+        BytesIO(input_data), output_data, backend, compaction
     )
+    return output_data.getvalue(), summary_data
 
-    activities_out = ET.SubElement(new_root, "Activities")
 
-    # Transfer information for each activity
-    for activity in activities:
-        # Convert the 'Sport' attribute value
-        sport = activity.attrib["Sport"].capitalize()
+def _to_float(text: Optional[str]) -> Optional[float]:
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
 
-        activity_out = ET.SubElement(activities_out, "Activity", Sport=sport)
 
-        # Transfer activity ID
-        activity_id = activity.find(
-            ".//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Id"
-        )
-        if activity_id is not None:
-            ET.SubElement(activity_out, "Id").text = activity_id.text
+def _parse_time(text: Optional[str]) -> Optional[float]:
+    # Seconds since the epoch
+    if not text:
+        return None
+    try:
+        # Much faster than dateutil for the usual "2024-01-01T10:00:00Z"
+        time = datetime.fromisoformat(text)
+    except ValueError:
+        try:
+            time = parser.isoparse(text)
+        except ValueError:
+            return None
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time.timestamp()
+
 
-        # Transfer information for each lap
-        for lap in activity.findall(
-            ".//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Lap"
+def _parse_fit_time(text: Optional[str]) -> Optional[int]:
+    time = _parse_time(text)
+    return fit_timestamp(time) if time is not None else None
+
+
+def _read_trackpoint(
+    fields: Dict,
+) -> Tuple[Optional[float], Tuple[Optional[float], ...]]:
+    """
+    :return: time in seconds since the epoch, and distance, heart rate,
+        cadence, speed and power as numbers (None where missing).
+    """
+    elem = fields.get(_TIME)
+    time = _parse_time(elem.text if elem is not None else None)
+    elem = fields.get(_DISTANCE_METERS)
+    distance = _to_float(elem.text) if elem is not None else None
+    elem = fields.get(_HEART_RATE_VALUE)
+    heart_rate = _to_float(elem.text) if elem is not None else None
+    elem = fields.get(_CADENCE)
+    cadence = _to_float(elem.text) if elem is not None else None
+    elem = fields.get(_TPX_SPEED)
+    speed = _to_float(elem.text) if elem is not None else None
+    elem = fields.get(_TPX_WATTS)
+    power = _to_float(elem.text) if elem is not None else None
+    return time, (distance, heart_rate, cadence, speed, power)
+
+
+def _read_altitude(fields: Dict) -> Optional[float]:
+    elem = fields.get(_ALTITUDE_METERS)
+    return _to_float(elem.text) if elem is not None else None
+
+
+def _encode_trackpoint(
+    encoder: FitActivityEncoder,
+    trackpoint,
+    columns: Optional[ActivityColumns],
+    compactor: Optional[Compactor],
+) -> None:
+    fields = _trackpoint_fields(trackpoint)
+    time, values = _read_trackpoint(fields)
+    if columns is not None:
+        columns.append(time, *values, _read_altitude(fields))
+    if time is None:
+        # FIT records can't go without a time
+        return
+    if compactor is None:
+        encoder.record(fit_timestamp(time), *values)
+        return
+    for time, values in compactor.add(Point(time, values, (time, values))):
+        encoder.record(fit_timestamp(time), *values)
+
+
+def _end_fit_lap(encoder: FitActivityEncoder, lap) -> None:
+    values = {}
+    for tag, element in LAP_ELEMENTS:
+        elem = _first_child(lap, tag)
+        if elem is not None and elem.text:
+            values[element] = elem.text.strip()
+    encoder.end_lap(
+        total_timer_time=_to_float(values.get("TotalTimeSeconds")),
+        total_distance=_to_float(values.get("DistanceMeters")),
+        total_calories=_to_float(values.get("Calories")),
+        intensity=INTENSITIES.get(values.get("Intensity", "").lower()),
+        lap_trigger=LAP_TRIGGERS.get(values.get("TriggerMethod", "").lower()),
+    )
+
+
+def convert_tcx_to_fit_stream(
+    source: Union[str, BinaryIO],
+    destination: BinaryIO,
+    backend: ConverterBackend = None,
+    compaction: CompactionRules = None,
+) -> Dict:
+    """
+    Converts TCX data to a FIT activity file in a single pass. Every TCX
+    activity becomes a session, laps keep their totals, and trackpoints become
+    records with time, distance, heart rate, cadence, speed and power.
+    :param source: path or binary file-like object with TCX data.
+    :param destination: binary file-like object for the FIT data.
+    :param backend: XML parser backend, see get_backend().
+    :param compaction: trackpoint compaction rules, see convert_tcx_stream().
+    :return: Dictionary with summary data, the same as convert_tcx_stream() returns.
+    """
+    if backend is None:
+        backend = get_backend()
+    compactor = Compactor(compaction) if compaction else None
+    columns = ActivityColumns()
+    encoder = FitActivityEncoder()
+
+    summary_elements = {}
+    activities_seen = 0
+    activity = lap = None
+
+    for event, elem, parent in backend.iterparse(source, _PARSE_TAGS):
+        tag = elem.tag
+        if event == "start":
+            if tag == _ACTIVITY and activity is None:
+                activity = elem
+                activities_seen += 1
+                sport = elem.attrib.get("Sport", "").lower()
+                encoder.start_session(SPORTS.get(sport, SPORT_GENERIC))
+            elif tag == _LAP and activity is not None and lap is None:
+                lap = elem
+                encoder.start_lap(
+                    _parse_fit_time(elem.attrib.get("StartTime"))
+                )
+            continue
+
+        if activity is None:
+            continue
+
+        if activities_seen == 1 and tag in (
+            _ID,
+            _TOTAL_TIME_SECONDS,
+            _DISTANCE_METERS,
         ):
-            lap_out = ET.SubElement(
-                activity_out, "Lap", StartTime=lap.attrib["StartTime"]
+            summary_elements.setdefault(tag, elem.text)
+
+        if tag == _TRACKPOINT and lap is not None:
+            _encode_trackpoint(
+                encoder,
+                elem,
+                columns if activities_seen == 1 else None,
+                compactor,
             )
+            elem.clear()
+            parent.remove(elem)
+        elif elem is lap:
+            if compactor is not None:
+                for time, values in compactor.finish_lap():
+                    encoder.record(fit_timestamp(time), *values)
+            _end_fit_lap(encoder, lap)
+            lap = None
+            elem.clear()
+            parent.remove(elem)
+        elif elem is activity:
+            encoder.end_session()
+            activity = None
+            elem.clear()
+            parent.remove(elem)
 
-            # Transfer main lap data
-            for element in [
-                "TotalTimeSeconds",
-                "DistanceMeters",
-                "Calories",
-                "Intensity",
-                "TriggerMethod",
-            ]:
-                elem = lap.find(
-                    f".//{{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}}{element}"
-                )
-                if elem is not None:
-                    ET.SubElement(lap_out, element).text = elem.text
+    destination.write(encoder.getvalue())
+    summary_data = _summarize(summary_elements)
+    summary_data.update(columns.stats())
+    if compactor is not None:
+        summary_data.update(compactor.summary())
+    return summary_data
 
-            # Process track and trackpoint data
-            track_out = ET.SubElement(lap_out, "Track")
-            for trackpoint in lap.findall(
-                ".//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Trackpoint"
-            ):
-                trackpoint_out = ET.SubElement(track_out, "Trackpoint")
-
-                # Transfer time and distance
-                for element in ["Time", "DistanceMeters"]:
-                    elem = trackpoint.find(
-                        f".//{{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}}{element}"
-                    )
-                    if elem is not None:
-                        ET.SubElement(trackpoint_out, element).text = elem.text
-
-                # Transfer heart rate
-                heart_rate = trackpoint.find(
-                    ".//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}HeartRateBpm"
-                )
-                if heart_rate is not None:
-                    heart_rate_out = ET.SubElement(
-                        trackpoint_out, "HeartRateBpm"
-                    )
-                    value = heart_rate.find(
-                        ".//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Value"
-                    )
-                    if value is not None:
-                        ET.SubElement(heart_rate_out, "Value").text = value.text
-
-                # Transfer cadence
-                cadence = trackpoint.find(
-                    ".//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Cadence"
-                )
-                if cadence is not None:
-                    ET.SubElement(trackpoint_out, "Cadence").text = cadence.text
 
-                # Transfer extension data (speed, watts, etc.)
-                extensions = trackpoint.find(
-                    ".//{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}Extensions"
-                )
-                if extensions is not None:
-                    ax_extension = extensions.find(
-                        ".//{http://www.garmin.com/xmlschemas/ActivityExtension/v2}TPX"
-                    )
-                    if ax_extension is not None:
-                        tpx_out = ET.SubElement(trackpoint_out, "Extensions")
-                        ax_tpx_out = ET.SubElement(
-                            tpx_out,
-                            f"{{{namespaces['ns2']}}}TPX",
+def convert_tcx_to_fit(
+    input_data: ByteString,
+    backend: ConverterBackend = None,
+    compaction: CompactionRules = None,
+) -> Tuple[bytes, Dict]:
+    """
+    Converts TCX data in memory to a FIT activity file and extracts summary data.
+    :param input_data: TCX data as bytes (e.g., from a downloaded file).
+    :param backend: XML parser backend, see get_backend().
+    :param compaction: trackpoint compaction rules, see convert_tcx_stream().
+    :return: FIT data as bytes and a dictionary with summary data.
+    """
+    output_data = BytesIO()
+    summary_data = convert_tcx_to_fit_stream(
+        BytesIO(input_data), output_data, backend, compaction
+    )
+    return output_data.getvalue(), summary_data
+
+
+# Streaming converter of every output format
+CONVERTERS = {"tcx": convert_tcx_stream, "fit": convert_tcx_to_fit_stream}
+
+
+def output_file_name(file_name: str, output_format: str = "tcx") -> str:
+    """
+    :return: name of the converted file, e.g. "converted_ride.fit".
+    """
+    if output_format == "fit":
+        file_name = splitext(file_name)[0] + ".fit"
+    return f"converted_{file_name}"
+
+
+@dataclass
+class BulkJob:
+    """
+    A TCX file, or a TCX entry of a ZIP archive, to be converted by the CLI.
+    """
+
+    source: str
+    member: Optional[str]  # Entry name if the source is a ZIP archive
+    output: str
+    input_bytes: int
+
+
+MANIFEST_FIELDS = [
+    "source",
+    "member",
+    "output",
+    "status",
+    "activity_datetime",
+    "total_time",
+    "total_distance_km",
+    "avg_power",
+    "normalized_power",
+    "max_power",
+    "avg_heart_rate",
+    "max_heart_rate",
+    "avg_speed_kmh",
+    "max_speed_kmh",
+    "min_altitude",
+    "max_altitude",
+    "ascent",
+    "trackpoints",
+    "trackpoints_removed",
+    "input_bytes",
+    "output_bytes",
+    "seconds",
+    "error",
+]
+
+
+def _is_tcx(name: str) -> bool:
+    return name.lower().endswith(".tcx")
+
+
+def _member_path(name: str) -> Optional[List[str]]:
+    """
+    Make a ZIP entry name safe to use as a relative output path: drive
+    letters and leading slashes are stripped.
+    :return: path components, or None if the name leads out of its directory
+        with "..".
+    """
+    name = name.replace("\\", "/")
+    if len(name) > 1 and name[1] == ":":
+        name = name[2:]
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if ".." in parts:
+        return None
+    return parts
+
+
+def _is_within(path: str, directory: str) -> bool:
+    directory = os.path.abspath(directory)
+    return os.path.commonpath([directory, os.path.abspath(path)]) == directory
+
+
+def collect_jobs(
+    inputs: List[str], output_dir: str, output_format: str = "tcx"
+) -> List[BulkJob]:
+    """
+    Find the TCX files to convert. Directories are searched recursively for
+    TCX files and ZIP archives; the output keeps their directory structure.
+    Every ZIP archive gets an output directory named after it; entries
+    whose names lead out of it are skipped.
+    :param inputs: paths of files, directories or ZIP archives, or glob patterns.
+    :param output_dir: directory for the converted files.
+    :raise FileNotFoundError: if an input matches nothing.
+    """
+    jobs = []
+    outputs = set()
+
+    def add(path: str, subdir: str) -> None:
+        if zipfile.is_zipfile(path):
+            archive = splitext(os.path.basename(path))[0]
+            with zipfile.ZipFile(path) as zip_ref:
+                for info in zip_ref.infolist():
+                    if info.is_dir() or not _is_tcx(info.filename):
+                        continue
+                    parts = _member_path(info.filename)
+                    output = None
+                    if parts is not None:
+                        output = os.path.join(
+                            output_dir,
+                            subdir,
+                            archive,
+                            *parts[:-1],
+                            output_file_name(parts[-1], output_format),
+                        )
+                    if output is None or not _is_within(output, output_dir):
+                        print(
+                            f"Skipping {path}:{info.filename}: the entry "
+                            "would be written outside the output directory",
+                            file=sys.stderr,
                         )
-                        for ext_element in ["Speed", "Watts"]:
-                            ext = ax_extension.find(
-                                f".//{{http://www.garmin.com/xmlschemas/ActivityExtension/v2}}{ext_element}"
+                        continue
+                    if output not in outputs:
+                        outputs.add(output)
+                        jobs.append(
+                            BulkJob(
+                                path, info.filename, output, info.file_size
                             )
-                            if ext is not None:
-                                ET.SubElement(
-                                    ax_tpx_out,
-                                    f"{{{namespaces['ns2']}}}{ext_element}",
-                                ).text = ext.text
+                        )
+        elif _is_tcx(path):
+            output = os.path.join(
+                output_dir,
+                subdir,
+                output_file_name(os.path.basename(path), output_format),
+            )
+            if output not in outputs:
+                outputs.add(output)
+                jobs.append(BulkJob(path, None, output, os.path.getsize(path)))
 
-    # Serialize the new XML tree to bytes
-    output_data = BytesIO()
-    tree_out = ET.ElementTree(new_root)
-    tree_out.write(output_data, xml_declaration=True, encoding="UTF-8")
-    return output_data.getvalue(), summary_data
+    for pattern in inputs:
+        if any(char in pattern for char in "*?["):
+            paths = sorted(glob.glob(pattern, recursive=True))
+        else:
+            paths = [pattern] if os.path.exists(pattern) else []
+        if not paths:
+            raise FileNotFoundError(f"No such file or directory: {pattern}")
+        for path in paths:
+            if not os.path.isdir(path):
+                add(path, "")
+                continue
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                subdir = os.path.relpath(dir_path, path)
+                for file_name in sorted(file_names):
+                    if _is_tcx(file_name) or file_name.lower().endswith(
+                        ".zip"
+                    ):
+                        add(
+                            os.path.join(dir_path, file_name),
+                            "" if subdir == "." else subdir,
+                        )
+    return jobs
+
+
+def is_up_to_date(job: BulkJob) -> bool:
+    """
+    :return: True if the output exists and is newer than its source.
+    """
+    try:
+        return os.path.getmtime(job.output) >= os.path.getmtime(job.source)
+    except OSError:
+        return False
+
+
+def convert_job(
+    job: BulkJob,
+    output_format: str = "tcx",
+    backend_name: str = None,
+    compaction: CompactionRules = None,
+) -> Dict:
+    """
+    Convert one file of a bulk run; runs in a worker process. The output is
+    written under a temporary name first, so an interrupted run never leaves
+    a partial file that looks up to date.
+    :return: manifest row of the file.
+    """
+    started = time.perf_counter()
+    row = {
+        "source": job.source,
+        "member": job.member,
+        "output": job.output,
+        "status": "converted",
+        "input_bytes": job.input_bytes,
+    }
+    temp_path = job.output + ".part"
+    try:
+        convert = CONVERTERS[output_format]
+        backend = get_backend(backend_name)
+        os.makedirs(os.path.dirname(job.output) or ".", exist_ok=True)
+        with open(temp_path, "wb") as destination:
+            if job.member is None:
+                summary = convert(job.source, destination, backend, compaction)
+            else:
+                with zipfile.ZipFile(job.source) as zip_ref, zip_ref.open(
+                    job.member
+                ) as member:
+                    summary = convert(member, destination, backend, compaction)
+        os.replace(temp_path, job.output)
+        row.update(summary)
+        row["output_bytes"] = os.path.getsize(job.output)
+    except Exception as e:
+        row["status"] = "failed"
+        row["error"] = str(e)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    row["seconds"] = round(time.perf_counter() - started, 3)
+    return row
+
+
+def read_manifest(path: str) -> Dict[str, Dict]:
+    """
+    :return: rows of a manifest written by a previous run, by output path;
+        empty if there is none.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = json.load(f)
+    return {row["output"]: row for row in rows}
+
+
+def write_manifest(path: str, rows: List[Dict]) -> None:
+    """
+    Save the manifest as CSV if the path ends with .csv, otherwise as JSON.
+    """
+    with open(path, "w", newline="") as f:
+        if path.lower().endswith(".csv"):
+            writer = csv.DictWriter(
+                f, fieldnames=MANIFEST_FIELDS, extrasaction="ignore"
+            )
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump(rows, f, indent=2)
+
+
+def convert_all(
+    jobs: List[BulkJob],
+    output_format: str = "tcx",
+    workers: int = None,
+    backend_name: str = None,
+    force: bool = False,
+    previous: Dict[str, Dict] = None,
+    compaction: CompactionRules = None,
+) -> List[Dict]:
+    """
+    Convert files on a process pool, skipping outputs that are up to date.
+    :param previous: manifest rows of a previous run; skipped files keep
+        their summaries from it.
+    :return: manifest rows in the order of the jobs.
+    """
+    previous = previous or {}
+    rows: List[Optional[Dict]] = [None] * len(jobs)
+    pending = []
+    for index, job in enumerate(jobs):
+        if not force and is_up_to_date(job):
+            row = dict(previous.get(job.output, {}))
+            row.update(
+                source=job.source,
+                member=job.member,
+                output=job.output,
+                status="skipped",
+                input_bytes=job.input_bytes,
+            )
+            rows[index] = row
+        else:
+            pending.append(index)
+    if not pending:
+        return rows
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                convert_job,
+                jobs[index],
+                output_format,
+                backend_name,
+                compaction,
+            ): index
+            for index in pending
+        }
+        for future in as_completed(futures):
+            row = future.result()
+            rows[futures[future]] = row
+            if row["status"] == "failed":
+                name = row["source"]
+                if row["member"]:
+                    name += f":{row['member']}"
+                print(
+                    f"Failed to convert {name}: {row['error']}",
+                    file=sys.stderr,
+                )
+    return rows
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description="Convert TCX files in bulk with the bot's converter."
+    )
+    arg_parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="TCX files, ZIP archives, directories or glob patterns",
+    )
+    arg_parser.add_argument(
+        "-o", "--output", required=True, help="directory for converted files"
+    )
+    arg_parser.add_argument(
+        "--format", choices=OUTPUT_FORMATS, default="tcx", help="output format"
+    )
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        help="worker processes (default: number of CPUs)",
+    )
+    arg_parser.add_argument(
+        "--backend", choices=sorted(BACKENDS), help="XML parser backend"
+    )
+    arg_parser.add_argument(
+        "--manifest",
+        help="save summaries to this JSON or CSV file (CSV if it ends with .csv)",
+    )
+    arg_parser.add_argument(
+        "--compact",
+        metavar="RULES",
+        help='drop redundant trackpoints, e.g. "duplicates,power=5,speed=0.1"',
+    )
+    arg_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="convert files even if their output is up to date",
+    )
+    args = arg_parser.parse_args()
+
+    try:
+        jobs = collect_jobs(args.inputs, args.output, args.format)
+    except (FileNotFoundError, zipfile.BadZipFile) as e:
+        arg_parser.error(str(e))
+    try:
+        compaction = CompactionRules.parse(args.compact)
+    except ValueError as e:
+        arg_parser.error(str(e))
+    previous = read_manifest(args.manifest) if args.manifest else {}
+
+    started = time.perf_counter()
+    rows = convert_all(
+        jobs,
+        args.format,
+        args.workers,
+        args.backend,
+        args.force,
+        previous,
+        compaction,
+    )
+    elapsed = time.perf_counter() - started
+
+    if args.manifest:
+        write_manifest(args.manifest, rows)
+    converted = [row for row in rows if row["status"] == "converted"]
+    failed = sum(row["status"] == "failed" for row in rows)
+    skipped = sum(row["status"] == "skipped" for row in rows)
+    input_mb = sum(row["input_bytes"] for row in converted) / 1024 / 1024
+    output_mb = sum(row["output_bytes"] for row in converted) / 1024 / 1024
+    print(
+        f"Converted {len(converted)} files ({input_mb:.1f} MB -> "
+        f"{output_mb:.1f} MB) in {elapsed:.1f} s: "
+        f"{len(converted) / elapsed if elapsed else 0:.1f} files/s, "
+        f"{input_mb / elapsed if elapsed else 0:.1f} MB/s"
+    )
+    print(f"Skipped {skipped} up-to-date files, {failed} failed")
+    if compaction is not None:
+        removed = sum(row.get("trackpoints_removed", 0) for row in converted)
+        total = sum(row.get("trackpoints", 0) for row in converted)
+        print(f"Removed {removed} of {total} trackpoints")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
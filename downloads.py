@@ -0,0 +1,115 @@
+import io
+import os
+import re
+import shutil
+import tempfile
+from os import getenv
+from typing import BinaryIO, Union
+
+from aiogram import Bot
+from aiogram.types import Document
+
+from metrics import STAGE_SECONDS
+
+# Files larger than this are downloaded to a temporary file instead of memory
+SPOOL_THRESHOLD = int(getenv("DOWNLOAD_SPOOL_THRESHOLD", str(4 * 1024 * 1024)))
+# Format checks only look at the beginning of a file
+SNIFF_SIZE = 4096
+
+
+class DownloadedFile:
+    """
+    A downloaded Telegram document. Small files are kept in memory, larger ones
+    in a temporary directory on disk under their original name.
+    """
+
+    def __init__(self, file_name: str, file_size: int, spool_threshold: int):
+        self.name = os.path.basename(file_name)
+        if file_size > spool_threshold:
+            self._dir = tempfile.mkdtemp(prefix="tcx_bot_")
+            self.path = os.path.join(self._dir, self.name)
+            self.file = open(self.path, "w+b")
+        else:
+            self._dir = None
+            self.path = None
+            self.file = io.BytesIO()
+            self.file.name = self.name
+
+    def head(self, size: int = SNIFF_SIZE) -> bytes:
+        """
+        Read the first bytes of the file without moving the file position.
+        """
+        position = self.file.tell()
+        self.file.seek(0)
+        data = self.file.read(size)
+        self.file.seek(position)
+        return data
+
+    def source(self) -> Union[str, bytes]:
+        """
+        :return: path of the file on disk, or its content if it is kept in memory.
+        """
+        if self.path:
+            return self.path
+        return self.file.getvalue()
+
+    def open(self) -> BinaryIO:
+        """
+        :return: the file rewound to the beginning, named after the original document.
+        """
+        self.file.seek(0)
+        return self.file
+
+    def close(self) -> None:
+        self.file.close()
+        if self._dir:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+    def __enter__(self) -> "DownloadedFile":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+async def download_document(
+    bot: Bot, document: Document, spool_threshold: int = SPOOL_THRESHOLD
+) -> DownloadedFile:
+    """
+    Download a Telegram document chunk by chunk into memory or a temporary file.
+    :return: DownloadedFile, to be closed by the caller.
+    """
+    downloaded = DownloadedFile(
+        document.file_name or document.file_id,
+        document.file_size or 0,
+        spool_threshold,
+    )
+    try:
+        with STAGE_SECONDS.time(stage="download"):
+            file = await bot.get_file(document.file_id)
+            await bot.download_file(
+                file.file_path, destination=downloaded.file
+            )
+            # Conversion workers open files on disk by path
+            downloaded.file.flush()
+    except BaseException:
+        downloaded.close()
+        raise
+    return downloaded
+
+
+def looks_like_tcx(head: bytes) -> bool:
+    """
+    Check the beginning of a file for an XML declaration and a TCX root element.
+    """
+    return bool(
+        re.search(rb"<\?xml.*?\?>", head)
+        and b"<TrainingCenterDatabase" in head
+    )
+
+
+def looks_like_fit(head: bytes) -> bool:
+    """
+    Check for a FIT file header: header size 12 or 14 and the ".FIT" signature.
+    """
+    return len(head) >= 12 and head[0] in (12, 14) and head[8:12] == b".FIT"
@@ -0,0 +1,187 @@
+import asyncio
+from collections import deque
+from typing import TYPE_CHECKING, Dict, Hashable, Tuple
+
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from metrics import Gauge
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+SCHEDULER_WAITING = Gauge(
+    "tcx_bot_scheduler_waiting",
+    "Jobs waiting for a slot, by scheduler.",
+    ["scheduler"],
+)
+SCHEDULER_RUNNING = Gauge(
+    "tcx_bot_scheduler_running",
+    "Jobs holding a slot, by scheduler.",
+    ["scheduler"],
+)
+SCHEDULER_USERS = Gauge(
+    "tcx_bot_scheduler_users",
+    "Users with waiting jobs, by scheduler.",
+    ["scheduler"],
+)
+
+
+class FairScheduler:
+    """
+    Shares a limited number of slots (worker processes, Garmin connections,
+    Telegram requests) fairly between users. Every user has their own queue;
+    free slots are handed out round-robin between the users with waiting jobs,
+    and no user holds more than per_user_limit slots at once. So a user with
+    a single file doesn't wait behind another user's big ZIP archive.
+    """
+
+    def __init__(
+        self, capacity: int, per_user_limit: int = None, name: str = "default"
+    ):
+        """
+        :param capacity: number of slots.
+        :param per_user_limit: maximum slots held by one user (default: all).
+        :param name: label of the scheduler's metrics.
+        """
+        self.capacity = capacity
+        self.per_user_limit = min(per_user_limit or capacity, capacity)
+        self.name = name
+        self.running = 0
+        self._running: Dict[Hashable, int] = {}
+        self._waiting: Dict[Hashable, deque] = {}
+        self._turns = deque()  # Users with waiting jobs, in round-robin order
+
+    def queue_depth(self, user_id: Hashable = None) -> int:
+        """
+        :return: number of waiting jobs of a user, or of all users if None.
+        """
+        if user_id is None:
+            return sum(len(queue) for queue in self._waiting.values())
+        return len(self._waiting.get(user_id, ()))
+
+    def snapshot(self) -> Dict[Hashable, Tuple[int, int]]:
+        """
+        :return: (waiting, running) jobs of every user with jobs.
+        """
+        users = set(self._waiting) | set(self._running)
+        return {
+            user_id: (
+                len(self._waiting.get(user_id, ())),
+                self._running.get(user_id, 0),
+            )
+            for user_id in users
+        }
+
+    def _update_metrics(self) -> None:
+        SCHEDULER_WAITING.set(self.queue_depth(), scheduler=self.name)
+        SCHEDULER_RUNNING.set(self.running, scheduler=self.name)
+        SCHEDULER_USERS.set(len(self._turns), scheduler=self.name)
+
+    def _dispatch(self) -> None:
+        while self.running < self.capacity and self._turns:
+            for _ in range(len(self._turns)):
+                user_id = self._turns[0]
+                self._turns.rotate(-1)
+                if self._running.get(user_id, 0) < self.per_user_limit:
+                    break
+            else:
+                # Every waiting user holds as many slots as allowed
+                break
+            queue = self._waiting[user_id]
+            waiter = queue.popleft()
+            if not queue:
+                del self._waiting[user_id]
+                self._turns.remove(user_id)
+            if waiter.done():
+                # Cancelled, its task will clean up when it wakes up
+                continue
+            self.running += 1
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            waiter.set_result(None)
+        self._update_metrics()
+
+    async def acquire(self, user_id: Hashable = None) -> None:
+        """
+        Wait for a slot on behalf of a user.
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        queue = self._waiting.get(user_id)
+        if queue is None:
+            queue = self._waiting[user_id] = deque()
+            self._turns.append(user_id)
+        queue.append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just before the cancellation
+                self.release(user_id)
+            elif waiter in queue:
+                queue.remove(waiter)
+                if not queue and self._waiting.get(user_id) is queue:
+                    del self._waiting[user_id]
+                    self._turns.remove(user_id)
+                self._update_metrics()
+            raise
+
+    def release(self, user_id: Hashable = None) -> None:
+        """
+        Give a slot back and pass it on to the next user in turn.
+        """
+        self.running -= 1
+        self._running[user_id] -= 1
+        if not self._running[user_id]:
+            del self._running[user_id]
+        self._dispatch()
+
+    def slot(self, user_id: Hashable = None) -> "_Slot":
+        """
+        Hold a slot for the duration of the block.
+        """
+        return _Slot(self, user_id)
+
+
+class _Slot:
+    # Not an @asynccontextmanager: contextlib assigns __traceback__ to the
+    # exceptions leaving the block, which fails for frozen dataclass
+    # exceptions like garth's GarthHTTPError and replaces them
+    def __init__(self, scheduler: FairScheduler, user_id: Hashable):
+        self.scheduler = scheduler
+        self.user_id = user_id
+
+    async def __aenter__(self) -> None:
+        await self.scheduler.acquire(self.user_id)
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.scheduler.release(self.user_id)
+
+
+class FairTelegramRequests(BaseRequestMiddleware):
+    """
+    Bot session middleware that passes outgoing Telegram requests through
+    a FairScheduler keyed by chat, so progress messages of one big batch
+    don't hold up the replies to other users. Requests without a chat
+    (getUpdates, getFile) bypass the scheduler: they would all share one
+    slot, and a long poll would hold it for its whole timeout.
+    """
+
+    def __init__(self, scheduler: FairScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: "Bot",
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        async with self.scheduler.slot(chat_id):
+            return await make_request(bot, method)
@@ -0,0 +1,471 @@
+import struct
+from typing import List, Optional, Tuple
+
+from fit_summary import FIT_EPOCH
+
+# FIT base types: (struct format, base type byte, invalid value)
+_ENUM = ("B", 0x00, 0xFF)
+_UINT8 = ("B", 0x02, 0xFF)
+_UINT16 = ("H", 0x84, 0xFFFF)
+_UINT32 = ("I", 0x86, 0xFFFFFFFF)
+_UINT32Z = ("I", 0x8C, 0)
+
+# Values of FIT profile enums we write
+SPORT_GENERIC = 0
+SPORTS = {"running": 1, "biking": 2}
+_FILE_ACTIVITY = 4
+_MANUFACTURER_DEVELOPMENT = 255
+_EVENT_TIMER = 0
+_EVENT_SESSION = 8
+_EVENT_LAP = 9
+_EVENT_ACTIVITY = 26
+_EVENT_TYPE_START = 0
+_EVENT_TYPE_STOP = 1
+_EVENT_TYPE_STOP_ALL = 4
+INTENSITIES = {"active": 0, "resting": 1}
+LAP_TRIGGERS = {"manual": 0, "time": 1, "distance": 2, "location": 3}
+
+
+def _crc_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+# Byte-wise table of the FIT CRC (CRC-16/ARC), 8 times fewer steps than
+# the nibble-wise table of the FIT SDK
+_CRC_TABLE = _crc_table()
+
+
+def fit_crc(data: bytes, crc: int = 0) -> int:
+    table = _CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class _MessageType:
+    """
+    Layout of one FIT message: its definition message and a packer for
+    the data messages. Fields are (field number, base type, scale).
+    """
+
+    def __init__(
+        self,
+        local_type: int,
+        global_number: int,
+        fields: List[Tuple[int, tuple, int]],
+    ):
+        self.fields = fields
+        self.definition = struct.pack(
+            "<BBBHB", 0x40 | local_type, 0, 0, global_number, len(fields)
+        ) + b"".join(
+            struct.pack("<BBB", number, struct.calcsize(base[0]), base[1])
+            for number, base, _ in fields
+        )
+        self.header = local_type
+        self.struct = struct.Struct(
+            "<B" + "".join(base[0] for _, base, _ in fields)
+        )
+        self.limits = [
+            (scale, base[2], 2 ** (8 * struct.calcsize(base[0])) - 1)
+            for _, base, scale in fields
+        ]
+
+    def pack(self, values: tuple) -> bytes:
+        encoded = []
+        for value, (scale, invalid, maximum) in zip(values, self.limits):
+            if value is None:
+                encoded.append(invalid)
+                continue
+            value = round(value * scale)
+            # Out of range values can't be stored, so they are left unset
+            encoded.append(value if 0 <= value < maximum else invalid)
+        return self.struct.pack(self.header, *encoded)
+
+
+_FILE_ID = _MessageType(
+    0,
+    0,
+    [
+        (0, _ENUM, 1),  # type
+        (1, _UINT16, 1),  # manufacturer
+        (2, _UINT16, 1),  # product
+        (3, _UINT32Z, 1),  # serial_number
+        (4, _UINT32, 1),  # time_created
+    ],
+)
+_EVENT = _MessageType(
+    1,
+    21,
+    [
+        (253, _UINT32, 1),  # timestamp
+        (0, _ENUM, 1),  # event
+        (1, _ENUM, 1),  # event_type
+    ],
+)
+_RECORD = _MessageType(
+    2,
+    20,
+    [
+        (253, _UINT32, 1),  # timestamp
+        (5, _UINT32, 100),  # distance, m
+        (3, _UINT8, 1),  # heart_rate, bpm
+        (4, _UINT8, 1),  # cadence, rpm
+        (6, _UINT16, 1000),  # speed, m/s
+        (7, _UINT16, 1),  # power, W
+    ],
+)
+_LAP = _MessageType(
+    3,
+    19,
+    [
+        (253, _UINT32, 1),  # timestamp
+        (254, _UINT16, 1),  # message_index
+        (0, _ENUM, 1),  # event
+        (1, _ENUM, 1),  # event_type
+        (2, _UINT32, 1),  # start_time
+        (7, _UINT32, 1000),  # total_elapsed_time, s
+        (8, _UINT32, 1000),  # total_timer_time, s
+        (9, _UINT32, 100),  # total_distance, m
+        (11, _UINT16, 1),  # total_calories, kcal
+        (13, _UINT16, 1000),  # avg_speed, m/s
+        (14, _UINT16, 1000),  # max_speed, m/s
+        (15, _UINT8, 1),  # avg_heart_rate
+        (16, _UINT8, 1),  # max_heart_rate
+        (17, _UINT8, 1),  # avg_cadence
+        (18, _UINT8, 1),  # max_cadence
+        (19, _UINT16, 1),  # avg_power, W
+        (20, _UINT16, 1),  # max_power, W
+        (23, _ENUM, 1),  # intensity
+        (24, _ENUM, 1),  # lap_trigger
+        (25, _ENUM, 1),  # sport
+    ],
+)
+_SESSION = _MessageType(
+    4,
+    18,
+    [
+        (253, _UINT32, 1),  # timestamp
+        (254, _UINT16, 1),  # message_index
+        (0, _ENUM, 1),  # event
+        (1, _ENUM, 1),  # event_type
+        (2, _UINT32, 1),  # start_time
+        (5, _ENUM, 1),  # sport
+        (6, _ENUM, 1),  # sub_sport
+        (7, _UINT32, 1000),  # total_elapsed_time, s
+        (8, _UINT32, 1000),  # total_timer_time, s
+        (9, _UINT32, 100),  # total_distance, m
+        (11, _UINT16, 1),  # total_calories, kcal
+        (14, _UINT16, 1000),  # avg_speed, m/s
+        (15, _UINT16, 1000),  # max_speed, m/s
+        (16, _UINT8, 1),  # avg_heart_rate
+        (17, _UINT8, 1),  # max_heart_rate
+        (18, _UINT8, 1),  # avg_cadence
+        (19, _UINT8, 1),  # max_cadence
+        (20, _UINT16, 1),  # avg_power, W
+        (21, _UINT16, 1),  # max_power, W
+        (25, _UINT16, 1),  # first_lap_index
+        (26, _UINT16, 1),  # num_laps
+    ],
+)
+_ACTIVITY = _MessageType(
+    5,
+    34,
+    [
+        (253, _UINT32, 1),  # timestamp
+        (0, _UINT32, 1000),  # total_timer_time, s
+        (1, _UINT16, 1),  # num_sessions
+        (2, _ENUM, 1),  # type
+        (3, _ENUM, 1),  # event
+        (4, _ENUM, 1),  # event_type
+        (5, _UINT32, 1),  # local_timestamp
+    ],
+)
+
+
+class _Stats:
+    """
+    Running averages and maxima of the record fields of a lap or session.
+    """
+
+    def __init__(self):
+        # [sum, count, max] for speed, heart rate, cadence, power
+        self.values = [[0, 0, None] for _ in range(4)]
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.last_distance = None
+
+    def add(
+        self,
+        timestamp: int,
+        distance: Optional[float],
+        values: Tuple[Optional[float], ...],
+    ) -> None:
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.last_timestamp = timestamp
+        if distance is not None:
+            self.last_distance = distance
+        for value, stat in zip(values, self.values):
+            if value is not None:
+                stat[0] += value
+                stat[1] += 1
+                if stat[2] is None or value > stat[2]:
+                    stat[2] = value
+
+    def averages_and_maxima(self) -> List[Optional[float]]:
+        result = []
+        for total, count, maximum in self.values:
+            result.append(total / count if count else None)
+            result.append(maximum)
+        return result
+
+
+class FitActivityEncoder:
+    """
+    Writes a FIT activity file from a stream of sessions, laps and records:
+    start_session(), start_lap(), record()..., end_lap(), ..., end_session(),
+    then getvalue(). Lap totals are taken as given; session totals are the
+    sums of their laps.
+    """
+
+    def __init__(self):
+        self._body = bytearray()
+        self._defined = set()
+        self._time_created = None
+        self._lap_index = 0
+        self._session_index = 0
+        self._sessions_timer_time = 0.0
+        self._last_timestamp = None
+        self._session = None
+        self._lap = None
+
+    def _write(self, message: _MessageType, *values) -> None:
+        if message not in self._defined:
+            self._body += message.definition
+            self._defined.add(message)
+        self._body += message.pack(values)
+
+    def start_session(self, sport: int = SPORT_GENERIC) -> None:
+        self._session = {
+            "sport": sport,
+            "start_time": None,
+            "first_lap_index": self._lap_index,
+            "timer_time": 0.0,
+            "distance": None,
+            "calories": None,
+            "stats": _Stats(),
+        }
+
+    def start_lap(self, start_time: Optional[int]) -> None:
+        """
+        :param start_time: FIT timestamp of the lap start, see fit_timestamp().
+        """
+        self._lap = {"start_time": start_time, "stats": _Stats()}
+        if self._session["start_time"] is None:
+            self._session["start_time"] = start_time
+
+    def record(
+        self,
+        timestamp: int,
+        distance: float = None,
+        heart_rate: float = None,
+        cadence: float = None,
+        speed: float = None,
+        power: float = None,
+    ) -> None:
+        """
+        Add a record (trackpoint). Missing values are passed as None.
+        """
+        if self._session["stats"].first_timestamp is None:
+            self._write(_EVENT, timestamp, _EVENT_TIMER, _EVENT_TYPE_START)
+            if self._session["start_time"] is None:
+                self._session["start_time"] = timestamp
+        if self._time_created is None:
+            self._time_created = timestamp
+        self._write(
+            _RECORD, timestamp, distance, heart_rate, cadence, speed, power
+        )
+        values = (speed, heart_rate, cadence, power)
+        self._lap["stats"].add(timestamp, distance, values)
+        self._session["stats"].add(timestamp, distance, values)
+        self._last_timestamp = timestamp
+
+    def end_lap(
+        self,
+        total_timer_time: float = None,
+        total_distance: float = None,
+        total_calories: float = None,
+        intensity: int = None,
+        lap_trigger: int = None,
+    ) -> None:
+        """
+        Write the lap with its totals from the source file. Missing totals are
+        taken from the records of the lap.
+        """
+        lap, session = self._lap, self._session
+        stats = lap["stats"]
+        start_time = lap["start_time"]
+        if start_time is None:
+            start_time = stats.first_timestamp
+        end_time = stats.last_timestamp
+        if end_time is None:
+            # A lap without records
+            end_time = start_time
+            if start_time is not None and total_timer_time is not None:
+                end_time = start_time + round(total_timer_time)
+        elapsed = (
+            end_time - start_time
+            if start_time is not None and end_time is not None
+            else None
+        )
+        if total_timer_time is None:
+            total_timer_time = elapsed
+        if total_distance is None:
+            total_distance = stats.last_distance
+        (
+            avg_speed,
+            max_speed,
+            avg_heart_rate,
+            max_heart_rate,
+            avg_cadence,
+            max_cadence,
+            avg_power,
+            max_power,
+        ) = stats.averages_and_maxima()
+        self._write(
+            _LAP,
+            end_time,
+            self._lap_index,
+            _EVENT_LAP,
+            _EVENT_TYPE_STOP,
+            start_time,
+            elapsed,
+            total_timer_time,
+            total_distance,
+            total_calories,
+            avg_speed,
+            max_speed,
+            avg_heart_rate,
+            max_heart_rate,
+            avg_cadence,
+            max_cadence,
+            avg_power,
+            max_power,
+            intensity,
+            lap_trigger,
+            session["sport"],
+        )
+        self._lap_index += 1
+        if end_time is not None:
+            self._last_timestamp = max(self._last_timestamp or 0, end_time)
+            session["end_time"] = end_time
+        if total_timer_time is not None:
+            session["timer_time"] += total_timer_time
+        if total_distance is not None:
+            session["distance"] = (session["distance"] or 0) + total_distance
+        if total_calories is not None:
+            session["calories"] = (session["calories"] or 0) + total_calories
+        self._lap = None
+
+    def end_session(self) -> None:
+        session = self._session
+        stats = session["stats"]
+        start_time = session["start_time"]
+        end_time = session.get("end_time", stats.last_timestamp)
+        if stats.first_timestamp is not None:
+            self._write(
+                _EVENT,
+                stats.last_timestamp,
+                _EVENT_TIMER,
+                _EVENT_TYPE_STOP_ALL,
+            )
+        if self._time_created is None:
+            self._time_created = start_time
+        (
+            avg_speed,
+            max_speed,
+            avg_heart_rate,
+            max_heart_rate,
+            avg_cadence,
+            max_cadence,
+            avg_power,
+            max_power,
+        ) = stats.averages_and_maxima()
+        self._write(
+            _SESSION,
+            end_time,
+            self._session_index,
+            _EVENT_SESSION,
+            _EVENT_TYPE_STOP,
+            start_time,
+            session["sport"],
+            0,  # sub_sport: generic
+            (
+                end_time - start_time
+                if start_time is not None and end_time is not None
+                else None
+            ),
+            session["timer_time"],
+            session["distance"],
+            session["calories"],
+            avg_speed,
+            max_speed,
+            avg_heart_rate,
+            max_heart_rate,
+            avg_cadence,
+            max_cadence,
+            avg_power,
+            max_power,
+            session["first_lap_index"],
+            self._lap_index - session["first_lap_index"],
+        )
+        self._session_index += 1
+        self._sessions_timer_time += session["timer_time"]
+        self._session = None
+
+    def getvalue(self) -> bytes:
+        """
+        :return: the complete FIT file.
+        """
+        if self._session_index:
+            self._write(
+                _ACTIVITY,
+                self._last_timestamp,
+                self._sessions_timer_time,
+                self._session_index,
+                0,  # type: manual
+                _EVENT_ACTIVITY,
+                _EVENT_TYPE_STOP,
+                self._last_timestamp,
+            )
+        # The file_id message must come first, but its time is known last
+        body = (
+            _FILE_ID.definition
+            + _FILE_ID.pack(
+                (
+                    _FILE_ACTIVITY,
+                    _MANUFACTURER_DEVELOPMENT,
+                    0,
+                    None,
+                    self._time_created,
+                )
+            )
+            + self._body
+        )
+        header = struct.pack("<BBHI4s", 14, 0x20, 2132, len(body), b".FIT")
+        header += struct.pack("<H", fit_crc(header))
+        data = header + body
+        return data + struct.pack("<H", fit_crc(data))
+
+
+def fit_timestamp(unix_time: float) -> int:
+    """
+    :return: FIT timestamp (seconds since 1989-12-31 00:00:00 UTC).
+    """
+    return int(unix_time) - FIT_EPOCH
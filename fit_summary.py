@@ -0,0 +1,177 @@
+import logging
+import struct
+from datetime import datetime, timedelta
+from typing import ByteString, Dict
+
+logger = logging.getLogger(__name__)
+
+# FIT timestamps count seconds from 1989-12-31 00:00:00 UTC
+FIT_EPOCH = 631065600
+SESSION_MESSAGE = 18
+# Session fields we need: start_time, total_timer_time, total_distance
+_START_TIME = 2
+_TOTAL_TIMER_TIME = 8
+_TOTAL_DISTANCE = 9
+_SESSION_FIELDS = frozenset({_START_TIME, _TOTAL_TIMER_TIME, _TOTAL_DISTANCE})
+_UINT32_INVALID = 0xFFFFFFFF
+
+
+class _UnusualFitError(Exception):
+    """
+    The scanner met something it doesn't handle; fit_tool takes over.
+    """
+
+
+def scan_fit_session(data: bytes) -> Dict[int, int]:
+    """
+    Find the first session message of a FIT file without decoding the rest.
+    Only record headers and definition messages are read; data messages are
+    skipped by the sizes from their definitions.
+    :param data: FIT data as bytes.
+    :return: raw values of the session fields we need, by field number.
+    :raise _UnusualFitError: if the file is not a plain FIT file the scanner
+        understands.
+    """
+    if len(data) < 12:
+        raise _UnusualFitError("File is too short")
+    header_size = data[0]
+    if header_size not in (12, 14) or data[8:12] != b".FIT":
+        raise _UnusualFitError("No FIT file header")
+    (data_size,) = struct.unpack_from("<I", data, 4)
+    end = header_size + data_size
+    if end > len(data):
+        raise _UnusualFitError("File is truncated")
+    try:
+        return _scan_messages(data, header_size, end)
+    except (IndexError, struct.error) as e:
+        # A definition cut off by the end of the data
+        raise _UnusualFitError(f"Truncated message: {e}") from e
+
+
+def _scan_messages(data: bytes, position: int, end: int) -> Dict[int, int]:
+    # Local message type -> (global message number, size, byte order,
+    # [(field number, offset, size)] of the session fields we need)
+    definitions = {}
+    while position < end:
+        header = data[position]
+        position += 1
+        if header & 0x80:
+            # Compressed timestamp header of a data message
+            local_type = (header >> 5) & 0x03
+        elif header & 0x40:
+            # Definition message
+            if position + 5 > end:
+                raise _UnusualFitError("Truncated definition message")
+            architecture = data[position + 1]
+            if architecture > 1:
+                raise _UnusualFitError(f"Unknown architecture {architecture}")
+            byte_order = ">" if architecture else "<"
+            (global_number,) = struct.unpack_from(
+                byte_order + "H", data, position + 2
+            )
+            field_count = data[position + 4]
+            position += 5
+            size = 0
+            fields = []
+            for _ in range(field_count):
+                number, field_size = data[position], data[position + 1]
+                if (
+                    global_number == SESSION_MESSAGE
+                    and number in _SESSION_FIELDS
+                ):
+                    fields.append((number, size, field_size))
+                size += field_size
+                position += 3
+            if header & 0x20:
+                # Developer data fields
+                developer_count = data[position]
+                position += 1
+                for _ in range(developer_count):
+                    size += data[position + 1]
+                    position += 3
+            if position > end:
+                raise _UnusualFitError("Truncated definition message")
+            definitions[header & 0x0F] = (
+                global_number,
+                size,
+                byte_order,
+                fields,
+            )
+            continue
+        else:
+            local_type = header & 0x0F
+
+        definition = definitions.get(local_type)
+        if definition is None:
+            raise _UnusualFitError(f"Undefined local message {local_type}")
+        global_number, size, byte_order, fields = definition
+        if position + size > end:
+            raise _UnusualFitError("Truncated data message")
+        if global_number == SESSION_MESSAGE:
+            values = {}
+            for number, offset, field_size in fields:
+                if field_size != 4:
+                    raise _UnusualFitError(
+                        f"Unexpected size of field {number}"
+                    )
+                (value,) = struct.unpack_from(
+                    byte_order + "I", data, position + offset
+                )
+                if value == _UINT32_INVALID:
+                    raise _UnusualFitError(f"Field {number} is not set")
+                values[number] = value
+            if len(values) != len(_SESSION_FIELDS):
+                raise _UnusualFitError("Session fields are missing")
+            return values
+        position += size
+    raise _UnusualFitError("No session message")
+
+
+def _format_summary(
+    start_time_ms: float, total_timer_time: float, total_distance: float
+) -> Dict:
+    summary = {}
+    summary["activity_datetime"] = datetime.fromtimestamp(
+        start_time_ms / 1000
+    ).strftime("%d %b @ %H:%M UTC")
+    total_seconds_rounded = round(total_timer_time)
+    summary["total_time"] = str(timedelta(seconds=total_seconds_rounded))
+    distance_km = float(total_distance) / 1000
+    summary["total_distance_km"] = f"{distance_km:.2f}"
+    return summary
+
+
+def _extract_with_fit_tool(input_data: ByteString) -> Dict:
+    # Full decode, slow on long recordings
+    from fit_tool.fit_file import FitFile
+    from fit_tool.profile.messages.session_message import SessionMessage
+
+    app_fit = FitFile.from_bytes(input_data)
+    for record in app_fit.records:
+        m = record.message
+        if isinstance(m, SessionMessage):
+            return _format_summary(
+                m.start_time, m.total_timer_time, m.total_distance
+            )
+    return {}
+
+
+def extract_fit_summary(input_data: ByteString) -> Dict:
+    """
+    Extracts summary data from the first session of a FIT file.
+    Plain files are scanned for the session message only; anything unusual
+    is decoded in full by fit_tool.
+    :param input_data: FIT data as bytes.
+    :return: Dictionary with summary data (empty if there is no session).
+    """
+    data = bytes(input_data)
+    try:
+        values = scan_fit_session(data)
+    except _UnusualFitError as e:
+        logger.info(f"Falling back to fit_tool: {e}")
+        return _extract_with_fit_tool(data)
+    return _format_summary(
+        (values[_START_TIME] + FIT_EPOCH) * 1000,
+        values[_TOTAL_TIMER_TIME] / 1000,
+        values[_TOTAL_DISTANCE] / 100,
+    )
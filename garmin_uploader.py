@@ -0,0 +1,96 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Optional
+
+import garth
+from requests import Response
+
+from fair_scheduler import FairScheduler
+from metrics import GARMIN_RESPONSES, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def http_response(error: Exception) -> Optional[Response]:
+    """
+    :return: the HTTP response of a failed garth request, if there was one.
+    """
+    # garth wraps the requests' HTTPError, which holds the response
+    return getattr(getattr(error, "error", None), "response", None)
+
+
+def http_status(error: Exception) -> Optional[int]:
+    """
+    :return: the HTTP status of a failed garth request, or None if the request
+        failed without a response (e.g. a connection error).
+    """
+    return getattr(http_response(error), "status_code", None)
+
+
+class GarminUploader:
+    """
+    Runs blocking garth calls (login, upload) on a bounded thread pool,
+    so a slow Garmin response doesn't freeze the bot's event loop.
+    """
+
+    def __init__(self, max_workers: int = 4, per_user_limit: int = None):
+        """
+        :param max_workers: maximum number of Garmin requests in flight at once.
+        :param per_user_limit: how many uploads of one user may run at once
+            (default: half of max_workers); uploads are shared round-robin
+            between users.
+        """
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="garmin"
+        )
+        self.scheduler = FairScheduler(
+            max_workers,
+            per_user_limit or max(1, max_workers // 2),
+            name="upload",
+        )
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run a blocking function on the uploader's thread pool and await its result.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def upload(
+        self, g_client: garth.Client, file_io: BinaryIO, user_id: int = None
+    ) -> Any:
+        """
+        Upload a file to Garmin Connect.
+        :param g_client: authorized garth client of the user.
+        :param file_io: file-like object with a `name` attribute.
+        :param user_id: user the upload is scheduled for.
+        :return: Garmin's response to the upload.
+        """
+        with STAGE_SECONDS.time(stage="upload"):
+            try:
+                async with self.scheduler.slot(user_id):
+                    response = await self.run(g_client.upload, file_io)
+            except garth.exc.GarthHTTPError as e:
+                GARMIN_RESPONSES.inc(status=str(http_status(e) or "error"))
+                raise
+            except Exception:
+                GARMIN_RESPONSES.inc(status="error")
+                raise
+        GARMIN_RESPONSES.inc(status="2xx")
+        return response
+
+    async def login(
+        self, g_client: garth.Client, email: str, password: str
+    ) -> Any:
+        """
+        Log in to Garmin Connect with the given credentials.
+        """
+        return await self.run(g_client.login, email, password)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
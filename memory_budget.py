@@ -0,0 +1,194 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+MEMORY_BUDGET_BYTES = Gauge(
+    "tcx_bot_memory_budget_bytes",
+    "Memory budget for files in flight, in bytes (0: unlimited).",
+)
+MEMORY_RESERVED_BYTES = Gauge(
+    "tcx_bot_memory_reserved_bytes",
+    "Estimated memory held by files in flight, in bytes.",
+)
+MEMORY_WAITING = Gauge(
+    "tcx_bot_memory_waiting",
+    "Jobs waiting for their share of the memory budget.",
+)
+MEMORY_REJECTIONS = Counter(
+    "tcx_bot_memory_rejections",
+    "Jobs rejected by the memory budget, by reason.",
+    ["reason"],
+)
+
+# Copies of a job's data that may be held at once: the input in the bot and
+# in its conversion worker (unless the worker reads it from disk), and the
+# output in the worker, on its way back and in the bot
+INPUT_COPIES = 2
+OUTPUT_COPIES = 3
+# Size of the output per input byte; files uploaded as is count fully
+OUTPUT_RATIO = {"tcx": 1.0, "fit": 0.1}
+
+
+def estimate_footprint(
+    size: int, output_format: Optional[str] = "tcx", on_disk: bool = False
+) -> int:
+    """
+    Estimate the peak memory of processing a file. The converter streams,
+    so what counts are the copies of the input and the output.
+    :param size: size of the file (of a ZIP entry: uncompressed).
+    :param output_format: "tcx" or "fit", or None if it isn't converted.
+    :param on_disk: whether the input stays on disk instead of memory.
+    :return: estimated bytes.
+    """
+    input_copies = 0 if on_disk else INPUT_COPIES
+    output = size * OUTPUT_RATIO.get(output_format, 1.0)
+    return int(size * input_copies + output * OUTPUT_COPIES)
+
+
+class MemoryBudgetError(Exception):
+    """
+    Raised when a job doesn't get its share of the memory budget.
+    """
+
+
+class JobTooLargeError(MemoryBudgetError):
+    """
+    Raised for a job that needs more than the whole budget.
+    """
+
+
+class MemoryBudgetTimeout(MemoryBudgetError):
+    """
+    Raised when a job waited too long for the memory held by other jobs.
+    """
+
+
+class Reservation:
+    """
+    Memory reserved for a job; give it back with release() or by using the
+    reservation as a context manager.
+    """
+
+    def __init__(self, budget: "MemoryBudget", amount: int):
+        self.budget = budget
+        self.amount = amount
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.budget._release(self.amount)
+
+    def __enter__(self) -> "Reservation":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class MemoryBudget:
+    """
+    Admission control for files in flight. Every job reserves its estimated
+    footprint before its data is loaded; jobs that don't fit wait in FIFO
+    order, so a big file isn't starved by a stream of small ones. Jobs that
+    need more than the whole budget, or wait too long, are rejected, which
+    keeps the memory use predictable under bursts instead of running out.
+    """
+
+    def __init__(self, capacity: Optional[int], timeout: float = 60):
+        """
+        :param capacity: budget in bytes, or None for unlimited (usage is
+            still tracked).
+        :param timeout: seconds a job may wait for its share before it is
+            rejected with MemoryBudgetTimeout.
+        """
+        self.capacity = capacity
+        self.timeout = timeout
+        self.used = 0
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        MEMORY_BUDGET_BYTES.set(capacity or 0)
+
+    @property
+    def waiting(self) -> int:
+        """
+        :return: number of jobs waiting for memory.
+        """
+        return len(self._waiters)
+
+    def _fits(self, amount: int) -> bool:
+        return self.capacity is None or self.used + amount <= self.capacity
+
+    def _update_metrics(self) -> None:
+        MEMORY_RESERVED_BYTES.set(self.used)
+        MEMORY_WAITING.set(len(self._waiters))
+
+    def _dispatch(self) -> None:
+        # Strictly in order: the first waiter blocks the ones behind it
+        while self._waiters:
+            amount, waiter = self._waiters[0]
+            if waiter.done():
+                # Cancelled, its task cleans up when it wakes up
+                self._waiters.popleft()
+                continue
+            if not self._fits(amount):
+                break
+            self._waiters.popleft()
+            self.used += amount
+            waiter.set_result(None)
+        self._update_metrics()
+
+    def _release(self, amount: int) -> None:
+        self.used -= amount
+        self._dispatch()
+
+    async def reserve(self, amount: int) -> Reservation:
+        """
+        Wait until the amount fits into the budget and reserve it.
+        :param amount: estimated bytes, see estimate_footprint().
+        :raise JobTooLargeError: if the amount exceeds the whole budget.
+        :raise MemoryBudgetTimeout: if other jobs hold the memory too long.
+        """
+        amount = max(0, int(amount))
+        if self.capacity is not None and amount > self.capacity:
+            MEMORY_REJECTIONS.inc(reason="too_large")
+            raise JobTooLargeError(
+                f"Job needs {amount} bytes, the budget is {self.capacity}"
+            )
+        if not self._waiters and self._fits(amount):
+            self.used += amount
+            self._update_metrics()
+            return Reservation(self, amount)
+
+        logger.info(
+            f"Waiting for {amount} bytes of memory: {self.used} of "
+            f"{self.capacity} reserved, {len(self._waiters)} jobs ahead"
+        )
+        entry = (amount, asyncio.get_running_loop().create_future())
+        self._waiters.append(entry)
+        self._update_metrics()
+        try:
+            await asyncio.wait_for(entry[1], self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            waiter = entry[1]
+            if waiter.done() and not waiter.cancelled():
+                # The memory was granted just before
+                if isinstance(e, asyncio.TimeoutError):
+                    return Reservation(self, amount)
+                self._release(amount)
+                raise
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+            # Jobs behind this one may fit now
+            self._dispatch()
+            if isinstance(e, asyncio.TimeoutError):
+                MEMORY_REJECTIONS.inc(reason="timeout")
+                raise MemoryBudgetTimeout(
+                    f"No memory for {amount} bytes within {self.timeout} s"
+                ) from None
+            raise
+        return Reservation(self, amount)
@@ -0,0 +1,322 @@
+import logging
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, List, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+def _escape(value: str) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: "Registry" = None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing counter.
+    """
+
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        self._values = {}
+        super().__init__(*args, **kwargs)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_total{labels} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """
+    Value that can go up and down.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        self._values = {}
+        super().__init__(*args, **kwargs)
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+class _Timer:
+    def __init__(self, histogram: "Histogram", labels: Dict[str, str]):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self) -> "_Timer":
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._histogram.observe(
+            time.perf_counter() - self._started, **self._labels
+        )
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (e.g. durations in seconds) in cumulative buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs
+    ):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}  # labels -> [bucket counts, sum, count]
+        super().__init__(*args, **kwargs)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[0][i] += 1
+                break
+        data[1] += value
+        data[2] += 1
+
+    def time(self, **labels) -> _Timer:
+        """
+        Context manager that observes the duration of its block in seconds.
+        Works around awaits too, it measures wall-clock time.
+        """
+        self._key(labels)
+        return _Timer(self, labels)
+
+    def count(self, **labels) -> int:
+        data = self._values.get(self._key(labels))
+        return data[2] if data else 0
+
+    def samples(self) -> Iterable[str]:
+        names = self.labelnames + ("le",)
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(names, key + (_format_value(bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Registry:
+    """
+    Collection of metrics rendered together in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: _Metric) -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Metrics of the bot
+STAGE_SECONDS = Histogram(
+    "tcx_bot_stage_seconds",
+    "Time spent in each stage of file processing.",
+    ["stage"],
+)
+TELEGRAM_REQUEST_SECONDS = Histogram(
+    "tcx_bot_telegram_request_seconds",
+    "Duration of Telegram Bot API requests.",
+    ["method"],
+)
+FILES = Counter(
+    "tcx_bot_files",
+    "Files received, by kind.",
+    ["kind"],
+)
+FILE_BYTES = Counter(
+    "tcx_bot_file_bytes",
+    "Size of the received files in bytes, by kind.",
+    ["kind"],
+)
+FAILURES = Counter(
+    "tcx_bot_failures",
+    "Failed files, by kind and failure type.",
+    ["kind", "type"],
+)
+CONVERSIONS_IN_FLIGHT = Gauge(
+    "tcx_bot_conversions_in_flight",
+    "Conversion jobs running or waiting for a worker process.",
+)
+GARMIN_RESPONSES = Counter(
+    "tcx_bot_garmin_responses",
+    "Responses to Garmin Connect requests, by HTTP status.",
+    ["status"],
+)
+
+
+# Telegram methods that answer the user
+REPLY_METHODS = frozenset({"SendMessage", "SendDocument", "EditMessageText"})
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """
+    Bot session middleware that times every Telegram Bot API request.
+    Replies to the user are also counted as the "reply" stage.
+    """
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: "Bot",
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            elapsed = time.perf_counter() - started
+            TELEGRAM_REQUEST_SECONDS.observe(elapsed, method=name)
+            if name in REPLY_METHODS:
+                STAGE_SECONDS.observe(elapsed, stage="reply")
+
+
+async def start_metrics_server(
+    host: str, port: int, registry: Registry = REGISTRY
+) -> web.AppRunner:
+    """
+    Serve the metrics at http://host:port/metrics.
+    :return: AppRunner; call its cleanup() on shutdown.
+    """
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(
+            text=registry.render(),
+            content_type="text/plain",
+            headers={"X-Content-Type-Options": "nosniff"},
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics are served at http://{host}:{port}/metrics")
+    return runner
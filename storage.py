@@ -0,0 +1,163 @@
+import asyncio
+import fnmatch
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (
+    BaseStorage,
+    DefaultKeyBuilder,
+    KeyBuilder,
+    StateType,
+    StorageKey,
+)
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+def dump_fsm_data(data: Dict[str, Any]) -> str:
+    """
+    JSON encoder for FSM data, for any storage keeping it outside the process.
+
+    :raise TypeError: the data holds a value JSON can't encode.
+    """
+    # Only plain values may be kept in FSM data, so that any process can
+    # load them; live objects like garth clients belong in GarminClientPool
+    try:
+        return json.dumps(data)
+    except TypeError as e:
+        raise TypeError(f"FSM data must be JSON serializable: {e}") from None
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage in an SQLite database. Bot processes on the same machine
+    can share the database file; data must be JSON serializable.
+    Queries run in a dedicated thread, so waiting for another process's
+    lock doesn't block the event loop.
+    """
+
+    def __init__(self, db_path: str, key_builder: Optional[KeyBuilder] = None):
+        """
+        :param db_path: path of the database, created if it doesn't exist.
+        :param key_builder: builds the row keys from storage keys.
+        """
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True)
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="fsm-storage"
+        )
+        self._db = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}'
+            )
+            """)
+        self._db.commit()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _upsert(self, key: str, column: str, value: Any) -> None:
+        self._db.execute(
+            f"INSERT INTO fsm (key, {column}) VALUES (?, ?)"
+            f" ON CONFLICT (key) DO UPDATE SET {column} = excluded.{column}",
+            (key, value),
+        )
+        self._db.commit()
+
+    def _select(self, key: str, column: str) -> Optional[str]:
+        row = self._db.execute(
+            f"SELECT {column} FROM fsm WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    async def set_state(
+        self, key: StorageKey, state: StateType = None
+    ) -> None:
+        await self._run(
+            self._upsert,
+            self.key_builder.build(key),
+            "state",
+            _state_name(state),
+        )
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._run(
+            self._select, self.key_builder.build(key), "state"
+        )
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._run(
+            self._upsert,
+            self.key_builder.build(key),
+            "data",
+            dump_fsm_data(data),
+        )
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        data = await self._run(
+            self._select, self.key_builder.build(key), "data"
+        )
+        return json.loads(data) if data else {}
+
+    async def close(self) -> None:
+        await self._run(self._db.close)
+        self._executor.shutdown()
+
+
+class LocalRedis:
+    """
+    In-process stand-in for the subset of redis.asyncio.Redis used by
+    RedisTokenStore and aiogram's RedisStorage, for local testing without a
+    server.
+    Like Redis, it stores bytes.
+    """
+
+    def __init__(self):
+        self._values: Dict[str, Tuple[bytes, Optional[float]]] = {}
+
+    async def get(self, name: str) -> Optional[bytes]:
+        value, expires_at = self._values.get(name, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._values[name]
+            return None
+        return value
+
+    async def set(self, name: str, value: Any, ex: int = None) -> bool:
+        if isinstance(value, str):
+            value = value.encode()
+        expires_at = time.monotonic() + ex if ex else None
+        self._values[name] = (value, expires_at)
+        return True
+
+    async def delete(self, *names: str) -> int:
+        return sum(self._values.pop(name, None) is not None for name in names)
+
+    async def scan_iter(self, match: str = None) -> AsyncIterator[bytes]:
+        for name in list(self._values):
+            if (match is None or fnmatch.fnmatchcase(name, match)) and (
+                await self.get(name) is not None
+            ):
+                yield name.encode()
+
+    async def aclose(self, close_connection_pool: bool = None) -> None:
+        pass
+
+
+def redis_from_url(url: str):
+    """
+    :return: redis.asyncio client for the URL, e.g. redis://localhost:6379/0.
+        The redis package is only needed when Redis is used.
+    """
+    from redis.asyncio import Redis
+
+    return Redis.from_url(url)
@@ -0,0 +1,54 @@
+import random
+import re
+
+import pytest
+
+from activity_model import ActivityColumns, _numpy_stats, _python_stats
+from benchmarks.synthetic import generate_tcx
+from convert_all_tcx import convert_tcx_in_memory
+
+STATS = [_numpy_stats, _python_stats]
+
+
+def columns_of(points):
+    columns = ActivityColumns()
+    for time, power in points:
+        columns.append(time, None, None, None, None, power, None)
+    return columns
+
+
+@pytest.mark.parametrize("stats", STATS)
+def test_points_a_year_apart_have_no_normalized_power(stats):
+    columns = columns_of([(0, 200), (365 * 24 * 3600, 210)])
+    assert "normalized_power" not in stats(columns)
+
+
+@pytest.mark.parametrize("stats", STATS)
+def test_pause_splits_the_rolling_average(stats):
+    # Two rides at constant power a day apart: nothing is interpolated
+    # across the pause, and both rides weigh the same
+    points = [(t, 200) for t in range(600)]
+    points += [(86400 + t, 300) for t in range(600)]
+    expected = ((200**4 + 300**4) / 2) ** 0.25
+    assert stats(columns_of(points))["normalized_power"] == round(expected)
+
+
+def test_implementations_agree_on_gaps():
+    rng = random.Random(0)
+    points = []
+    time = 0
+    for _ in range(2000):
+        time += rng.choice([1, 1, 1, 2, 5, 400])
+        points.append((time, rng.uniform(100, 300)))
+    columns = columns_of(points)
+    assert _numpy_stats(columns) == _python_stats(columns)
+
+
+def test_tcx_spanning_decades_converts():
+    data = generate_tcx(2)
+    times = re.findall(rb"<Time>([^<]*)</Time>", data)
+    data = data.replace(times[0], b"2000-01-01T00:00:00.000Z")
+    data = data.replace(times[1], b"2024-01-01T00:00:00.000Z")
+    _, summary = convert_tcx_in_memory(data)
+    assert "normalized_power" not in summary
+    assert summary["max_power"] > 0
@@ -0,0 +1,123 @@
+import csv
+import os
+import subprocess
+import sys
+import zipfile
+
+from benchmarks.synthetic import generate_tcx
+from convert_all_tcx import collect_jobs
+
+SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "convert_all_tcx.py",
+)
+
+
+def run(*args):
+    return subprocess.run(
+        [sys.executable, SCRIPT, *args, "--workers", "1"],
+        capture_output=True,
+        text=True,
+    )
+
+
+def read_rows(path):
+    with open(path, newline="") as f:
+        return {row["output"]: row for row in csv.DictReader(f)}
+
+
+def make_inputs(tmp_path):
+    inputs = tmp_path / "exports"
+    (inputs / "old").mkdir(parents=True)
+    (inputs / "ride.tcx").write_bytes(generate_tcx(60))
+    with zipfile.ZipFile(inputs / "old" / "archive.zip", "w") as zip_ref:
+        zip_ref.writestr("rides/a.tcx", generate_tcx(60))
+        zip_ref.writestr("notes.txt", "")
+    return inputs
+
+
+def test_converts_files_and_archive_members(tmp_path):
+    inputs = make_inputs(tmp_path)
+    out = tmp_path / "out"
+    manifest = str(tmp_path / "manifest.csv")
+
+    result = run(str(inputs), "-o", str(out), "--manifest", manifest)
+
+    assert result.returncode == 0, result.stderr
+    ride = str(out / "converted_ride.tcx")
+    member = str(out / "old" / "archive" / "rides" / "converted_a.tcx")
+    rows = read_rows(manifest)
+    assert sorted(rows) == sorted([ride, member])
+    assert rows[member]["member"] == "rides/a.tcx"
+    assert {row["status"] for row in rows.values()} == {"converted"}
+    assert os.path.exists(ride) and os.path.exists(member)
+
+
+def test_up_to_date_outputs_are_skipped(tmp_path):
+    inputs = make_inputs(tmp_path)
+    out = tmp_path / "out"
+    manifest = str(tmp_path / "manifest.csv")
+    run(str(inputs), "-o", str(out), "--manifest", manifest)
+    first = read_rows(manifest)
+
+    result = run(str(inputs), "-o", str(out), "--manifest", manifest)
+
+    assert result.returncode == 0, result.stderr
+    rows = read_rows(manifest)
+    assert {row["status"] for row in rows.values()} == {"skipped"}
+    # Skipped files keep the summaries of the previous run
+    for output, row in rows.items():
+        assert row["total_time"] == first[output]["total_time"]
+
+    result = run(
+        str(inputs), "-o", str(out), "--manifest", manifest, "--force"
+    )
+    assert {row["status"] for row in read_rows(manifest).values()} == {
+        "converted"
+    }
+
+
+def test_failures_set_the_exit_code(tmp_path):
+    (tmp_path / "broken.tcx").write_bytes(b"<TrainingCenterDatabase")
+    manifest = str(tmp_path / "manifest.csv")
+
+    result = run(
+        str(tmp_path / "broken.tcx"),
+        "-o",
+        str(tmp_path / "out"),
+        "--manifest",
+        manifest,
+    )
+
+    assert result.returncode == 1
+    [row] = read_rows(manifest).values()
+    assert row["status"] == "failed" and row["error"]
+    assert not os.listdir(tmp_path / "out")
+
+    result = run(str(tmp_path / "missing"), "-o", str(tmp_path / "out"))
+    assert result.returncode == 2
+
+
+def test_archive_members_stay_in_the_output_directory(tmp_path):
+    archive = tmp_path / "in" / "arch.zip"
+    archive.parent.mkdir()
+    with zipfile.ZipFile(archive, "w") as zip_ref:
+        zip_ref.writestr("../../escaped.tcx", generate_tcx(10))
+        zip_ref.writestr(str(tmp_path / "abs.tcx"), generate_tcx(10))
+        zip_ref.writestr("C:\\rides\\win.tcx", generate_tcx(10))
+    out = tmp_path / "in" / "out"
+
+    jobs = collect_jobs([str(archive)], str(out))
+    result = run(str(archive), "-o", str(out))
+
+    assert result.returncode == 0, result.stderr
+    assert "escaped.tcx" in result.stderr
+    assert [job.member for job in jobs] == [
+        str(tmp_path / "abs.tcx"),
+        "C:\\rides\\win.tcx",
+    ]
+    for job in jobs:
+        assert job.output.startswith(str(out / "arch") + os.sep)
+        assert os.path.exists(job.output)
+    assert not list(tmp_path.glob("**/converted_escaped.tcx"))
+    assert not (tmp_path / "converted_abs.tcx").exists()
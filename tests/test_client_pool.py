@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+import garth
+from garth.auth_tokens import OAuth1Token, OAuth2Token
+
+from client_pool import GarminClientPool
+from storage import LocalRedis
+from token_store import RedisTokenStore, TokenStore
+
+
+def make_client(access_token):
+    client = garth.Client()
+    client.oauth1_token = OAuth1Token("token", "secret")
+    expires_at = int(time.time()) + 3600
+    client.oauth2_token = OAuth2Token(
+        "scope",
+        "jti",
+        "Bearer",
+        access_token,
+        "refresh",
+        3600,
+        expires_at,
+        7200,
+        expires_at + 3600,
+    )
+    return client
+
+
+class CountingTokenStore(TokenStore):
+    def __init__(self):
+        self.tokens = {}
+        self.reads = 0
+
+    async def get(self, user_id):
+        self.reads += 1
+        return self.tokens.get(user_id)
+
+    async def put(self, user_id, auth):
+        self.tokens[user_id] = auth
+
+    async def delete(self, user_id):
+        self.tokens.pop(user_id, None)
+
+    async def users(self):
+        return sorted(self.tokens)
+
+
+def test_pools_sharing_a_token_store_follow_each_other():
+    async def scenario():
+        store = RedisTokenStore(LocalRedis())
+        first = GarminClientPool(None, token_store=store)
+        second = GarminClientPool(None, token_store=store)
+        await first.put(1, make_client("first"))
+        assert (await second.get(1)).oauth2_token.access_token == "first"
+
+        # Another login on the first process replaces the tokens
+        await first.put(1, make_client("again"))
+        await second.refresh()
+        assert (await second.get(1)).oauth2_token.access_token == "again"
+
+        # /stop on the first process logs the user out of the second
+        await first.delete(1)
+        await second.refresh()
+        return len(second), await second.get(1), await store.get(1)
+
+    assert asyncio.run(scenario()) == (0, None, None)
+
+
+def test_local_token_store_is_not_reread_on_refresh():
+    async def scenario():
+        store = CountingTokenStore()
+        pool = GarminClientPool(None, token_store=store)
+        for user_id in range(10):
+            await pool.put(user_id, make_client(str(user_id)))
+        for _ in range(3):
+            await pool.refresh()
+        return len(pool), store.reads
+
+    assert asyncio.run(scenario()) == (10, 0)
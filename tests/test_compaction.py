@@ -0,0 +1,117 @@
+import random
+import xml.etree.ElementTree as ET
+
+from benchmarks.synthetic import generate_tcx
+from compaction import CHANNELS, CompactionRules, Compactor, Point
+from convert_all_tcx import convert_tcx_in_memory
+
+RULES = "duplicates,power=20,speed=0.5,distance=5,min_interval=2"
+
+
+def laps(data):
+    root = ET.fromstring(data)
+    for lap in root.iterfind(".//{*}Lap"):
+        totals = [
+            (child.tag, child.text)
+            for child in lap
+            if child.tag.rsplit("}", 1)[-1] != "Track"
+        ]
+        times = [time.text for time in lap.iterfind(".//{*}Time")]
+        yield totals, times
+
+
+def test_lap_totals_and_first_and_last_points_are_kept():
+    data = generate_tcx(900, laps=3)
+    full, full_summary = convert_tcx_in_memory(data)
+    compact, summary = convert_tcx_in_memory(
+        data, compaction=CompactionRules.parse(RULES)
+    )
+    assert summary["trackpoints"] == 900
+    assert 450 <= summary["trackpoints_removed"] < 900
+    del summary["trackpoints"], summary["trackpoints_removed"]
+    assert summary == full_summary
+
+    full_laps, compact_laps = list(laps(full)), list(laps(compact))
+    assert len(compact_laps) == 3
+    for (full_totals, full_times), (totals, times) in zip(
+        full_laps, compact_laps
+    ):
+        assert totals == full_totals
+        assert times[0] == full_times[0] and times[-1] == full_times[-1]
+        assert set(times) <= set(full_times)
+    assert len(compact) < len(full) / 2
+
+
+def ride(points, seed=0):
+    rng = random.Random(seed)
+    distance = 0.0
+    for second in range(points):
+        speed = 8 + rng.uniform(-1, 1)
+        distance += speed
+        values = (
+            distance,
+            130 + rng.randint(-3, 3),
+            85 + rng.randint(-3, 3),
+            speed,
+            200 + rng.randint(-30, 30),
+        )
+        yield Point(float(second), values, second)
+
+
+def compact(rules, points):
+    compactor = Compactor(rules)
+    kept = []
+    for point in points:
+        kept.extend(compactor.add(point))
+    kept.extend(compactor.finish_lap())
+    return kept, compactor
+
+
+def test_removed_points_stay_within_the_tolerances():
+    rules = CompactionRules.parse("power=25,speed=0.8,distance=3")
+    points = list(ride(2000))
+    kept, compactor = compact(rules, points)
+    assert kept[0] == 0 and kept[-1] == 1999
+    assert compactor.removed == len(points) - len(kept) > 500
+    tolerances = [rules.tolerances.get(channel) for channel in CHANNELS]
+    for start, stop in zip(kept, kept[1:]):
+        assert stop - start <= rules.max_gap
+        first, last = points[start], points[stop]
+        for point in points[start + 1 : stop]:
+            share = (point.time - first.time) / (last.time - first.time)
+            for a, value, b, tolerance in zip(
+                first.values, point.values, last.values, tolerances
+            ):
+                if tolerance is not None:
+                    assert abs(a + (b - a) * share - value) <= tolerance + 1e-6
+
+
+def test_channels_without_a_tolerance_must_be_present_alike():
+    points = list(ride(20))
+    # Heart rate drops out for a second: that point and the next one,
+    # where it resumes, are kept
+    gap = points[10]
+    points[10] = gap._replace(values=(gap.values[0], None) + gap.values[2:])
+    kept, _ = compact(CompactionRules.parse("power=1000,speed=10"), points)
+    assert kept == [0, 9, 10, 11, 19]
+
+
+def test_duplicates_drop_pauses():
+    moving = list(ride(10))
+    pause = [
+        Point(float(second), (moving[-1].values[0], 110, 0, 0.0, 0), second)
+        for second in range(10, 70)
+    ]
+    kept, compactor = compact(
+        CompactionRules.parse("duplicates"), moving + pause
+    )
+    # The pause is reduced to its ends, and max_gap keeps one a minute
+    assert kept == list(range(10)) + [10, 69]
+    assert compactor.removed == 58
+
+
+def test_min_interval_keeps_one_point_per_interval_and_the_last():
+    points = list(ride(23))
+    kept, compactor = compact(CompactionRules(False, min_interval=5), points)
+    assert kept == [0, 5, 10, 15, 20, 22]
+    assert compactor.removed == 23 - 6
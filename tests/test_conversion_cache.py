@@ -0,0 +1,32 @@
+import asyncio
+
+from conversion_cache import ConversionCache
+
+
+def test_too_large_result_replaces_the_cached_one():
+    async def scenario():
+        cache = ConversionCache(max_bytes=10)
+        await cache.put("key", b"small", {"n": 1})
+        await cache.put("key", b"x" * 11, {"n": 2})
+        return cache
+
+    cache = asyncio.run(scenario())
+    assert cache.size == 0
+    assert asyncio.run(cache.get("key")) is None
+
+
+def test_results_survive_in_the_database(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+
+    async def scenario():
+        cache = ConversionCache(db_path=db_path)
+        await cache.put("key", b"data", {"n": 1})
+        await cache.mark_uploaded(1, "key")
+        await cache.close()
+        cache = ConversionCache(db_path=db_path)
+        try:
+            return await cache.get("key"), await cache.is_uploaded(1, "key")
+        finally:
+            await cache.close()
+
+    assert asyncio.run(scenario()) == ((b"data", {"n": 1}), True)
@@ -0,0 +1,24 @@
+import asyncio
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from benchmarks.synthetic import generate_tcx
+from conversion_pool import ConversionExecutor
+
+
+def test_pool_recovers_after_a_worker_dies():
+    async def scenario():
+        converter = ConversionExecutor(1)
+        converter.start()
+        try:
+            # Like a worker killed for running out of memory
+            with pytest.raises(BrokenProcessPool):
+                await converter._run(os._exit, 1)
+            _, summary = await converter.convert_tcx(generate_tcx(10))
+            return summary
+        finally:
+            converter.shutdown()
+
+    assert asyncio.run(scenario())["total_time"] == "0:00:10"
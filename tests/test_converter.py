@@ -0,0 +1,41 @@
+import re
+
+import pytest
+
+from baseline_converter import convert_tcx_in_memory as baseline_convert
+from benchmarks.synthetic import generate_tcx
+from convert_all_tcx import BACKENDS, convert_tcx_in_memory, get_backend
+
+LAP_DISTANCE = re.compile(rb"<DistanceMeters>[^<]*</DistanceMeters><Calories>")
+TRACKPOINT_DISTANCE = re.compile(rb"<DistanceMeters>[^<]*</DistanceMeters>")
+
+
+def without_lap_distance(data):
+    return LAP_DISTANCE.sub(b"<Calories>", data)
+
+
+CASES = {
+    "one lap": generate_tcx(30),
+    "three laps": generate_tcx(30, laps=3),
+    "no extensions": generate_tcx(10, heart_rate=False, tpx=False),
+    "lap without distance": without_lap_distance(generate_tcx(10, laps=2)),
+    # The lap then takes the distance of the second trackpoint
+    "lap and first trackpoint without distance": TRACKPOINT_DISTANCE.sub(
+        b"", without_lap_distance(generate_tcx(10)), count=1
+    ),
+    "empty lap": generate_tcx(10).replace(
+        b"</Lap>", b'</Lap><Lap StartTime="2024-05-01T11:00:00Z"></Lap>', 1
+    ),
+}
+
+
+@pytest.mark.parametrize("backend", sorted(BACKENDS))
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_output_matches_the_baseline_converter(case, backend):
+    expected, expected_summary = baseline_convert(CASES[case])
+    converted, summary = convert_tcx_in_memory(
+        CASES[case], get_backend(backend)
+    )
+    assert converted == expected
+    for key, value in expected_summary.items():
+        assert summary[key] == value
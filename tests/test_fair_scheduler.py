@@ -0,0 +1,58 @@
+import asyncio
+
+from aiogram.methods import GetFile, GetUpdates, SendMessage
+
+from fair_scheduler import FairScheduler, FairTelegramRequests
+
+
+def test_pending_get_updates_does_not_block_get_file():
+    async def scenario():
+        middleware = FairTelegramRequests(FairScheduler(8, per_user_limit=1))
+        poll_done = asyncio.Event()
+
+        async def make_request(bot, method):
+            if isinstance(method, GetUpdates):
+                # A long poll waiting for updates
+                await poll_done.wait()
+            return method
+
+        poll = asyncio.create_task(
+            middleware(make_request, None, GetUpdates(timeout=10))
+        )
+        await asyncio.sleep(0)
+        method = GetFile(file_id="file")
+        result = await asyncio.wait_for(
+            middleware(make_request, None, method), timeout=1
+        )
+        poll_done.set()
+        await poll
+        return result is method
+
+    assert asyncio.run(scenario())
+
+
+def test_requests_of_one_chat_take_turns():
+    async def scenario():
+        middleware = FairTelegramRequests(FairScheduler(8, per_user_limit=1))
+        running = []
+        peak = 0
+
+        async def make_request(bot, method):
+            nonlocal peak
+            running.append(method)
+            peak = max(peak, len(running))
+            await asyncio.sleep(0.01)
+            running.remove(method)
+            return method
+
+        await asyncio.gather(
+            *(
+                middleware(
+                    make_request, None, SendMessage(chat_id=1, text=str(i))
+                )
+                for i in range(3)
+            )
+        )
+        return peak
+
+    assert asyncio.run(scenario()) == 1
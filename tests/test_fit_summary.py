@@ -0,0 +1,38 @@
+import struct
+
+import pytest
+
+import fit_summary
+from benchmarks.synthetic import generate_fit, generate_tcx
+from convert_all_tcx import convert_tcx_to_fit
+from fit_summary import extract_fit_summary, scan_fit_session
+
+
+def fit_file(body):
+    header = struct.pack("<BBHI4sH", 14, 0x10, 2132, len(body), b".FIT", 0)
+    return header + body
+
+
+def test_definition_cut_off_falls_back_to_fit_tool():
+    # A session definition announcing ten fields, of which one is present
+    body = struct.pack("<BBBHB", 0x40, 0, 0, 18, 10) + bytes([2, 4, 134])
+    with pytest.raises(fit_summary._UnusualFitError):
+        scan_fit_session(fit_file(body))
+
+
+@pytest.mark.parametrize("points", [1, 600])
+def test_scanner_agrees_with_fit_tool(points):
+    data = generate_fit(points)
+    scan_fit_session(data)  # The scanner handles the file itself
+    assert extract_fit_summary(data) == fit_summary._extract_with_fit_tool(
+        data
+    )
+
+
+def test_scanner_reads_the_converter_output():
+    # TCX converted to FIT by our own encoder, read back by both readers
+    data, _ = convert_tcx_to_fit(generate_tcx(600, laps=3))
+    scan_fit_session(data)
+    assert extract_fit_summary(data) == fit_summary._extract_with_fit_tool(
+        data
+    )
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+from memory_budget import (
+    JobTooLargeError,
+    MemoryBudget,
+    MemoryBudgetTimeout,
+    estimate_footprint,
+)
+
+
+def test_estimate_footprint_counts_input_and_output_copies():
+    assert estimate_footprint(1000) == 2000 + 3000
+    assert estimate_footprint(1000, "fit") == 2000 + 300
+    assert estimate_footprint(1000, None, on_disk=True) == 3000
+
+
+def test_job_larger_than_the_budget_is_rejected():
+    async def scenario():
+        budget = MemoryBudget(100)
+        with pytest.raises(JobTooLargeError):
+            await budget.reserve(101)
+        with await budget.reserve(100) as reservation:
+            assert budget.used == reservation.amount == 100
+        assert budget.used == 0
+        # Without a capacity anything goes, and usage is still tracked
+        unlimited = MemoryBudget(None)
+        await unlimited.reserve(10**12)
+        assert unlimited.used == 10**12
+
+    asyncio.run(scenario())
+
+
+def test_waiting_job_times_out():
+    async def scenario():
+        budget = MemoryBudget(100, timeout=0.05)
+        held = await budget.reserve(80)
+        with pytest.raises(MemoryBudgetTimeout):
+            await budget.reserve(50)
+        assert budget.waiting == 0 and budget.used == 80
+        # The timed out job doesn't hold anything up
+        await budget.reserve(20)
+        held.release()
+        assert budget.used == 20
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_unblocks_the_jobs_behind_it():
+    async def scenario():
+        budget = MemoryBudget(100)
+        held = await budget.reserve(80)
+        big = asyncio.create_task(budget.reserve(50))
+        await asyncio.sleep(0)
+        # It would fit, but waits behind the big job
+        small = asyncio.create_task(budget.reserve(10))
+        await asyncio.sleep(0)
+        assert budget.waiting == 2 and not small.done()
+
+        big.cancel()
+        reservation = await asyncio.wait_for(small, 1)
+        assert big.cancelled()
+        assert budget.used == 90 and budget.waiting == 0
+
+        # The rest is granted in order once memory is released
+        first = asyncio.create_task(budget.reserve(60))
+        second = asyncio.create_task(budget.reserve(40))
+        await asyncio.sleep(0)
+        held.release()
+        assert (await first).amount == 60
+        assert not second.done()
+        reservation.release()
+        assert (await second).amount == 40
+        assert budget.used == 100
+
+    asyncio.run(scenario())
+
+
+def test_memory_granted_as_the_wait_times_out_is_kept(monkeypatch):
+    async def scenario():
+        budget = MemoryBudget(100)
+        held = await budget.reserve(80)
+
+        async def grant_then_time_out(future, timeout):
+            # The memory is released and handed to the waiter, but the
+            # timeout fires before the waiting task resumes
+            held.release()
+            assert future.done()
+            raise asyncio.TimeoutError
+
+        monkeypatch.setattr(asyncio, "wait_for", grant_then_time_out)
+        reservation = await budget.reserve(50)
+        assert reservation.amount == 50 and budget.used == 50
+        reservation.release()
+        assert budget.used == 0 and budget.waiting == 0
+
+    asyncio.run(scenario())
+
+
+def test_memory_granted_to_a_cancelled_job_is_not_lost():
+    async def scenario():
+        budget = MemoryBudget(100)
+        held = await budget.reserve(80)
+        job = asyncio.create_task(budget.reserve(50))
+        await asyncio.sleep(0)
+        # Granted and cancelled before the job runs again
+        held.release()
+        job.cancel()
+        try:
+            # Depending on the Python version the grant wins
+            (await job).release()
+        except asyncio.CancelledError:
+            pass
+        assert budget.used == 0 and budget.waiting == 0
+
+    asyncio.run(scenario())
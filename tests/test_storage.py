@@ -0,0 +1,110 @@
+import asyncio
+import threading
+
+import pytest
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import DefaultKeyBuilder, StorageKey
+
+from storage import LocalRedis, SQLiteStorage, dump_fsm_data
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=3)
+
+
+class Form(StatesGroup):
+    waiting = State()
+
+
+def test_sqlite_storage_keeps_state_and_data_across_instances(tmp_path):
+    db_path = str(tmp_path / "fsm.db")
+
+    async def first_process():
+        storage = SQLiteStorage(db_path)
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {}
+        await storage.set_state(KEY, Form.waiting)
+        await storage.set_data(KEY, {"files": ["ride.fit"], "count": 1})
+        await storage.close()
+
+    async def second_process():
+        storage = SQLiteStorage(db_path)
+        assert await storage.get_state(KEY) == Form.waiting.state
+        assert await storage.get_data(KEY) == {
+            "files": ["ride.fit"],
+            "count": 1,
+        }
+        # Clearing the state keeps the data, as in aiogram's storages
+        await storage.set_state(KEY, None)
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {
+            "files": ["ride.fit"],
+            "count": 1,
+        }
+        other = StorageKey(bot_id=1, chat_id=4, user_id=4)
+        assert await storage.get_data(other) == {}
+        await storage.close()
+
+    asyncio.run(first_process())
+    asyncio.run(second_process())
+
+
+def test_sqlite_storage_queries_off_the_event_loop(tmp_path):
+    async def scenario():
+        storage = SQLiteStorage(str(tmp_path / "fsm.db"))
+        threads = []
+        execute = storage._select
+
+        def select(*args):
+            threads.append(threading.current_thread())
+            return execute(*args)
+
+        storage._select = select
+        await storage.get_state(KEY)
+        await storage.close()
+        assert threads and threads[0] is not threading.main_thread()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_storage_rejects_live_objects(tmp_path):
+    async def scenario():
+        storage = SQLiteStorage(str(tmp_path / "fsm.db"))
+        with pytest.raises(TypeError, match="JSON serializable"):
+            await storage.set_data(KEY, {"client": object()})
+        assert await storage.get_data(KEY) == {}
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_dump_fsm_data_names_the_problem():
+    assert dump_fsm_data({"a": 1}) == '{"a": 1}'
+    with pytest.raises(TypeError, match="FSM data must be JSON serializable"):
+        dump_fsm_data({"client": object()})
+
+
+def test_redis_storage_works_with_local_redis():
+    pytest.importorskip("redis")
+    from aiogram.fsm.storage.redis import RedisStorage
+
+    async def scenario():
+        redis = LocalRedis()
+        storage = RedisStorage(
+            redis,
+            key_builder=DefaultKeyBuilder(with_bot_id=True),
+            json_dumps=dump_fsm_data,
+        )
+        await storage.set_state(KEY, Form.waiting)
+        await storage.set_data(KEY, {"count": 1})
+        assert await storage.get_state(KEY) == Form.waiting.state
+        assert await storage.get_data(KEY) == {"count": 1}
+        # Keys carry the bot id, as bot.py configures them
+        assert await redis.get("fsm:1:2:3:state") == b"Form:waiting"
+        with pytest.raises(TypeError, match="JSON serializable"):
+            await storage.set_data(KEY, {"client": object()})
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {}
+        await storage.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+from cryptography.fernet import Fernet
+
+from storage import LocalRedis
+from token_store import RedisTokenStore, SQLiteTokenStore, TokenStore
+
+
+class UnlistedStore(TokenStore):
+    """
+    Store that can't list its users, like most keyring backends.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = dict(tokens)
+
+    async def get(self, user_id):
+        return self.tokens.get(user_id)
+
+    async def put(self, user_id, auth):
+        self.tokens[user_id] = auth
+
+    async def delete(self, user_id):
+        del self.tokens[user_id]
+
+    async def users(self):
+        return None
+
+
+def test_token_store_is_abstract():
+    with pytest.raises(TypeError):
+        TokenStore()
+
+
+def test_redis_store_lists_its_users():
+    async def scenario():
+        redis = LocalRedis()
+        await redis.set("other:3", "x")
+        store = RedisTokenStore(redis)
+        await store.put(2, "b")
+        await store.put(1, "a")
+        await store.put(4, "c")
+        await store.delete(4)
+        return await store.users()
+
+    assert asyncio.run(scenario()) == [1, 2]
+
+
+def test_unlisted_users_are_migrated_on_first_use(tmp_path):
+    db_path = str(tmp_path / "tokens.db")
+    key = Fernet.generate_key().decode()
+    source = UnlistedStore({1: "one", 2: "two"})
+
+    async def scenario():
+        store = SQLiteTokenStore(db_path, key)
+        assert await store.migrate(source) == 0
+        assert await store.get(1) == "one"
+        await store.delete(2)
+        result = await store.get(2), await store.users()
+        await store.close()
+        return result
+
+    assert asyncio.run(scenario()) == (None, [1])
+    assert source.tokens == {}
+
+    async def restart():
+        # Nothing is recorded as migrated, so the fallback stays in place
+        store = SQLiteTokenStore(db_path, key)
+        source.tokens[3] = "three"
+        await store.migrate(source)
+        try:
+            return await store.get(3)
+        finally:
+            await store.close()
+
+    assert asyncio.run(restart()) == "three"
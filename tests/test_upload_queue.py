@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+import requests
+
+from upload_queue import UploadQueue, is_retryable
+
+
+def enqueue(queue):
+    return asyncio.run(queue.enqueue(1, 1, "a.fit", b"data", kind="fit"))
+
+
+def test_two_queues_on_one_database_claim_a_job_once(tmp_path):
+    db_path = str(tmp_path / "queue.db")
+    first = UploadQueue(None, None, db_path=db_path)
+    second = UploadQueue(None, None, db_path=db_path)
+    enqueue(first)
+
+    job, _ = first._claim()
+    # A queue started later doesn't take over the running job
+    third = UploadQueue(None, None, db_path=db_path)
+    assert job is not None
+    assert second._claim()[0] is None
+    assert third._claim()[0] is None
+
+
+def test_job_with_expired_lease_is_claimed_again(tmp_path):
+    db_path = str(tmp_path / "queue.db")
+    first = UploadQueue(None, None, db_path=db_path)
+    second = UploadQueue(None, None, db_path=db_path)
+    job_id = enqueue(first)
+    assert first._claim()[0].id == job_id
+
+    first._db.execute(
+        "UPDATE upload_jobs SET lease_until = ?", (time.time() - 1,)
+    )
+    first._db.commit()
+    assert second._claim()[0].id == job_id
+
+
+class Clients:
+    def __init__(self, error):
+        self.error = error
+
+    async def get(self, user_id):
+        raise self.error
+
+
+class Notifier:
+    def __init__(self):
+        self.failed_jobs = []
+
+    async def failed(self, job, error):
+        self.failed_jobs.append((job.id, error))
+
+
+def test_is_retryable_only_for_temporary_errors():
+    assert is_retryable(requests.ConnectionError())
+    assert is_retryable(requests.Timeout())
+    assert is_retryable(TimeoutError())
+    assert not is_retryable(ValueError())
+    assert not is_retryable(PermissionError())
+
+
+def test_job_is_not_left_running_when_the_client_lookup_fails():
+    async def scenario():
+        queue = UploadQueue(None, Clients(RuntimeError("broken")))
+        queue._notifier = Notifier()
+        job_id = await queue.enqueue(1, 1, "a.fit", b"data", kind="fit")
+        job, _ = queue._claim()
+        await queue._process(job)
+        return job_id, queue
+
+    job_id, queue = asyncio.run(scenario())
+    assert len(queue) == 0
+    assert [job for job, _ in queue._notifier.failed_jobs] == [job_id]
+
+
+def test_network_error_reschedules_the_job():
+    async def scenario():
+        queue = UploadQueue(None, Clients(requests.ConnectionError()))
+        queue._notifier = Notifier()
+        await queue.enqueue(1, 1, "a.fit", b"data", kind="fit")
+        job, _ = queue._claim()
+        await queue._process(job)
+        return queue
+
+    queue = asyncio.run(scenario())
+    running, attempts = queue._db.execute(
+        "SELECT running, attempts FROM upload_jobs"
+    ).fetchone()
+    assert (running, attempts) == (0, 1)
+    assert queue._notifier.failed_jobs == []
+
+
+def test_cancelled_upload_is_returned_to_the_queue():
+    async def scenario():
+        started = asyncio.Event()
+
+        class SlowClients:
+            async def get(self, user_id):
+                started.set()
+                await asyncio.sleep(10)
+
+        queue = UploadQueue(None, SlowClients(), workers=1)
+        await queue.enqueue(1, 1, "a.fit", b"data", kind="fit")
+        queue.start(Notifier())
+        await started.wait()
+        for task in queue._tasks:
+            task.cancel()
+        await asyncio.gather(*queue._tasks, return_exceptions=True)
+        return queue._db.execute("SELECT running FROM upload_jobs").fetchone()
+
+    assert asyncio.run(scenario()) == (0,)
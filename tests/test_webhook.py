@@ -0,0 +1,98 @@
+import asyncio
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+from aiohttp.test_utils import TestServer
+
+from webhook import FakeTelegramSender, build_webhook_app
+
+SECRET = "secret"
+
+
+def run_with_webhook(scenario):
+    """
+    Serve a webhook whose handler holds every message until released, and
+    run scenario(server, handler, sender, session, started, release).
+    :return: texts of the messages the handler got.
+    """
+
+    async def main():
+        dp = Dispatcher()
+        started, release = asyncio.Event(), asyncio.Event()
+        texts = []
+
+        @dp.message()
+        async def on_message(message: Message):
+            texts.append(message.text)
+            started.set()
+            await release.wait()
+
+        bot = Bot("42:TEST")
+        app, handler = build_webhook_app(dp, bot, SECRET)
+        try:
+            async with TestServer(app) as server:
+                sender = FakeTelegramSender(
+                    str(server.make_url("/webhook")), SECRET
+                )
+                async with aiohttp.ClientSession() as session:
+                    await scenario(
+                        server, handler, sender, session, started, release
+                    )
+                release.set()
+        finally:
+            await bot.session.close()
+        return texts
+
+    return asyncio.run(main())
+
+
+async def health(server, session):
+    async with session.get(server.make_url("/healthz")) as response:
+        return response.status, await response.json()
+
+
+def test_webhook_takes_updates_and_drains_on_shutdown():
+    async def scenario(server, handler, sender, session, started, release):
+        assert await health(server, session) == (
+            200,
+            {"status": "ok", "in_flight": 0},
+        )
+        intruder = FakeTelegramSender(sender.url, "wrong")
+        assert (
+            await intruder.send(intruder.text_update(1, "x"), session) == 401
+        )
+
+        # Telegram is answered before the update is processed
+        assert (
+            await sender.send(sender.text_update(1, "hello"), session) == 200
+        )
+        await asyncio.wait_for(started.wait(), 5)
+        assert await health(server, session) == (
+            200,
+            {"status": "ok", "in_flight": 1},
+        )
+
+        drained = asyncio.create_task(handler.drain(5))
+        await asyncio.sleep(0)
+        assert await sender.send(sender.text_update(1, "late"), session) == 503
+        assert await health(server, session) == (
+            503,
+            {"status": "draining", "in_flight": 1},
+        )
+        assert not drained.done()
+        release.set()
+        assert await drained is True
+        assert handler.in_flight == 0
+
+    assert run_with_webhook(scenario) == ["hello"]
+
+
+def test_drain_gives_up_after_the_timeout():
+    async def scenario(server, handler, sender, session, started, release):
+        assert await sender.send(sender.text_update(1, "slow"), session) == 200
+        await asyncio.wait_for(started.wait(), 5)
+        assert await handler.drain(0.1) is False
+        assert handler.in_flight == 1
+
+    assert run_with_webhook(scenario) == ["slow"]
@@ -0,0 +1,51 @@
+import asyncio
+import io
+import zipfile
+
+import requests
+
+from benchmarks.synthetic import generate_tcx
+from conversion_pool import ConversionExecutor
+from garmin_uploader import GarminUploader
+from zip_pipeline import BatchReporter, ZipBatchPipeline
+
+
+class OfflineClient:
+    def upload(self, file_io):
+        raise requests.ConnectionError("Connection refused")
+
+
+class Reporter(BatchReporter):
+    def __init__(self):
+        self.events = []
+
+    async def uploaded(self, name):
+        self.events.append(("uploaded", name))
+
+    async def upload_failed(self, name, converted_content):
+        self.events.append(("upload_failed", name))
+
+
+def test_network_error_on_upload_is_reported():
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_ref:
+        zip_ref.writestr("ride.tcx", generate_tcx(10))
+
+    async def scenario():
+        converter = ConversionExecutor(1)
+        converter.start()
+        uploader = GarminUploader(1)
+        reporter = Reporter()
+        try:
+            with zipfile.ZipFile(archive) as zip_ref:
+                report = await ZipBatchPipeline(converter, uploader).run(
+                    zip_ref, OfflineClient(), reporter
+                )
+        finally:
+            converter.shutdown()
+            uploader.shutdown()
+        return report, reporter.events
+
+    report, events = asyncio.run(scenario())
+    assert (report.uploaded, report.upload_failed) == (0, 1)
+    assert events == [("upload_failed", "ride.tcx")]
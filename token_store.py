@@ -0,0 +1,369 @@
+import asyncio
+import configparser
+import logging
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import keyring
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from keyrings.alt.escape import escape as escape_for_ini
+
+logger = logging.getLogger(__name__)
+
+
+class TokenStore(ABC):
+    """
+    Keeps the serialized garth tokens of logged in users, so that any bot
+    process can rebuild a user's client.
+    """
+
+    # Whether bot processes are expected to share the store, so that one
+    # of them may change tokens behind another's back
+    shared = False
+
+    @abstractmethod
+    async def get(self, user_id: int) -> Optional[str]:
+        """
+        :return: tokens as dumped by garth.Client.dumps(), or None.
+        """
+
+    @abstractmethod
+    async def put(self, user_id: int, auth: str) -> None:
+        pass
+
+    @abstractmethod
+    async def delete(self, user_id: int) -> None:
+        pass
+
+    @abstractmethod
+    async def users(self) -> Optional[List[int]]:
+        """
+        :return: IDs of the users with stored tokens, or None if the store
+            can't list them.
+        """
+
+    async def close(self) -> None:
+        pass
+
+
+def _service_name(user_id: int) -> str:
+    return f"tcx_bot_{user_id}"
+
+
+class KeyringTokenStore(TokenStore):
+    """
+    Tokens in the system keyring, one entry per user. The keyring is local
+    to the machine, so it only suits bot processes running side by side.
+    """
+
+    async def get(self, user_id: int) -> Optional[str]:
+        return await asyncio.to_thread(
+            keyring.get_password, _service_name(user_id), "auth"
+        )
+
+    async def put(self, user_id: int, auth: str) -> None:
+        await asyncio.to_thread(
+            keyring.set_password, _service_name(user_id), "auth", auth
+        )
+
+    async def delete(self, user_id: int) -> None:
+        await asyncio.to_thread(
+            keyring.delete_password, _service_name(user_id), "auth"
+        )
+
+    async def users(self) -> Optional[List[int]]:
+        return await asyncio.to_thread(_keyring_users)
+
+
+def _keyring_users() -> Optional[List[int]]:
+    # Keyrings can't list their entries in general, but the file backends
+    # of keyrings.alt keep one INI section per service
+    path = getattr(keyring.get_keyring(), "file_path", None)
+    if not path:
+        return None
+    if not os.path.exists(path):
+        return []
+    config = configparser.RawConfigParser()
+    config.read(path, encoding="utf-8")
+    prefix = escape_for_ini(_service_name(""))
+    return [
+        int(section[len(prefix) :])
+        for section in config.sections()
+        if section.startswith(prefix) and section[len(prefix) :].isdigit()
+        # Deleting a password leaves its section behind
+        and config.has_option(section, escape_for_ini("auth"))
+    ]
+
+
+class RedisTokenStore(TokenStore):
+    """
+    Tokens in Redis, shared by bot processes on any number of machines.
+    """
+
+    shared = True
+
+    def __init__(self, redis, prefix: str = "tcx_bot:auth"):
+        """
+        :param redis: redis.asyncio client, or a storage.LocalRedis for testing.
+        :param prefix: prefix of the keys.
+        """
+        self.redis = redis
+        self.prefix = prefix
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.prefix}:{user_id}"
+
+    async def get(self, user_id: int) -> Optional[str]:
+        value = await self.redis.get(self._key(user_id))
+        return value.decode() if isinstance(value, bytes) else value
+
+    async def put(self, user_id: int, auth: str) -> None:
+        await self.redis.set(self._key(user_id), auth)
+
+    async def delete(self, user_id: int) -> None:
+        await self.redis.delete(self._key(user_id))
+
+    async def users(self) -> List[int]:
+        prefix = self._key("")
+        users = []
+        async for key in self.redis.scan_iter(match=f"{prefix}*"):
+            if isinstance(key, bytes):
+                key = key.decode()
+            if key[len(prefix) :].isdigit():
+                users.append(int(key[len(prefix) :]))
+        return sorted(users)
+
+
+class SQLiteTokenStore(TokenStore):
+    """
+    Tokens in an SQLite database, one row per user, encrypted with Fernet.
+    Bot processes on the same machine can share the database (WAL mode).
+    The database is only touched by a single thread, and writes arriving
+    within flush_delay of each other are committed in one transaction,
+    so a burst of logins or token refreshes costs a single disk sync.
+    """
+
+    shared = True
+
+    def __init__(self, db_path: str, keys: str, flush_delay: float = 0.05):
+        """
+        :param db_path: path of the database, created if it doesn't exist.
+        :param keys: Fernet key, or comma-separated keys for key rotation:
+            tokens are encrypted with the first key and decrypted with any.
+        :param flush_delay: seconds writes are collected before a commit.
+        """
+        self._fernet = MultiFernet(
+            [Fernet(key.strip()) for key in keys.split(",")]
+        )
+        self.flush_delay = flush_delay
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="token_store"
+        )
+        self._db = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS tokens (
+                user_id INTEGER PRIMARY KEY,
+                auth BLOB NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+            """)
+        self._db.commit()
+        # Changes not committed yet (None: deleted), newest last
+        self._pending: Dict[int, Optional[str]] = {}
+        self._writing: List[Dict[int, Optional[str]]] = []
+        self._flushed: Optional[asyncio.Future] = None
+        self._flusher: Optional[asyncio.Task] = None
+        # Store whose users couldn't be listed, migrated one by one on access
+        self._fallback: Optional[TokenStore] = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _read(self, user_id: int) -> Optional[bytes]:
+        row = self._db.execute(
+            "SELECT auth FROM tokens WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _commit(self, rows: Dict[int, Optional[bytes]]) -> None:
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO tokens (user_id, auth, updated_at)"
+                " VALUES (?, ?, ?) ON CONFLICT (user_id) DO UPDATE"
+                " SET auth = excluded.auth, updated_at = excluded.updated_at",
+                [
+                    (user_id, token, now)
+                    for user_id, token in rows.items()
+                    if token is not None
+                ],
+            )
+            self._db.executemany(
+                "DELETE FROM tokens WHERE user_id = ?",
+                [
+                    (user_id,)
+                    for user_id, token in rows.items()
+                    if token is None
+                ],
+            )
+
+    def _meta(self, name: str) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT value FROM meta WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name: str, value: str) -> None:
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                (name, value),
+            )
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        batch, self._pending = self._pending, {}
+        flushed, self._flushed = self._flushed, None
+        self._flusher = None
+        self._writing.append(batch)
+        try:
+            rows = {
+                user_id: (
+                    None
+                    if auth is None
+                    else self._fernet.encrypt(auth.encode())
+                )
+                for user_id, auth in batch.items()
+            }
+            await self._run(self._commit, rows)
+        except Exception as e:
+            flushed.set_exception(e)
+        else:
+            flushed.set_result(None)
+        finally:
+            self._writing.remove(batch)
+
+    async def _write(self, changes: Dict[int, Optional[str]]) -> None:
+        """
+        Queue changes for the next commit and wait until it is done.
+        """
+        self._pending.update(changes)
+        if self._flusher is None:
+            self._flushed = asyncio.get_running_loop().create_future()
+            self._flusher = asyncio.create_task(self._flush_later())
+        # The commit is shared, so one cancelled caller must not cancel it
+        await asyncio.shield(self._flushed)
+
+    async def get(self, user_id: int) -> Optional[str]:
+        # Changes on their way to the database are the latest
+        for changes in (self._pending, *reversed(self._writing)):
+            if user_id in changes:
+                return changes[user_id]
+        token = await self._run(self._read, user_id)
+        if token is None:
+            return await self._migrate_user(user_id)
+        try:
+            return self._fernet.decrypt(token).decode()
+        except InvalidToken:
+            logger.error(
+                f"Tokens of user {user_id} can't be decrypted with the "
+                "configured keys"
+            )
+            return None
+
+    async def put(self, user_id: int, auth: str) -> None:
+        await self._write({user_id: auth})
+
+    async def delete(self, user_id: int) -> None:
+        await self._write({user_id: None})
+        # Not migrated yet tokens must not come back on the next get()
+        if self._fallback is not None:
+            if await self._fallback.get(user_id) is not None:
+                await self._fallback.delete(user_id)
+
+    async def users(self) -> List[int]:
+        rows = await self._run(
+            lambda: self._db.execute("SELECT user_id FROM tokens").fetchall()
+        )
+        users = {user_id for (user_id,) in rows}
+        for changes in (*self._writing, self._pending):
+            for user_id, auth in changes.items():
+                if auth is None:
+                    users.discard(user_id)
+                else:
+                    users.add(user_id)
+        return sorted(users)
+
+    async def _migrate_user(self, user_id: int) -> Optional[str]:
+        if self._fallback is None:
+            return None
+        auth = await self._fallback.get(user_id)
+        if auth:
+            await self._write({user_id: auth})
+            await self._fallback.delete(user_id)
+            logger.info(
+                f"Migrated tokens of user {user_id} from "
+                f"{type(self._fallback).__name__}"
+            )
+        return auth
+
+    async def migrate(self, source: TokenStore) -> int:
+        """
+        Move the tokens of another store into this one. Runs only once per
+        kind of source; tokens already in this store are kept, and all
+        tokens are deleted from the source. If the source can't list its
+        users, each user's tokens are moved when they are first looked up.
+        :return: number of users whose tokens were moved.
+        """
+        name = f"migrated_from:{type(source).__name__}"
+        if await self._run(self._meta, name):
+            return 0
+        users = await source.users()
+        if users is None:
+            self._fallback = source
+            logger.info(
+                f"{type(source).__name__} can't list its users; their "
+                "tokens are migrated when they are used"
+            )
+            return 0
+        tokens = {}
+        for user_id in users:
+            auth = await source.get(user_id)
+            if auth and await self.get(user_id) is None:
+                tokens[user_id] = auth
+        if tokens:
+            await self._write(tokens)
+        for user_id in users:
+            try:
+                await source.delete(user_id)
+            except Exception as e:
+                logger.error(
+                    f"Error deleting migrated tokens of {user_id}: {e}"
+                )
+        await self._run(self._set_meta, name, str(time.time()))
+        logger.info(
+            f"Migrated tokens of {len(tokens)} users from "
+            f"{type(source).__name__}"
+        )
+        return len(tokens)
+
+    async def close(self) -> None:
+        """
+        Commit the pending changes and close the database.
+        """
+        if self._flusher is not None:
+            await asyncio.shield(self._flushed)
+        await self._run(self._db.close)
+        self._executor.shutdown()
@@ -0,0 +1,494 @@
+import asyncio
+import io
+import logging
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+import requests
+
+from client_pool import GarminClientPool
+from conversion_cache import ConversionCache, is_duplicate_upload
+from garmin_uploader import GarminUploader, http_response, http_status
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_JOBS = Gauge(
+    "tcx_bot_upload_jobs",
+    "Jobs waiting in the upload queue.",
+)
+UPLOAD_RETRIES = Counter(
+    "tcx_bot_upload_retries",
+    "Uploads rescheduled after a temporary Garmin Connect error.",
+)
+
+# Workers look for due jobs at least this often, even without new jobs
+POLL_INTERVAL = 60
+# A claimed job that isn't finished within this time is claimed again, by
+# any process sharing the database: the process uploading it has died
+LEASE_SECONDS = 15 * 60
+
+
+@dataclass
+class UploadJob:
+    """
+    A file waiting to be uploaded to Garmin Connect on behalf of a user.
+    """
+
+    id: int
+    user_id: int
+    chat_id: int
+    file_name: str
+    content: bytes
+    content_hash: Optional[str]
+    kind: str
+    attempts: int = 0
+
+
+class UploadNotifier:
+    """
+    Receives the final result of upload jobs. The default does nothing;
+    the bot overrides the methods to talk to the user.
+    """
+
+    async def uploaded(self, job: UploadJob) -> None:
+        pass
+
+    async def already_uploaded(self, job: UploadJob) -> None:
+        pass
+
+    async def failed(self, job: UploadJob, error: Exception) -> None:
+        pass
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `rate` events per minute with bursts of `burst`.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate / 60
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def delay(self) -> float:
+        """
+        :return: seconds until the next event is allowed, 0 if it is allowed now.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def acquire(self) -> None:
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """
+        Allow no events for the given time (e.g. after a 429 response).
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    :return: seconds to wait according to the Retry-After header of a failed
+        garth request, or None if there is no such header.
+    """
+    response = http_response(error)
+    value = (
+        response.headers.get("Retry-After") if response is not None else None
+    )
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Check whether an upload error is temporary: rate limiting, a server error,
+    or a network error or timeout before any response.
+    """
+    status = http_status(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(
+        error,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            ConnectionError,
+            TimeoutError,
+        ),
+    )
+
+
+class UploadQueue:
+    """
+    Durable queue of Garmin Connect uploads backed by SQLite.
+    Async workers upload the queued files, retry temporary errors with
+    exponential backoff (respecting Retry-After), and keep the upload rate
+    within a per-user and a global limit. Jobs survive restarts; the final
+    result of every job is passed to an UploadNotifier.
+    """
+
+    def __init__(
+        self,
+        uploader: GarminUploader,
+        clients: GarminClientPool,
+        db_path: str = ":memory:",
+        workers: int = 2,
+        max_attempts: int = 8,
+        base_delay: float = 30,
+        max_delay: float = 3600,
+        user_rate: float = 10,
+        global_rate: float = 120,
+        cache: ConversionCache = None,
+    ):
+        """
+        :param uploader: runs the blocking uploads.
+        :param clients: provides the users' garth clients.
+        :param db_path: SQLite database holding the jobs.
+        :param workers: number of concurrent uploads.
+        :param max_attempts: attempts before a job is given up.
+        :param base_delay: delay before the first retry, doubled for every next one.
+        :param max_delay: upper limit of the delay between retries.
+        :param user_rate: uploads per minute allowed for a single user.
+        :param global_rate: uploads per minute allowed for all users together.
+        :param cache: if given, successful uploads are recorded in it.
+        """
+        self.uploader = uploader
+        self.clients = clients
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.user_rate = user_rate
+        self.cache = cache
+        self._global_limiter = RateLimiter(global_rate, burst=max(1, workers))
+        self._user_limiters: Dict[int, RateLimiter] = {}
+        self._notifier = UploadNotifier()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        # Job contents are megabytes: reading and writing them on the event
+        # loop would stall the bot
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="upload_queue"
+        )
+        self._db = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS upload_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                file_name TEXT NOT NULL,
+                content BLOB NOT NULL,
+                content_hash TEXT,
+                kind TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                running INTEGER NOT NULL DEFAULT 0,
+                lease_until REAL NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            )
+            """)
+        columns = [
+            row[1]
+            for row in self._db.execute("PRAGMA table_info(upload_jobs)")
+        ]
+        if "lease_until" not in columns:
+            # Jobs left running by older versions count as expired
+            self._db.execute(
+                "ALTER TABLE upload_jobs"
+                " ADD COLUMN lease_until REAL NOT NULL DEFAULT 0"
+            )
+        self._db.commit()
+        self._update_depth()
+
+    def __len__(self) -> int:
+        (count,) = self._db.execute(
+            "SELECT COUNT(*) FROM upload_jobs"
+        ).fetchone()
+        return count
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _count(self, user_id: int) -> int:
+        (count,) = self._db.execute(
+            "SELECT COUNT(*) FROM upload_jobs WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return count
+
+    async def pending(self, user_id: int) -> int:
+        """
+        :return: number of the user's jobs not finished yet, running or not.
+        """
+        return await self._run(self._count, user_id)
+
+    def _update_depth(self) -> None:
+        UPLOAD_JOBS.set(len(self))
+
+    def _insert(self, *values) -> int:
+        now = time.time()
+        cursor = self._db.execute(
+            "INSERT INTO upload_jobs (user_id, chat_id, file_name, content,"
+            " content_hash, kind, next_attempt_at, created_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (*values, now, now),
+        )
+        self._db.commit()
+        self._update_depth()
+        return cursor.lastrowid
+
+    async def enqueue(
+        self,
+        user_id: int,
+        chat_id: int,
+        file_name: str,
+        content: bytes,
+        content_hash: str = None,
+        kind: str = "tcx",
+    ) -> int:
+        """
+        Add a file to the queue. It is uploaded by a worker as soon as
+        the rate limits allow.
+        :param kind: "tcx" or "fit", passed on to the notifier.
+        :return: ID of the job.
+        """
+        job_id = await self._run(
+            self._insert,
+            user_id,
+            chat_id,
+            file_name,
+            content,
+            content_hash,
+            kind,
+        )
+        self._wakeup.set()
+        return job_id
+
+    def _delete_user(self, user_id: int) -> None:
+        self._db.execute(
+            "DELETE FROM upload_jobs WHERE user_id = ?"
+            " AND (running = 0 OR lease_until < ?)",
+            (user_id, time.time()),
+        )
+        self._db.commit()
+        self._update_depth()
+
+    async def forget_user(self, user_id: int) -> None:
+        """
+        Drop the queued jobs of a user (e.g. after /stop).
+        Jobs being uploaded right now are finished.
+        """
+        await self._run(self._delete_user, user_id)
+
+    def _user_limiter(self, user_id: int) -> RateLimiter:
+        limiter = self._user_limiters.get(user_id)
+        if limiter is None:
+            limiter = self._user_limiters[user_id] = RateLimiter(
+                self.user_rate
+            )
+        return limiter
+
+    def _claim(self) -> Tuple[Optional[UploadJob], float]:
+        """
+        Pick the next due job whose user is within the rate limit. Jobs
+        whose lease has expired are due as well. Runs on the executor, like
+        all the methods touching the database or the rate limiters.
+        :return: the job (marked as running) or None, and how long to wait
+            before looking again if there is no job.
+        """
+        wait = self._global_limiter.delay()
+        if wait:
+            return None, wait
+        wait = POLL_INTERVAL
+        now = time.time()
+        rows = self._db.execute(
+            "SELECT id, user_id, next_attempt_at FROM upload_jobs"
+            " WHERE running = 0 OR lease_until < ?"
+            " ORDER BY next_attempt_at, id",
+            (now,),
+        ).fetchall()
+        for job_id, user_id, next_attempt_at in rows:
+            if next_attempt_at > now:
+                wait = min(wait, next_attempt_at - now)
+                break
+            user_wait = self._user_limiter(user_id).delay()
+            if user_wait:
+                wait = min(wait, user_wait)
+                continue
+            # Other processes may share the database: only one of them
+            # gets the job
+            claimed = self._db.execute(
+                "UPDATE upload_jobs SET running = 1, lease_until = ?"
+                " WHERE id = ? AND (running = 0 OR lease_until < ?)",
+                (now + LEASE_SECONDS, job_id, now),
+            ).rowcount
+            self._db.commit()
+            if not claimed:
+                continue
+            row = self._db.execute(
+                "SELECT id, user_id, chat_id, file_name, content,"
+                " content_hash, kind, attempts FROM upload_jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+            self._global_limiter.acquire()
+            self._user_limiter(user_id).acquire()
+            return UploadJob(*row), 0
+        return None, wait
+
+    def _finish(self, job: UploadJob) -> None:
+        self._db.execute("DELETE FROM upload_jobs WHERE id = ?", (job.id,))
+        self._db.commit()
+        self._update_depth()
+
+    def _retry(self, job: UploadJob, error: Exception) -> bool:
+        """
+        Reschedule a job after a temporary error.
+        :return: False if the job is out of attempts.
+        """
+        attempts = job.attempts + 1
+        if attempts >= self.max_attempts:
+            return False
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        # Jitter spreads out the retries of jobs that failed together
+        delay *= random.uniform(0.5, 1)
+        server_delay = retry_after(error)
+        if server_delay is not None:
+            delay = max(delay, server_delay)
+        if http_status(error) == 429:
+            # Garmin throttles the whole bot, not a single user
+            self._global_limiter.pause(server_delay or delay)
+        self._db.execute(
+            "UPDATE upload_jobs SET attempts = ?, next_attempt_at = ?,"
+            " running = 0 WHERE id = ?",
+            (attempts, time.time() + delay, job.id),
+        )
+        self._db.commit()
+        UPLOAD_RETRIES.inc()
+        logger.info(
+            f"Upload of {job.file_name} for user {job.user_id} failed "
+            f"(attempt {attempts}): {error}. Retrying in {delay:.0f}s"
+        )
+        return True
+
+    def _release(self, job: UploadJob) -> None:
+        """
+        Return a job that was neither finished nor rescheduled to the queue.
+        """
+        self._db.execute(
+            "UPDATE upload_jobs SET running = 0, lease_until = 0"
+            " WHERE id = ? AND running = 1",
+            (job.id,),
+        )
+        self._db.commit()
+
+    async def _process(self, job: UploadJob) -> None:
+        try:
+            g_client = await self.clients.get(job.user_id)
+            if g_client is None:
+                raise PermissionError("The user is not logged in")
+            file_io = io.BytesIO(job.content)
+            file_io.name = job.file_name
+            await self.uploader.upload(g_client, file_io, job.user_id)
+        except Exception as e:
+            if is_duplicate_upload(e):
+                await self._run(self._finish, job)
+                await self._mark_uploaded(job)
+                await self._notifier.already_uploaded(job)
+            elif not (
+                is_retryable(e) and await self._run(self._retry, job, e)
+            ):
+                logger.error(
+                    f"Upload of {job.file_name} for user {job.user_id} "
+                    f"failed: {e}"
+                )
+                await self._run(self._finish, job)
+                await self._notifier.failed(job, e)
+            return
+        await self._run(self._finish, job)
+        await self._mark_uploaded(job)
+        await self._notifier.uploaded(job)
+
+    async def _mark_uploaded(self, job: UploadJob) -> None:
+        if self.cache is not None and job.content_hash:
+            await self.cache.mark_uploaded(job.user_id, job.content_hash)
+
+    async def _work(self) -> None:
+        while True:
+            # Cleared before the check: a job added meanwhile sets it again,
+            # so no wakeup is lost
+            self._wakeup.clear()
+            job, wait = await self._run(self._claim)
+            if job is None:
+                # Unlike wait_for(), timeout() never swallows a cancellation
+                # that arrives together with the wakeup, so close() returns
+                try:
+                    async with asyncio.timeout(wait):
+                        await self._wakeup.wait()
+                except TimeoutError:
+                    pass
+                continue
+            try:
+                await self._process(job)
+            except Exception as e:
+                logger.error(f"Error processing upload job {job.id}: {e}")
+            finally:
+                # Also on cancellation: another worker uploads it later
+                await self._run(self._release, job)
+            # The job may have freed a rate limit slot for other workers
+            self._wakeup.set()
+
+    def start(self, notifier: UploadNotifier = None) -> None:
+        """
+        Start the upload workers.
+        :param notifier: receives the final result of every job.
+        """
+        if notifier is not None:
+            self._notifier = notifier
+        self._tasks = [
+            asyncio.create_task(self._work()) for _ in range(self.workers)
+        ]
+        logger.info(
+            f"Upload queue started with {self.workers} workers, "
+            f"{len(self)} jobs pending"
+        )
+
+    async def close(self) -> None:
+        """
+        Stop the workers. Interrupted jobs stay in the database and are
+        uploaded again on the next start.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._run(self._db.close)
+        self._executor.shutdown()
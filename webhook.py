@@ -0,0 +1,244 @@
+import asyncio
+import itertools
+import logging
+import signal
+import time
+from typing import Any, Dict, Tuple
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import (
+    SimpleRequestHandler,
+    setup_application,
+)
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class DrainingRequestHandler(SimpleRequestHandler):
+    """
+    Webhook handler that answers Telegram at once and processes the update
+    in background. On shutdown it stops taking updates (Telegram delivers
+    them again later, possibly to another replica) and waits for the updates
+    in progress, so running conversions are not cut off.
+    """
+
+    def __init__(
+        self, dispatcher: Dispatcher, bot: Bot, secret_token: str, **data: Any
+    ):
+        super().__init__(
+            dispatcher,
+            bot,
+            handle_in_background=True,
+            secret_token=secret_token,
+            **data,
+        )
+        self.draining = False
+
+    @property
+    def in_flight(self) -> int:
+        """
+        :return: number of updates being processed.
+        """
+        return len(self._background_feed_update_tasks)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.draining:
+            # Telegram retries updates that were not answered with 200
+            return web.Response(text="Shutting down", status=503)
+        return await super().handle(request)
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Stop taking updates and wait for the ones in progress.
+        :param timeout: seconds to wait at most.
+        :return: True if every update was processed in time.
+        """
+        self.draining = True
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return True
+        logger.info(f"Waiting for {len(tasks)} updates in progress")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logger.warning(
+                f"{len(pending)} updates were still in progress "
+                f"after {timeout}s"
+            )
+        return not pending
+
+    async def close(self) -> None:
+        # The bot session is closed by whoever created the bot
+        pass
+
+
+def build_webhook_app(
+    dp: Dispatcher,
+    bot: Bot,
+    secret_token: str,
+    path: str = "/webhook",
+    **data: Any,
+) -> Tuple[web.Application, DrainingRequestHandler]:
+    """
+    Build the aiohttp application that receives Telegram updates.
+    Besides the webhook it serves GET /healthz for load balancers: 200 while
+    the replica takes updates, 503 once it is shutting down.
+    :param secret_token: updates without this X-Telegram-Bot-Api-Secret-Token
+        header are rejected with 401.
+    :param path: path of the webhook.
+    :param data: passed on to the handlers like with dp.start_polling().
+    :return: the application and its webhook handler.
+    """
+    handler = DrainingRequestHandler(dp, bot, secret_token, **data)
+
+    async def handle_health(request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "status": "draining" if handler.draining else "ok",
+                "in_flight": handler.in_flight,
+            },
+            status=503 if handler.draining else 200,
+        )
+
+    app = web.Application()
+    handler.register(app, path=path)
+    app.router.add_get("/healthz", handle_health)
+    setup_application(app, dp, bot=bot, **data)
+    return app, handler
+
+
+async def run_webhook(
+    dp: Dispatcher,
+    bot: Bot,
+    secret_token: str,
+    host: str = "0.0.0.0",
+    port: int = 8080,
+    path: str = "/webhook",
+    url: str = None,
+    drain_timeout: float = 60,
+    **data: Any,
+) -> None:
+    """
+    Receive updates through a webhook until SIGTERM or SIGINT, then drain
+    the updates in progress and stop.
+    :param url: public URL of the webhook. If given, the webhook is registered
+        with Telegram on start; otherwise it is expected to be set already
+        (e.g. by another replica).
+    :param drain_timeout: seconds to wait for updates in progress on shutdown.
+    """
+    if not secret_token:
+        raise ValueError("A secret token is required in webhook mode")
+    app, handler = build_webhook_app(dp, bot, secret_token, path, **data)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Webhook is served at http://{host}:{port}{path}")
+
+    if url:
+        await bot.set_webhook(
+            url,
+            secret_token=secret_token,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info(f"Webhook is registered at {url}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+        logger.info("Shutting down the webhook")
+        # Keep serving until the updates in progress are done, so that
+        # new updates and health checks are answered with 503
+        await handler.drain(drain_timeout)
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+        await runner.cleanup()
+
+
+class FakeTelegramSender:
+    """
+    Posts updates to a webhook the way Telegram does, for local testing
+    without a public URL. The bot's own requests to the Bot API still need
+    a token or a fake session.
+    """
+
+    def __init__(self, url: str, secret_token: str):
+        """
+        :param url: URL of the webhook, e.g. http://127.0.0.1:8080/webhook.
+        :param secret_token: secret token the webhook expects.
+        """
+        self.url = url
+        self.secret_token = secret_token
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _message(self, user_id: int, **fields: Any) -> Dict:
+        user = {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": f"User {user_id}",
+        }
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": user,
+                **fields,
+            },
+        }
+
+    def text_update(self, user_id: int, text: str) -> Dict:
+        """
+        :return: update with a text message (or a command) from a user.
+        """
+        fields = {"text": text}
+        if text.startswith("/"):
+            command_length = len(text.split()[0])
+            fields["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": command_length}
+            ]
+        return self._message(user_id, **fields)
+
+    def document_update(
+        self,
+        user_id: int,
+        file_name: str,
+        file_size: int,
+        file_id: str = None,
+        mime_type: str = "application/octet-stream",
+    ) -> Dict:
+        """
+        :return: update with a document from a user. Downloading it goes
+            through the bot's session, so file_id must be known to it.
+        """
+        file_id = file_id or f"file-{file_name}"
+        document = {
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "file_name": file_name,
+            "file_size": file_size,
+            "mime_type": mime_type,
+        }
+        return self._message(user_id, document=document)
+
+    async def send(
+        self, update: Dict, session: aiohttp.ClientSession = None
+    ) -> int:
+        """
+        Post an update to the webhook.
+        :return: HTTP status of the response.
+        """
+        headers = {SECRET_TOKEN_HEADER: self.secret_token}
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self.send(update, session)
+        async with session.post(self.url, json=update, headers=headers) as r:
+            return r.status
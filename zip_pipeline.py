@@ -0,0 +1,377 @@
+import asyncio
+import csv
+import io
+import logging
+import os
+import posixpath
+import shutil
+import tempfile
+import time
+import zipfile
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Sequence
+
+import garth
+
+from conversion_cache import (
+    ConversionCache,
+    content_hash,
+    is_duplicate_upload,
+)
+from conversion_pool import ConversionBusyError, ConversionExecutor
+from convert_all_tcx import output_file_name
+from garmin_uploader import GarminUploader
+from memory_budget import MemoryBudget, estimate_footprint
+from upload_queue import UploadQueue, is_retryable
+
+logger = logging.getLogger(__name__)
+
+# How long a batch waits for a free conversion slot before giving up on an entry
+BUSY_RETRY_DELAY = 0.5
+BUSY_RETRY_LIMIT = 120
+
+
+@dataclass
+class BatchReport:
+    """
+    Totals of a processed ZIP archive.
+    """
+
+    total: int = 0
+    converted: int = 0
+    uploaded: int = 0
+    upload_failed: int = 0
+    queued: int = 0
+    failed: int = 0
+    skipped: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: float = None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished_at or time.monotonic()
+        return end - self.started_at
+
+
+class BatchReporter:
+    """
+    Receives per-entry events from ZipBatchPipeline. The default does nothing;
+    the bot overrides the methods to talk to the user.
+    """
+
+    async def started(self, total: int) -> None:
+        pass
+
+    async def converted(
+        self, name: str, summary: Dict, converted_content: bytes
+    ) -> None:
+        pass
+
+    async def uploaded(self, name: str) -> None:
+        pass
+
+    async def upload_failed(self, name: str, converted_content: bytes) -> None:
+        pass
+
+    async def queued(self, name: str) -> None:
+        pass
+
+    async def already_uploaded(self, name: str) -> None:
+        pass
+
+    async def failed(self, name: str, error: Exception) -> None:
+        pass
+
+
+class ResultArchive:
+    """
+    ZIP archive of the results of a batch, written to a temporary file entry
+    by entry as the results come in, so it is never held in memory.
+    """
+
+    def __init__(self, file_name: str, max_size: int = None):
+        """
+        :param file_name: name of the archive file.
+        :param max_size: entries are no longer added once the archive has
+            reached this size; the last one added may exceed it.
+        """
+        self._dir = tempfile.mkdtemp(prefix="tcx_bot_")
+        self.path = os.path.join(self._dir, os.path.basename(file_name))
+        self.max_size = max_size
+        self.count = 0
+        self._file = open(self.path, "w+b")
+        self._zip = zipfile.ZipFile(self._file, "w", zipfile.ZIP_DEFLATED)
+        # Writes run in threads, one at a time
+        self._lock = asyncio.Lock()
+
+    @property
+    def size(self) -> int:
+        """
+        :return: bytes written so far.
+        """
+        return self._file.tell()
+
+    @property
+    def full(self) -> bool:
+        return self.max_size is not None and self.size >= self.max_size
+
+    async def add(self, name: str, content: bytes) -> bool:
+        """
+        Compress an entry into the archive.
+        :return: False if the archive is full and the entry was left out.
+        """
+        async with self._lock:
+            if self.full:
+                return False
+            await asyncio.to_thread(self._zip.writestr, name, content)
+            self.count += 1
+            return True
+
+    async def close(
+        self, summary: Iterable[Dict] = None, fields: Sequence[str] = ()
+    ) -> None:
+        """
+        Finish the archive, with a summary.csv of the given rows, if any.
+        """
+        async with self._lock:
+            if summary is not None:
+                text = io.StringIO()
+                writer = csv.DictWriter(
+                    text, fieldnames=fields, extrasaction="ignore"
+                )
+                writer.writeheader()
+                writer.writerows(summary)
+                await asyncio.to_thread(
+                    self._zip.writestr, "summary.csv", text.getvalue()
+                )
+            await asyncio.to_thread(self._zip.close)
+            self._file.close()
+
+    def cleanup(self) -> None:
+        """
+        Delete the archive file.
+        """
+        self._zip.close()
+        self._file.close()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def result_entry_name(name: str, output_format: str = "tcx") -> str:
+    """
+    :return: name of a converted ZIP entry in the results, in the directory
+        of the original entry, e.g. "rides/converted_ride.fit".
+    """
+    directory, file_name = posixpath.split(name)
+    return posixpath.join(
+        directory, output_file_name(file_name, output_format)
+    )
+
+
+class ZipBatchPipeline:
+    """
+    Processes the TCX entries of a ZIP archive concurrently: entries are read,
+    converted and uploaded in parallel with a separate limit per stage.
+    A failing entry doesn't stop the others. Entries whose upload failed
+    temporarily are handed over to the upload queue, if there is one.
+    With a memory budget, every entry reserves its estimated footprint
+    (from its uncompressed size) before it is read.
+    """
+
+    def __init__(
+        self,
+        converter: ConversionExecutor,
+        uploader: GarminUploader,
+        read_limit: int = 2,
+        convert_limit: int = 2,
+        upload_limit: int = 2,
+        cache: ConversionCache = None,
+        upload_queue: UploadQueue = None,
+        memory_budget: MemoryBudget = None,
+    ):
+        self.converter = converter
+        self.uploader = uploader
+        self.cache = cache
+        self.upload_queue = upload_queue
+        self.memory_budget = memory_budget
+        self.read_limit = read_limit
+        self.convert_limit = convert_limit
+        self.upload_limit = upload_limit
+
+    async def _convert(self, convert, *args):
+        # Other users share the conversion pool, so wait for a free slot
+        for _ in range(BUSY_RETRY_LIMIT):
+            try:
+                return await convert(*args)
+            except ConversionBusyError:
+                await asyncio.sleep(BUSY_RETRY_DELAY)
+        return await convert(*args)
+
+    async def run(
+        self,
+        zip_ref: zipfile.ZipFile,
+        g_client: garth.Client,
+        reporter: BatchReporter,
+        zip_path: str = None,
+        user_id: int = None,
+        chat_id: int = None,
+        output_format: str = "tcx",
+    ) -> BatchReport:
+        """
+        Convert and upload every TCX entry of an open ZIP archive.
+        :param zip_ref: open ZIP archive.
+        :param g_client: authorized garth client of the user.
+        :param reporter: receives per-entry events.
+        :param zip_path: path of the archive if it is on disk; then the
+            conversion workers read the entries themselves.
+        :param user_id: Telegram user ID; entries this user already uploaded
+            are skipped.
+        :param chat_id: chat to notify about entries retried by the upload queue.
+        :param output_format: "tcx" or "fit", the format uploaded to Garmin.
+        :return: Totals and timing of the batch.
+        """
+        names = [name for name in zip_ref.namelist() if name.endswith(".tcx")]
+        report = BatchReport(total=len(names))
+        await reporter.started(report.total)
+
+        read_sem = asyncio.Semaphore(self.read_limit)
+        convert_sem = asyncio.Semaphore(self.convert_limit)
+        upload_sem = asyncio.Semaphore(self.upload_limit)
+        # Bound the number of entries held in memory at once
+        in_flight = asyncio.Semaphore(
+            self.read_limit + self.convert_limit + self.upload_limit
+        )
+
+        track_uploads = self.cache is not None and user_id is not None
+
+        def read_entry(name: str) -> bytes:
+            with zip_ref.open(name) as entry:
+                return entry.read()
+
+        def hash_entry(name: str, content: bytes) -> str:
+            if content is not None:
+                return content_hash(content)
+            with zip_ref.open(name) as entry:
+                return content_hash(entry)
+
+        async def process(name: str) -> None:
+            # The memory reservation is held until the entry is done
+            async with in_flight, AsyncExitStack() as reservation:
+                content = key = None
+                try:
+                    if self.memory_budget is not None:
+                        reservation.enter_context(
+                            await self.memory_budget.reserve(
+                                estimate_footprint(
+                                    zip_ref.getinfo(name).file_size,
+                                    output_format,
+                                    on_disk=bool(zip_path),
+                                )
+                            )
+                        )
+                    async with read_sem:
+                        if not zip_path:
+                            content = await asyncio.to_thread(read_entry, name)
+                        if self.cache is not None:
+                            key = await asyncio.to_thread(
+                                hash_entry, name, content
+                            )
+                    if track_uploads and await self.cache.is_uploaded(
+                        user_id, key
+                    ):
+                        report.skipped += 1
+                        await reporter.already_uploaded(name)
+                        return
+
+                    cache_key = (
+                        self.converter.cache_key(key, output_format)
+                        if key
+                        else None
+                    )
+                    cached = await self.cache.get(cache_key) if key else None
+                    if cached:
+                        converted_content, summary = cached
+                    elif zip_path:
+                        async with convert_sem:
+                            converted_content, summary = await self._convert(
+                                self.converter.convert_zip_member,
+                                zip_path,
+                                name,
+                                user_id,
+                                output_format,
+                            )
+                    else:
+                        async with convert_sem:
+                            converted_content, summary = await self._convert(
+                                self.converter.convert_tcx,
+                                content,
+                                user_id,
+                                output_format,
+                            )
+                    del content
+                    if key and not cached:
+                        await self.cache.put(
+                            cache_key, converted_content, summary
+                        )
+                except Exception as e:
+                    logger.error(f"Error during conversion of {name}: {e}")
+                    report.failed += 1
+                    await reporter.failed(name, e)
+                    return
+                report.converted += 1
+                await reporter.converted(name, summary, converted_content)
+
+                try:
+                    converted_content_io = io.BytesIO(converted_content)
+                    converted_content_io.name = output_file_name(
+                        name, output_format
+                    )
+                    async with upload_sem:
+                        uploaded = await self.uploader.upload(
+                            g_client, converted_content_io, user_id
+                        )
+                except Exception as e:
+                    # Not only GarthHTTPError: garth passes network errors
+                    # and timeouts through unwrapped
+                    logger.info(f"Upload of {name} failed: {e}")
+                    if (
+                        self.upload_queue is not None
+                        and chat_id is not None
+                        and is_retryable(e)
+                    ):
+                        await self.upload_queue.enqueue(
+                            user_id,
+                            chat_id,
+                            converted_content_io.name,
+                            converted_content,
+                            key,
+                        )
+                        report.queued += 1
+                        await reporter.queued(name)
+                        return
+                    if track_uploads and is_duplicate_upload(e):
+                        await self.cache.mark_uploaded(user_id, key)
+                    report.upload_failed += 1
+                    await reporter.upload_failed(name, converted_content)
+                    return
+                if uploaded:
+                    if track_uploads:
+                        await self.cache.mark_uploaded(user_id, key)
+                    report.uploaded += 1
+                    await reporter.uploaded(name)
+
+        results = await asyncio.gather(
+            *(process(name) for name in names), return_exceptions=True
+        )
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error while processing {name}: {result}")
+        report.finished_at = time.monotonic()
+        logger.info(
+            f"ZIP batch: {report.total} entries, {report.converted} converted, "
+            f"{report.uploaded} uploaded, {report.queued} queued, "
+            f"{report.skipped} skipped, "
+            f"{report.failed} failed "
+            f"in {report.elapsed:.1f}s"
+        )
+        return report